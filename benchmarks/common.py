@@ -0,0 +1,67 @@
+"""
+Synthetic data and timing helpers shared by all benchmarks.
+The benchmarks are run as scripts, e.g. python benchmarks/feature_extraction.py, so this module is importable as 'common'.
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def random_signals(num_utterances, min_sec, max_sec, sample_rate, seed=42):
+    """
+    Gaussian noise signals with random lengths between 'min_sec' and 'max_sec' seconds.
+    """
+    rng = np.random.RandomState(seed)
+    return [rng.normal(0, 0.1, int(sample_rate * rng.uniform(min_sec, max_sec))).astype(np.float32) for _ in range(num_utterances)]
+
+
+def _value_dtype(value):
+    if isinstance(value, (str, bytes)):
+        return tf.string
+    return tf.as_dtype(np.asarray(value).dtype)
+
+
+def dataset_from_elements(elements):
+    """
+    Dataset of all element dicts in the list 'elements', which must all have the same keys, value dtypes and value shapes as the first element, except for the length of the first axis.
+    """
+    first = elements[0]
+    return tf.data.Dataset.from_generator(
+            lambda: iter(elements),
+            {k: _value_dtype(v) for k, v in first.items()},
+            {k: tf.TensorShape([None] + list(np.shape(v)[1:]) if np.ndim(v) else []) for k, v in first.items()})
+
+
+def signal_dataset(signals, sample_rate, **extra_values):
+    """
+    Dataset of elements with keys 'id', 'signal' and 'sample_rate', and a value from every list in 'extra_values' under its key.
+    Elements are kept in memory after the dataset has been iterated once, to measure only the steps applied after it.
+    """
+    elements = [{"id": "utt{:06d}".format(i), "signal": s, "sample_rate": np.int32(sample_rate)} for i, s in enumerate(signals)]
+    for key, values in extra_values.items():
+        for x, value in zip(elements, values):
+            x[key] = value
+    return dataset_from_elements(elements).cache()
+
+
+def iterate(ds):
+    """
+    Iterate over all elements of 'ds' and return the amount of elements.
+    """
+    num_elements = 0
+    for _ in ds:
+        num_elements += 1
+    return num_elements
+
+
+def mean_seconds(fn, repeats, warmup=1):
+    """
+    Mean wall clock time in seconds of calling 'fn' 'repeats' times, after 'warmup' calls that are not timed, e.g. for tracing tf.functions.
+    """
+    for _ in range(warmup):
+        fn()
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - begin) / repeats
@@ -0,0 +1,105 @@
+"""
+Compare the disk usage, read throughput and quantization error of feature caches written by lidbox.dataset.steps.cache with different storage dtypes.
+Uses random log-scale spectrograms of random lengths as features, with a random spectral envelope for every label.
+The effect of the quantization error on language identification is measured as the minimum C_avg of a small model, trained on float32 features, on the features read from each cache.
+
+Usage:
+    python benchmarks/feature_cache.py --num-utterances 2000 --num-channels 40
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import lidbox.dataset.steps as steps
+import lidbox.metrics
+
+from common import dataset_from_elements, iterate, mean_seconds
+
+
+def make_features(num_utterances, min_frames, max_frames, num_channels, num_labels, separation, seed=42):
+    rng = np.random.RandomState(seed)
+    # Every label has its own average power in every channel
+    envelopes = np.exp(separation * rng.normal(size=(num_labels, num_channels)))
+    features, labels = [], rng.randint(num_labels, size=num_utterances)
+    for label in labels:
+        num_frames = rng.randint(min_frames, max_frames + 1)
+        power = envelopes[label] * rng.gamma(0.5, 1.0, (num_frames, num_channels))
+        features.append((10.0 * np.log10(np.maximum(1e-10, power))).astype(np.float32))
+    return features, labels
+
+
+def train_model(features, labels, num_labels, num_frames, epochs):
+    # Equal length crops for batching
+    inputs = np.stack([f[:num_frames] for f in features])
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input((None, inputs.shape[2])),
+        tf.keras.layers.BatchNormalization(),
+        tf.keras.layers.Conv1D(32, 5, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling1D(),
+        tf.keras.layers.Dense(num_labels),
+        tf.keras.layers.Activation(tf.nn.log_softmax)])
+    model.compile(optimizer="adam", loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True))
+    model.fit(inputs, labels, batch_size=32, epochs=epochs, verbose=0)
+    return model
+
+
+def min_average_detection_cost(model, features, labels, num_labels):
+    log_probs = np.concatenate([model(f[np.newaxis], training=False).numpy() for f in features])
+    cavg = lidbox.metrics.SparseAverageDetectionCost(num_labels, np.log(np.linspace(0.01, 0.99, 99)))
+    cavg.update_state(np.expand_dims(labels, -1), log_probs)
+    return float(cavg.result().numpy())
+
+
+def make_dataset(features):
+    return dataset_from_elements([{"id": "utt{:06d}".format(i), "input": f} for i, f in enumerate(features)])
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-utterances", type=int, default=2000)
+    parser.add_argument("--num-train-utterances", type=int, default=2000)
+    parser.add_argument("--min-frames", type=int, default=200)
+    parser.add_argument("--max-frames", type=int, default=400)
+    parser.add_argument("--num-channels", type=int, default=40)
+    parser.add_argument("--num-labels", type=int, default=4)
+    parser.add_argument("--separation", type=float, default=0.05, help="Standard deviation of the log-power differences between the spectral envelopes of labels")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    features, labels = make_features(
+            args.num_train_utterances + args.num_utterances,
+            args.min_frames, args.max_frames, args.num_channels, args.num_labels, args.separation)
+    train_features, features = features[:args.num_train_utterances], features[args.num_train_utterances:]
+    train_labels, labels = labels[:args.num_train_utterances], labels[args.num_train_utterances:]
+    model = train_model(train_features, train_labels, args.num_labels, args.min_frames, args.epochs)
+    print("C_avg without cache: {:.4f}".format(min_average_detection_cost(model, features, labels, args.num_labels)))
+    print("{:>8s} {:>12s} {:>16s} {:>14s} {:>14s} {:>8s}".format("dtype", "size (MiB)", "read (utt/sec)", "max abs err", "mean abs err", "C_avg"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for storage_dtype in ("float32", "float16", "uint8"):
+            directory = os.path.join(tmpdir, storage_dtype)
+            # Elements are only batched with equal shapes, use batch size 1 to avoid grouping
+            ds = steps.cache(make_dataset(features), directory=directory, batch_size=1, cache_key="features", storage_dtype=storage_dtype)
+            # Fill the cache
+            cached = [x["input"].numpy() for x in ds]
+            errors = [np.abs(c - f) for c, f in zip(cached, features)]
+            size = directory_size(directory)
+            read_sec = mean_seconds(lambda: iterate(ds), args.repeats, warmup=0)
+            print("{:>8s} {:12.2f} {:16.1f} {:14.3g} {:14.3g} {:8.4f}".format(
+                storage_dtype,
+                size / 2**20,
+                len(features) / read_sec,
+                max(e.max() for e in errors),
+                np.mean([e.mean() for e in errors]),
+                min_average_detection_cost(model, cached, labels, args.num_labels)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compare the throughput of the feature extraction backends of lidbox.dataset.steps.extract_features, in seconds of audio processed per second.
+Uses random signals of random lengths as input.
+
+Usage:
+    python benchmarks/feature_extraction.py --num-utterances 500 --batch-size 1 32 --feature-type logmelspectrogram mfcc
+"""
+import argparse
+import os
+
+import lidbox.dataset.steps as steps
+
+from common import iterate, mean_seconds, random_signals, signal_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-utterances", type=int, default=500)
+    parser.add_argument("--min-sec", type=float, default=2.0)
+    parser.add_argument("--max-sec", type=float, default=10.0)
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--feature-type", nargs="+", default=["logmelspectrogram", "mfcc"])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 32])
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    signals = random_signals(args.num_utterances, args.min_sec, args.max_sec, args.sample_rate)
+    total_sec = sum(s.size for s in signals) / args.sample_rate
+    ds = signal_dataset(signals, args.sample_rate)
+    iterate(ds)
+    print("{} utterances, {:.1f} seconds of audio, {} worker processes for the numpy backend".format(args.num_utterances, total_sec, args.num_workers))
+    print("{:>18s} {:>8s} {:>11s} {:>20s}".format("feature type", "backend", "batch size", "audio sec / sec"))
+    for feature_type in args.feature_type:
+        for batch_size in args.batch_size:
+            for backend in ("tf", "numpy"):
+                config = {
+                    "type": feature_type,
+                    "sample_rate": args.sample_rate,
+                    "batch_size": batch_size,
+                    "pad_batches": True,
+                    "window_normalization": {"window_len": 300},
+                    "device": "/CPU:0",
+                    "backend": backend,
+                    "num_workers": args.num_workers,
+                }
+                features_ds = steps.extract_features(ds, config)
+                # Warm up, e.g. tracing and starting worker processes
+                iterate(features_ds.take(2 * batch_size))
+                sec = mean_seconds(lambda: iterate(features_ds), args.repeats, warmup=0)
+                print("{:>18s} {:>8s} {:11d} {:20.1f}".format(feature_type, backend, batch_size, total_sec / sec))
+
+
+if __name__ == "__main__":
+    main()
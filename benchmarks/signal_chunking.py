@@ -0,0 +1,85 @@
+"""
+Compare the throughput of lidbox.dataset.steps.create_signal_chunks, which chunks every signal with one batched operation, to the previous implementation that interleaved three nested datasets for every signal, in chunks per second.
+Uses random signals of random lengths with a frame level VAD decision array as input.
+
+Usage:
+    python benchmarks/signal_chunking.py --num-utterances 1000 --length-ms 2000 --step-ms 500
+"""
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import lidbox.dataset.steps as steps
+
+from common import iterate, mean_seconds, random_signals, signal_dataset
+
+
+def nested_dataset_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, max_num_chunks_per_signal=int(1e6), avg_num_chunks_from_signals=100):
+    """create_signal_chunks before chunking was done with map and unbatch."""
+    chunk_length_sec = tf.constant(1e-3 * length_ms, tf.float32)
+    chunk_step_sec = tf.constant(1e-3 * step_ms, tf.float32)
+    max_pad_sec = tf.constant(1e-3 * max_pad_ms, tf.float32)
+    id_str_padding = int(round(np.log10(max_num_chunks_per_signal)))
+    def chunks_to_elements(chunk, chunk_num, x):
+        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
+        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
+        return dict(x, signal=tf.reshape(chunk, [-1]), id=chunk_id)
+    def chunk_signal_and_flatten(x):
+        signal = x["signal"]
+        sample_rate = tf.cast(x["sample_rate"], tf.float32)
+        chunk_length = tf.cast(sample_rate * chunk_length_sec, tf.int32)
+        chunk_step = tf.cast(sample_rate * chunk_step_sec, tf.int32)
+        max_pad = tf.cast(sample_rate * max_pad_sec, tf.int32)
+        num_full_chunks = tf.math.maximum(0, 1 + (tf.size(signal) - chunk_length) // chunk_step)
+        last_chunk_length = tf.size(signal) - num_full_chunks * chunk_step
+        if last_chunk_length < chunk_length and chunk_length <= last_chunk_length + max_pad:
+            signal = tf.pad(signal, [[0, chunk_length - last_chunk_length]])
+        chunks = tf.signal.frame(signal, chunk_length, chunk_step, axis=0)
+        num_chunks = tf.cast(tf.shape(chunks)[0], tf.int64)
+        chunk_ds = tf.data.Dataset.from_tensor_slices(chunks)
+        chunk_nums_ds = tf.data.Dataset.range(1, num_chunks + 1)
+        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(num_chunks)
+        return (tf.data.Dataset
+                  .zip((chunk_ds, chunk_nums_ds, repeat_x_ds))
+                  .map(chunks_to_elements))
+    return ds.interleave(chunk_signal_and_flatten, block_length=avg_num_chunks_from_signals, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+
+def make_dataset(num_utterances, min_sec, max_sec, sample_rate, seed=42):
+    signals = random_signals(num_utterances, min_sec, max_sec, sample_rate, seed)
+    rng = np.random.RandomState(seed + 1)
+    # 10 ms VAD frames
+    vad_decisions = [rng.uniform(size=s.size // (sample_rate // 100)) > 0.2 for s in signals]
+    return signal_dataset(signals, sample_rate, vad_is_speech=vad_decisions)
+
+
+def benchmark(ds, repeats):
+    num_chunks = iterate(ds)
+    return num_chunks, mean_seconds(lambda: iterate(ds), repeats, warmup=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-utterances", type=int, default=1000)
+    parser.add_argument("--min-sec", type=float, default=2.0)
+    parser.add_argument("--max-sec", type=float, default=20.0)
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--length-ms", type=int, default=2000)
+    parser.add_argument("--step-ms", type=int, nargs="+", default=[2000, 500])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    ds = make_dataset(args.num_utterances, args.min_sec, args.max_sec, args.sample_rate)
+    iterate(ds)
+    print("{} utterances, chunk length {} ms".format(args.num_utterances, args.length_ms))
+    print("{:>8s} {:>8s} {:>18s} {:>18s} {:>8s}".format("step ms", "chunks", "nested (chunk/s)", "unbatch (chunk/s)", "speedup"))
+    for step_ms in args.step_ms:
+        num_chunks, old_sec = benchmark(nested_dataset_signal_chunks(ds, args.length_ms, step_ms), args.repeats)
+        new_num_chunks, new_sec = benchmark(steps.create_signal_chunks(ds, args.length_ms, step_ms), args.repeats)
+        assert num_chunks == new_num_chunks, "implementations created different amounts of chunks"
+        print("{:8d} {:8d} {:18.1f} {:18.1f} {:8.2f}".format(step_ms, num_chunks, num_chunks / old_sec, num_chunks / new_sec, old_sec / new_sec))
+
+
+if __name__ == "__main__":
+    main()
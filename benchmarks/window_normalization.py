@@ -0,0 +1,61 @@
+"""
+Compare lidbox.features.window_normalization, which computes sliding window statistics from cumulative sums, to the previous implementation that materialized all windows with tf.signal.frame.
+
+Usage:
+    python benchmarks/window_normalization.py --batch-size 32 --num-frames 1000 --window-len 300
+"""
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import lidbox.features
+
+from common import mean_seconds
+
+
+@tf.function
+def frame_based_window_normalization(X, window_len=-1, normalize_variance=True):
+    """Sliding window branch of window_normalization before cumulative sums were used."""
+    padding = tf.constant([[0, 0], [window_len//2, window_len//2 - 1 + (window_len&1)], [0, 0]])
+    X_padded = tf.pad(X, padding, mode="REFLECT")
+    windows = tf.signal.frame(X_padded, window_len, 1, axis=1)
+    output = X - tf.math.reduce_mean(windows, axis=2)
+    if normalize_variance:
+        output = tf.math.divide_no_nan(output, tf.math.reduce_std(windows, axis=2))
+    return output
+
+
+def benchmark(fn, X, window_len, repeats):
+    # First call traces the tf.function
+    return mean_seconds(lambda: fn(X, window_len).numpy(), repeats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-frames", type=int, default=1000)
+    parser.add_argument("--num-channels", type=int, default=40)
+    parser.add_argument("--window-len", type=int, nargs="+", default=[50, 150, 300])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    X = tf.constant(np.random.RandomState(42).normal(5.0, 3.0, (args.batch_size, args.num_frames, args.num_channels)), tf.float32)
+    print("input shape {}".format(X.shape.as_list()))
+    print("{:>10s} {:>14s} {:>14s} {:>8s} {:>14s}".format("window_len", "frames (ms)", "cumsum (ms)", "speedup", "max abs diff"))
+    for window_len in args.window_len:
+        new = lidbox.features.window_normalization(X, window_len).numpy()
+        new_sec = benchmark(lidbox.features.window_normalization, X, window_len, args.repeats)
+        try:
+            old = frame_based_window_normalization(X, window_len).numpy()
+        except tf.errors.ResourceExhaustedError:
+            # The frames tensor has batch_size * num_frames * window_len * num_channels elements
+            print("{:10d} {:>14s} {:14.3f} {:>8s} {:>14s}".format(window_len, "OOM", 1e3 * new_sec, "-", "-"))
+            continue
+        old_sec = benchmark(frame_based_window_normalization, X, window_len, args.repeats)
+        print("{:10d} {:14.3f} {:14.3f} {:8.2f} {:14.3g}".format(
+            window_len, 1e3 * old_sec, 1e3 * new_sec, old_sec / new_sec, np.abs(old - new).max()))
+
+
+if __name__ == "__main__":
+    main()
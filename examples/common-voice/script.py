@@ -33,10 +33,8 @@ def create_dataset(split, labels, init_data, config):
         Step("apply_filters", {"config": config["pre_process"]["filters"]}),
         # Compute WebRTC VAD decisions
         Step("compute_webrtc_vad", config["pre_process"]["webrtcvad"]),
-        # Count how many frames were kept or dropped
-        # NOTE this step will evaluate all previous steps
-        Step("reduce_stats", {"statistic": "vad_ratio"}),
         # Drop non-speech frames using computed decisions
+        # Counts of kept and dropped frames are logged when the pipeline is consumed
         Step("apply_vad", {}),
         # Some signals might have become empty after VAD
         Step("drop_empty", {}),
@@ -46,7 +44,7 @@ def create_dataset(split, labels, init_data, config):
         Step("extract_features", {"config": config["features"]}),
         # Serialize all elements to disk
         Step("cache", cache_config),
-        # Evaluate whole pipeline up to this point, this fills the cache
+        # Evaluate whole pipeline up to this point, this fills the cache and logs VAD statistics
         Step("consume", {"log_interval": 10000}),
         # Add some samples to TensorBoard for inspection
         Step("consume_to_tensorboard", tensorboard_config),
@@ -10,7 +10,8 @@ import sys
 import yaml
 
 
-random.seed(int(os.environ.get("LIDBOX_RANDOM_SEED", "42")))
+RANDOM_SEED = int(os.environ.get("LIDBOX_RANDOM_SEED", "42"))
+random.seed(RANDOM_SEED)
 
 DEBUG = os.environ.get("LIDBOX_DEBUG") not in (None, "False", "false", "0")
 
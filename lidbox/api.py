@@ -4,7 +4,6 @@ import itertools
 import json
 import logging
 import os
-import random
 import sys
 
 logger = logging.getLogger("api")
@@ -13,6 +12,8 @@ import numpy as np
 import sklearn.metrics
 
 import lidbox
+import lidbox.metadata
+import lidbox.system
 from lidbox.dataset.steps import Step
 from lidbox.models.keras_utils import KerasWrapper
 
@@ -24,7 +25,9 @@ VALID_METADATA_FILES = {
     "utt2label": "label",
     "utt2lang": "label",
     "utt2path": "path",
+    "utt2seg": "segment",
     "utt2spk": "speaker",
+    "wav.scp": lidbox.metadata.FILE_PATH_KEY,
 }
 
 
@@ -41,6 +44,7 @@ def create_datasets(split2meta, labels, config):
 
 def get_flat_dataset_config(config):
     num_datasets = len(config["datasets"])
+    metadata_config = config.get("metadata", {})
     # Merge all labels and sort
     labels = sorted(set(label for dataset in config["datasets"] for label in dataset["labels"]))
     split2datasets = collections.defaultdict(list)
@@ -48,60 +52,62 @@ def get_flat_dataset_config(config):
         for split in dataset["splits"]:
             split = dict(split)
             logger.info("Scanning dataset '%s' split '%s' for valid metadata files", dataset["key"], split["key"])
-            meta = {VALID_METADATA_FILES[p.name]: p.path for p in os.scandir(split.pop("path")) if p.name in VALID_METADATA_FILES}
+            split_dir = split.pop("path")
+            meta = {VALID_METADATA_FILES[p.name]: p.path for p in os.scandir(split_dir) if p.name in VALID_METADATA_FILES}
+            if lidbox.metadata.FILE_PATH_KEY in meta and ("path" in meta or "segment" not in meta):
+                # wav.scp is only needed for resolving the paths of utt2seg segments when there is no utt2path
+                del meta[lidbox.metadata.FILE_PATH_KEY]
             logger.info("Using valid metadata files:\n  %s", '\n  '.join(meta.values()))
+            if metadata_config.get("index", False):
+                if "index_directory" in metadata_config:
+                    index_dir = os.path.join(metadata_config["index_directory"], dataset["key"], split["key"])
+                elif "cache" in config:
+                    index_dir = os.path.join(config["cache"]["directory"], "metadata_index", dataset["key"], split["key"])
+                else:
+                    # Dataset directories might be read-only, but there is nowhere else to write the index
+                    index_dir = os.path.join(split_dir, lidbox.metadata.DEFAULT_INDEX_DIRECTORY)
+                # Also checks that all metadata files contain the same utterance ids
+                meta["index"] = lidbox.metadata.update_index(index_dir, meta)
             meta["dataset"] = dataset["key"]
             meta["kwargs"] = split
             split2datasets[split.pop("key")].append(meta)
-    #TODO assert amount of keys and all values of same length
+    #TODO assert amount of keys and all values of same length when not using an index
     return dict(split2datasets), labels
 
 
-def load_all_metadata_from_paths(split2datasets):
-    split2datasets_meta = collections.OrderedDict()
-    for split, datasets in split2datasets.items():
-        split2datasets_meta[split] = []
-        for meta in datasets:
-            meta = dict(meta)
-            dataset = meta.pop("dataset")
-            kwargs = meta.pop("kwargs")
-            logger.info("Loading all metadata file contents for dataset '%s' split '%s'", dataset, split)
-            # Read all meta files
-            meta = {key: collections.OrderedDict(lidbox.iter_metadata_file(path, num_columns=2)) for key, path in meta.items()}
-            logger.info("Amount of contents per file:\n  %s", '\n  '.join("{}: {}".format(key, len(val)) for key, val in meta.items()))
-            first_meta_length = len(list(meta.values())[0])
-            if not all(len(meta_list) == first_meta_length for meta_list in meta.values()):
-                logger.error("All metadata files must contain exactly the same amount of unique utterance ids")
-                return
-            # 'utt2path' is always present, use it to select final utterance ids
-            utt_ids = list(meta["path"].keys())
-            if kwargs.get("shuffle_files", False):
-                logger.info("'shuffle_files' given for dataset '%s' split '%s', shuffling all its utterance ids", dataset, split)
-                random.shuffle(utt_ids)
-            file_limit = kwargs.get("file_limit")
-            utt_ids = utt_ids[:file_limit]
-            logger.info("After applying file_limit %s, amount of final utterance ids that will be used is %d", file_limit, len(utt_ids))
-            # Filter all metadata with selected utterance ids to ensure correct order of metadata
-            # This step is very important in order to not have samples with wrong metadata
-            meta = {key: [utt2meta[utt] for utt in utt_ids] for key, utt2meta in meta.items()}
-            meta["id"] = utt_ids
-            meta["dataset"] = len(utt_ids) * [dataset]
-            if "kaldi_ark_key" in meta:
-                logger.info("Metadata contains 'kaldi_ark_key', loading all arrays from Kaldi archive files.")
-                from kaldiio import load_mat
-                meta["kaldi_ark"] = [load_mat(key) for key in meta["kaldi_ark_key"]]
-            split2datasets_meta[split].append(meta)
-            logger.info("Dataset '%s' split '%s' done, all its elements will have keys:\n  %s", dataset, split, '\n  '.join(meta.keys()))
+def load_all_metadata_from_paths(split2datasets, num_workers=1):
+    """
+    Load metadata of all datasets of all splits, in parallel with 'num_workers' processes if there are more than one dataset.
+    The results are always in the same order as the datasets in 'split2datasets'.
+    The workers run lidbox.metadata.load_dataset_metadata, which does not depend on TensorFlow, so starting them is cheap.
+    """
+    tasks = [(split, meta) for split, datasets in split2datasets.items() for meta in datasets]
+    num_workers = min(num_workers, len(tasks))
+    if num_workers > 1:
+        logger.info("Loading metadata of %d datasets using %d worker processes", len(tasks), num_workers)
+        results = lidbox.system.get_pool(num_workers).starmap(lidbox.metadata.load_dataset_metadata, tasks, chunksize=1)
+    else:
+        results = [lidbox.metadata.load_dataset_metadata(split, meta) for split, meta in tasks]
+    if any(meta is None for meta in results):
+        return
+    split2datasets_meta = collections.OrderedDict((split, []) for split in split2datasets)
+    for (split, _), meta in zip(tasks, results):
+        split2datasets_meta[split].append(meta)
     return split2datasets_meta
 
 
 def merge_dataset_metadata(split2datasets_meta):
+    """
+    Concatenate the metadata lists of all datasets of each split.
+    Every list is built in one pass and splits with only one dataset are used as is.
+    """
     split2meta = {}
     for split, datasets in split2datasets_meta.items():
-        split2meta[split] = {key: data for key, data in datasets[0].items()}
-        for dataset in datasets[1:]:
-            for key, data in dataset.items():
-                split2meta[split][key].extend(data)
+        if len(datasets) == 1:
+            split2meta[split] = datasets[0]
+        else:
+            split2meta[split] = {key: list(itertools.chain.from_iterable(dataset[key] for dataset in datasets))
+                                 for key in datasets[0]}
     return split2meta
 
 
@@ -119,13 +125,18 @@ def load_splits_from_config_file(config_file_path):
     logger.info("Reading all metadata from %d different datasets.", len(config["datasets"]))
     split2datasets, labels = get_flat_dataset_config(config)
     logger.info("Merged all metadata into %d splits, set of all labels is:\n  %s", len(split2datasets), '\n  '.join(labels))
-    logger.info("Loading metadata from all files and merging metadata of all datasets")
-    split2meta = merge_dataset_metadata(load_all_metadata_from_paths(split2datasets))
+    if config.get("metadata", {}).get("file_backed", False):
+        logger.info("Metadata is file backed, it will be streamed from the metadata files when the datasets are iterated")
+        split2meta = split2datasets
+    else:
+        logger.info("Loading metadata from all files and merging metadata of all datasets")
+        num_workers = config.get("metadata", {}).get("num_workers", 1)
+        split2meta = merge_dataset_metadata(load_all_metadata_from_paths(split2datasets, num_workers))
     return split2meta, labels, config
 
 
 def run_training(split2ds, config):
-    from lidbox.dataset.steps import as_supervised
+    from lidbox.dataset.steps import as_supervised, augment_by_spec_augment
     from lidbox.models.keras_utils import best_model_checkpoint_from_config
     split_conf = config["experiment"]["data"]
     # 1. get the training and validation splits as defined by the user
@@ -136,6 +147,9 @@ def run_training(split2ds, config):
     if shuffle_buffer_size is not None:
         logger.info("Shuffling training dataset with buffer of size %d", shuffle_buffer_size)
         train_ds = train_ds.shuffle(shuffle_buffer_size)
+    spec_augment_kwargs = split_conf["train"].get("spec_augment")
+    if spec_augment_kwargs is not None:
+        train_ds = augment_by_spec_augment(train_ds, **spec_augment_kwargs)
     train_ds = (train_ds
                     .batch(split_conf["train"]["batch_size"])
                     .apply(as_supervised))
@@ -2,12 +2,16 @@
 lidbox command line interface.
 """
 import argparse
+import collections
 import itertools
 import os
+import shutil
 import sys
 
 import lidbox
 import lidbox.schemas
+import lidbox.system
+import lidbox.wavfile as wavfile
 
 
 def create_argparser():
@@ -227,6 +231,10 @@ class Kaldi(Command):
         with open(args.utt2lang, "w") as f:
             for uttid, lang in utt2lang.items():
                 print(uttid, lang, file=f)
+        # The path of every segment is resolved at load time from the file id of the segment, see lidbox.metadata.load_metadata_files
+        wavscp_file = os.path.join(os.path.dirname(args.utt2seg), "wav.scp")
+        if not (os.path.exists(wavscp_file) and os.path.samefile(wavscp_file, args.wavscp)):
+            print("warning: segment paths are read from '{}' when loading the dataset, but the given wav.scp is '{}'".format(wavscp_file, args.wavscp), file=sys.stderr)
 
     def run(self):
         super().run()
@@ -241,9 +249,99 @@ class Kaldi(Command):
         return 1
 
 
+class Stats(Command):
+    """
+    Compute corpus statistics of all dataset splits in the config file, e.g. durations, sample rates and channel counts of all audio files.
+    Only the RIFF headers of the WAV files are read, in parallel in multiple processes.
+    """
+
+    @classmethod
+    def create_argparser(cls, subparsers):
+        parser = super().create_argparser(subparsers)
+        optional = parser.add_argument_group("stats options")
+        optional.add_argument("--num-workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Amount of processes for reading WAV file headers. Defaults to the amount of CPUs.")
+        optional.add_argument("--write-utt2dur",
+            action="store_true",
+            default=False,
+            help="Write the duration of every utterance in seconds into an utt2dur file in every split directory, which can be used for filtering by duration without reading the audio files. Unreadable files get duration 0, which is always dropped by the 'duration' filter. Existing utt2dur files are backed up to utt2dur.old.")
+        return parser
+
+    def split_stats(self, split_dir):
+        args = self.args
+        utt2path = dict(lidbox.iter_metadata_file(os.path.join(split_dir, "utt2path"), 2))
+        utt2label = {}
+        for label_file in ("utt2lang", "utt2label"):
+            if os.path.exists(os.path.join(split_dir, label_file)):
+                utt2label = dict(lidbox.iter_metadata_file(os.path.join(split_dir, label_file), 2))
+        utt_ids = list(utt2path)
+        utt2dur = {}
+        sample_rates = collections.Counter()
+        channels = collections.Counter()
+        label2stats = collections.defaultdict(lambda: {"num_files": 0, "duration_sec": 0.0})
+        failed = []
+        for utt, info in zip(utt_ids, wavfile.scan_files([utt2path[u] for u in utt_ids], args.num_workers)):
+            if info is None:
+                failed.append(utt)
+                # All metadata files must contain the same utterance ids, the 'duration' filter drops zero durations
+                utt2dur[utt] = 0.0
+                continue
+            sample_rate, num_channels, duration = info
+            utt2dur[utt] = duration
+            sample_rates[sample_rate] += 1
+            channels[num_channels] += 1
+            label_stats = label2stats[utt2label.get(utt, "<no label>")]
+            label_stats["num_files"] += 1
+            label_stats["duration_sec"] += duration
+        failed_set = set(failed)
+        durations = [duration for utt, duration in utt2dur.items() if utt not in failed_set]
+        total_sec = round(sum(durations))
+        stats = {
+            "num_files": len(utt_ids),
+            "num_unreadable_files": len(failed),
+            "total_duration": lidbox.system.format_duration((total_sec // 3600, total_sec // 60 % 60, total_sec % 60)),
+            "total_duration_sec": round(sum(durations), 3),
+            "min_duration_sec": round(min(durations, default=0), 3),
+            "mean_duration_sec": round(sum(durations) / (len(durations) or 1), 3),
+            "max_duration_sec": round(max(durations, default=0), 3),
+            "sample_rates": dict(sample_rates),
+            "num_channels": dict(channels),
+            "labels": {label: dict(v, duration_sec=round(v["duration_sec"], 3)) for label, v in sorted(label2stats.items())},
+        }
+        if failed and args.verbosity:
+            print("Unable to read the WAV headers of {} files in '{}':".format(len(failed), split_dir), file=sys.stderr)
+            for utt in failed:
+                print("  " + utt2path[utt], file=sys.stderr)
+        if args.write_utt2dur:
+            utt2dur_file = os.path.join(split_dir, "utt2dur")
+            if os.path.exists(utt2dur_file):
+                shutil.copyfile(utt2dur_file, utt2dur_file + ".old")
+            with open(utt2dur_file, "w") as f:
+                for utt, duration in utt2dur.items():
+                    print(utt, format(duration, ".3f"), file=f)
+            if args.verbosity:
+                print("Wrote durations of {} utterances to '{}'".format(len(utt2dur), utt2dur_file))
+        return stats
+
+    def run(self):
+        super().run()
+        args = self.args
+        config = lidbox.load_yaml(args.lidbox_config_yaml_path)
+        all_stats = {}
+        for dataset in config["datasets"]:
+            for split in dataset["splits"]:
+                if args.verbosity:
+                    print("Reading WAV headers of all files in dataset '{}' split '{}'".format(dataset["key"], split["key"]))
+                all_stats.setdefault(dataset["key"], {})[split["key"]] = self.split_stats(split["path"])
+        lidbox.yaml_pprint(all_stats)
+
+
 VALID_COMMANDS = (
     E2E,
     Evaluate,
     Kaldi,
+    Stats,
     Utils,
 )
@@ -1,5 +1,26 @@
+import hashlib
+import json
 import os
+
 import lidbox.api
+import lidbox.system
+
+
+def audio_shards_source_hash(init_data, config):
+    """
+    SHA1 hex digest of all metadata in 'init_data' and the JSON serializable dict 'config'.
+    If metadata is file backed, the contents of all metadata files are hashed instead of the paths, and the kwargs of every dataset, e.g. file_limit, are included.
+    """
+    if isinstance(init_data, dict):
+        # All metadata by key, file_limit has already been applied
+        source = {"metadata": init_data}
+    else:
+        source = {"metadata": [
+            {key: value if key in ("dataset", "kwargs") else lidbox.system.md5sum(value)
+                for key, value in meta.items() if key != "index"}
+            for meta in init_data]}
+    source["config"] = config
+    return hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
 
 def create_dataset(split, labels, init_data, config):
@@ -9,44 +30,83 @@ def create_dataset(split, labels, init_data, config):
     labels:
         All labels from all datasets.
     init_data:
-        All metadata by split from all datasets.
+        All metadata by split from all datasets, or the metadata file paths of all datasets if metadata is file backed.
     config:
         Contents of the lidbox config file, unmodified.
     """
     # Configure steps to create dataset iterator
     Step = lidbox.api.Step
     steps = []
+    initialize_kwargs = {"labels": labels, "init_data": init_data}
+    if "file_batch_size" in config.get("metadata", {}):
+        initialize_kwargs["file_batch_size"] = config["metadata"]["file_batch_size"]
+    signal_dtype = config.get("pre_process", {}).get("signal_dtype", "float32")
     steps.extend([
         # Create a tf.data.Dataset that contains all metadata, e.g. paths from utt2path and labels from utt2label etc.
-        Step("initialize", {"labels": labels, "init_data": init_data}),
+        Step("initialize", initialize_kwargs),
+    ])
+    filters_config = dict(config.get("pre_process", {}).get("filters", {}))
+    if "duration" in filters_config:
+        steps.extend([
+            # Drop utterances by their utt2dur durations before reading any audio files
+            Step("apply_filters", {"config": {"duration": filters_config.pop("duration")}}),
+        ])
+    steps.extend([
         # Load signals from all paths
-        Step("load_audio", {}),
+        Step("load_audio", {"dtype": signal_dtype}),
         # Drop empty signals
         Step("drop_empty", {}),
     ])
+    if "audio_shards" in config:
+        shards_config = dict(config["audio_shards"], directory=os.path.join(config["audio_shards"]["directory"], split), dtype=signal_dtype)
+        # Existing shards are packed again if the metadata or any config that affects the packed elements changes
+        shards_config["source_hash"] = audio_shards_source_hash(
+                init_data,
+                {"duration_filter": config.get("pre_process", {}).get("filters", {}).get("duration"),
+                 "signal_dtype": signal_dtype})
+        steps.extend([
+            # Pack all signals and metadata into large shard files on the first run, or read the existing shards on later runs
+            Step("write_audio_shards", shards_config),
+        ])
     if "pre_process" in config:
         # Pre-processing before feature extraction has been defined in the config file
-        if "filters" in config["pre_process"]:
+        if filters_config:
             # Drop unwanted signals
             steps.extend([
-                Step("apply_filters", {"config": config["pre_process"]["filters"]}),
+                Step("apply_filters", {"config": filters_config}),
             ])
         if "webrtcvad" in config["pre_process"]:
             # Voice activity detection
             steps.extend([
                 # Compute WebRTC VAD decisions
                 Step("compute_webrtc_vad", config["pre_process"]["webrtcvad"]),
-                Step("reduce_stats", {"statistic": "vad_ratio"}),
                 # Drop non-speech frames using computed decisions
                 Step("apply_vad", {}),
                 # Some signals might contain only non-speech frames
                 Step("drop_empty", {}),
             ])
+        if "energy_vad" in config["pre_process"]:
+            # Voice activity detection by comparing frame energies, computed completely in the TensorFlow graph
+            steps.extend([
+                Step("compute_energy_vad", config["pre_process"]["energy_vad"]),
+                Step("apply_vad", {}),
+                Step("drop_empty", {}),
+            ])
+        if "augment_by_rir" in config["pre_process"]:
+            # Create new signals by convolving existing signals with random room impulse responses
+            steps.extend([
+                Step("augment_by_rir", config["pre_process"]["augment_by_rir"]),
+            ])
         if "augment_by_additive_noise" in config["pre_process"]:
             # Create new signals by mixing in random noise signals with random SNR dB levels into existing signals
             steps.extend([
                 Step("augment_by_additive_noise", config["pre_process"]["augment_by_additive_noise"]),
             ])
+        if "augment_by_random_resampling" in config["pre_process"]:
+            # Speed perturbation, create new signals by resampling existing signals with random ratios
+            steps.extend([
+                Step("augment_by_random_resampling", config["pre_process"]["augment_by_random_resampling"]),
+            ])
         if "chunks" in config["pre_process"]:
             # Dividing signals into fixed length chunks
             steps.extend([
@@ -59,6 +119,8 @@ def create_dataset(split, labels, init_data, config):
         if config["features"]["type"] == "kaldi":
             # Pre-extracted Kaldi features will be used as input
             steps.extend([
+                # Read feature matrices from the ark files only when they are needed
+                Step("load_kaldi_features", {}),
                 # Use data under 'kaldi_ark' as 'input' and drop ark metadata
                 Step("remap_keys", {"new_keys": {"input": "kaldi_ark", "kaldi_ark": None, "kaldi_ark_key": None}}),
             ])
@@ -68,6 +130,8 @@ def create_dataset(split, labels, init_data, config):
                 # Apply feature extraction, uses GPU by default, change with 'device' key
                 Step("extract_features", {"config": config["features"]}),
             ])
+    if "global_cmvn" in config.get("post_process", {}) and "cache" not in config:
+        raise ValueError("post_process.global_cmvn requires the cache config, since the global CMVN statistics are accumulated when the cache is filled")
     if "post_process" in config:
         if "filters" in config["post_process"]:
             # Drop unwanted features
@@ -93,12 +157,38 @@ def create_dataset(split, labels, init_data, config):
         cache_config = {
                 "directory": os.path.join(cache_root, "features", split),
                 "cache_key": config["cache"].get("key"),
-                "batch_size": config["cache"]["batch_size"]}
+                "batch_size": config["cache"]["batch_size"],
+                "storage_dtype": config["cache"].get("storage_dtype", "float32")}
+        cmvn_config = config.get("post_process", {}).get("global_cmvn")
+        if cmvn_config is not None:
+            cmvn_filename = "global_cmvn.npz" if cache_config["cache_key"] is None else cache_config["cache_key"] + "_global_cmvn.npz"
         # Serialize all elements to disk and eagerly evaluate whole pipeline
         steps.extend([
             Step("cache", cache_config),
+        ])
+        if cmvn_config is not None:
+            steps.extend([
+                # Gather global mean and variance of all features while the pipeline is evaluated
+                Step("accumulate_global_cmvn", {"path": os.path.join(cache_config["directory"], cmvn_filename)}),
+            ])
+        steps.extend([
             Step("consume", {"log_interval": 10000}),
         ])
+        if cmvn_config is not None:
+            stats_split = cmvn_config.get("split", split)
+            stats_path = os.path.join(cache_root, "features", stats_split, cmvn_filename)
+            # Splits are created and consumed in the order they are listed in the datasets
+            if stats_split != split and not os.path.exists(stats_path):
+                raise ValueError(
+                        "Cannot normalize split '{}' with the global CMVN statistics of split '{}' since '{}' does not exist. "
+                        "The statistics are written when the cache of split '{}' is filled, make sure that split '{}' exists and is listed before split '{}' in the splits of the datasets.".format(
+                            split, stats_split, stats_path, stats_split, stats_split, split))
+            steps.extend([
+                # Normalize features with the statistics of this split or some other split that has been consumed before this split
+                Step("apply_global_cmvn", {
+                    "path": stats_path,
+                    "normalize_variance": cmvn_config.get("normalize_variance", True)}),
+            ])
         if "show_samples" in config:
             tensorboard_summary_dir = os.path.join(cache_root, "dataset_tensorboard", split)
             # Add some samples to TensorBoard for inspection
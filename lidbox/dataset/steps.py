@@ -1,19 +1,27 @@
 import collections
+import hashlib
 import io
+import json
 import logging
 import os
-# import random
+import random
 import time
 
 logger = logging.getLogger("dataset")
 
+import numpy as np
 import tensorflow as tf
 TF_VERSION_MAJOR, TF_VERSION_MINOR = tuple(int(x) for x in tf.version.VERSION.split(".")[:2])
 
 import lidbox
 import lidbox.dataset.tf_utils as tf_utils
+import lidbox.metadata
+import lidbox.numpy_features
 import lidbox.features as features
 import lidbox.features.audio as audio_features
+import lidbox.features.kaldi_ark as kaldi_ark
+import lidbox.vad
+import lidbox.wavfile
 
 
 if lidbox.DEBUG:
@@ -24,10 +32,17 @@ else:
 
 Step = collections.namedtuple("Step", ("key", "kwargs"))
 
+AUDIO_SHARDS_MANIFEST = "shards.json"
+
+# Statistics gathered by steps as a side effect of iterating over the dataset, logged when the dataset is consumed.
+# Contains functions that log the current values of the statistics, reset for every new pipeline in from_steps.
+_pipeline_stats = collections.OrderedDict()
+
 
 def from_steps(steps):
     logger.info("Initializing dataset from %d steps:\n  %s", len(steps), "\n  ".join(s.key for s in steps))
     ds = None
+    _pipeline_stats.clear()
     if steps[0].key != "initialize":
         logger.critical("When constructing a dataset, the first step must be 'initialize' but it was '%s'. The 'initialize' step is needed for first loading all metadata such as the utterance_id to wavpath mappings.", steps[0].key)
         return
@@ -59,12 +74,260 @@ def _feature_extraction_kwargs_to_args(config):
     ]
     return [config.get(arg, {}) for arg in valid_args]
 
+def _padded_batch_with_shapes(ds, batch_size, group_key_fn=None):
+    """
+    Like ds.padded_batch, but the original shape of every non-scalar value is stored under '_shape_<key>' so that the padding can be removed with _unbatch_and_trim.
+    If 'group_key_fn' is given, only elements with the same int64 key are batched together.
+    """
+    non_scalar_keys = [k for k, spec in ds.element_spec.items() if spec.shape.rank != 0]
+    def append_shapes(x):
+        return dict(x, **{"_shape_" + k: tf.shape(x[k]) for k in non_scalar_keys})
+    ds = ds.map(append_shapes, num_parallel_calls=TF_AUTOTUNE)
+    # TF 2.1 does not infer padded_shapes
+    padded_shapes = {k: spec.shape for k, spec in ds.element_spec.items()}
+    if group_key_fn is None:
+        return ds.padded_batch(batch_size, padded_shapes=padded_shapes)
+    return ds.apply(tf.data.experimental.group_by_window(
+        group_key_fn,
+        lambda key, group: group.padded_batch(batch_size, padded_shapes=padded_shapes),
+        window_size=batch_size))
+
+def _unbatch_and_trim(ds):
+    """
+    Unbatch a dataset batched with _padded_batch_with_shapes and slice all values with a stored shape back to that shape.
+    """
+    def trim(x):
+        shapes = {k[len("_shape_"):]: v for k, v in x.items() if k.startswith("_shape_")}
+        trimmed = {}
+        for k, v in x.items():
+            if k in shapes:
+                # Dimensions that were not padded keep their static sizes
+                trimmed[k] = tf.slice(v, tf.zeros_like(shapes[k]), shapes[k])
+                trimmed[k].set_shape(v.shape)
+            elif not k.startswith("_shape_"):
+                trimmed[k] = v
+        return trimmed
+    return ds.unbatch().map(trim, num_parallel_calls=TF_AUTOTUNE)
+
+def _drop_non_scalar_keys_except(key):
+    """
+    Dataset transformation that drops all non-scalar values except 'key' from every element.
+    """
+    def apply(ds):
+        dropped = [k for k, spec in ds.element_spec.items() if k != key and spec.shape.rank != 0]
+        if not dropped:
+            return ds
+        logger.info("Dropping non-scalar keys that cannot be chunked together with '%s':\n  %s", key, "\n  ".join(dropped))
+        return ds.map(lambda x: {k: v for k, v in x.items() if k not in dropped}, num_parallel_calls=TF_AUTOTUNE)
+    return apply
+
+def _flatten_chunks(x, key, chunks, id_str_padding):
+    """
+    Batch of elements with 'chunks' under 'key', all other values of x repeated for every chunk and chunk numbers appended to the utterance ids.
+    Use with unbatch to get one element for every chunk.
+    """
+    num_chunks = tf.shape(chunks)[0]
+    chunk_nums = tf.strings.as_string(tf.range(1, num_chunks + 1), width=id_str_padding, fill='0')
+    chunk_ids = tf.strings.join((tf.fill([num_chunks], x["id"]), chunk_nums), separator='-')
+    repeated_x = {k: tf.fill([num_chunks], v) for k, v in x.items() if k not in ("id", key)}
+    return dict(repeated_x, **{"id": chunk_ids, key: chunks})
+
+def _register_pipeline_stats(name, log_fn):
+    key = name
+    i = 1
+    while key in _pipeline_stats:
+        i += 1
+        key = "{}_{}".format(name, i)
+    _pipeline_stats[key] = log_fn
+
+def _log_pipeline_stats():
+    for key, log_fn in _pipeline_stats.items():
+        log_fn(key)
+
 def _element_shapes_dict(x):
     return {k: list(tf.shape(v).numpy()) for k, v in x.items()}
 
 def _pretty_dict(d):
     return "\n  ".join("{}: {}".format(k, p) for k, p in d.items())
 
+def _is_metadata_line(line):
+    # Same rules as in lidbox.iter_metadata_file: skip empty lines and comments
+    return tf.math.logical_and(
+            tf.strings.length(line) > 0,
+            tf.strings.substr(line, 0, 1) != "#")
+
+def _stream_metadata_files(meta, batch_size):
+    """
+    Create a dataset that streams the contents of all metadata files of one dataset in batches of size 'batch_size'.
+    All files are read line by line in parallel, which requires that every metadata file lists the utterance ids in exactly the same order (as Kaldi does by keeping all files sorted).
+    If there is a wav.scp file instead of utt2path, it is loaded into a lookup table and the path of every utterance is resolved from the file id of its utt2seg segment.
+    """
+    meta = dict(meta)
+    dataset_key = meta.pop("dataset")
+    kwargs = meta.pop("kwargs", {})
+    index_dir = meta.pop("index", None)
+    if index_dir is not None:
+        return _stream_metadata_index(index_dir, dataset_key, kwargs, batch_size)
+    file_path = meta.pop(lidbox.metadata.FILE_PATH_KEY, None)
+    meta_keys = sorted(meta.keys())
+    if file_path is None:
+        id_key = "path"
+    else:
+        id_key = "segment"
+        file_ids, paths = zip(*lidbox.iter_metadata_file(file_path, 2))
+        file2path = tf.lookup.StaticHashTable(
+                tf.lookup.KeyValueTensorInitializer(tf.constant(file_ids), tf.constant(paths)),
+                default_value='')
+    file_limit = kwargs.get("file_limit")
+    def read_lines(path):
+        lines = (tf.data.TextLineDataset(path)
+                   .map(tf.strings.strip)
+                   .filter(_is_metadata_line))
+        if file_limit is not None:
+            lines = lines.take(file_limit)
+        return lines.batch(batch_size)
+    def lines_to_columns(*lines):
+        # 'utt2path', or 'utt2seg' if paths are resolved from segments, is always present, use it to define the utterance ids
+        utt_ids = tf.strings.regex_replace(lines[meta_keys.index(id_key)], " .*$", "")
+        columns = {"id": utt_ids, "dataset": tf.fill(tf.shape(utt_ids), dataset_key)}
+        for key, key_lines in zip(meta_keys, lines):
+            tf.debugging.assert_equal(
+                    tf.strings.regex_replace(key_lines, " .*$", ""),
+                    utt_ids,
+                    message="Utterance ids in the metadata files are not in the same order, cannot stream metadata without loading it into memory")
+            if lidbox.metadata.NUM_COLUMNS.get(key, 2) > 2:
+                columns[key] = tf.strings.regex_replace(key_lines, "^[^ ]* ?", "")
+            else:
+                columns[key] = tf.strings.regex_replace(key_lines, "^[^ ]* ?([^ ]*).*$", "\\1")
+        if file_path is not None:
+            columns["path"] = file2path.lookup(tf.strings.regex_replace(columns["segment"], " .*$", ""))
+            tf.debugging.assert_greater(
+                    tf.strings.length(columns["path"]),
+                    0,
+                    message="File ids of some segments in utt2seg were not found from wav.scp")
+        return columns
+    ds = (tf.data.Dataset
+            .zip(tuple(read_lines(meta[key]) for key in meta_keys))
+            .map(lines_to_columns, num_parallel_calls=TF_AUTOTUNE)
+            .unbatch())
+    if kwargs.get("shuffle_files", False):
+        logger.warning("'shuffle_files' given for dataset '%s' but metadata is streamed from files, shuffling utterances only approximately with a buffer of size %d", dataset_key, batch_size)
+        ds = ds.shuffle(batch_size)
+    return ds
+
+def _stream_metadata_index(index_dir, dataset_key, kwargs, batch_size):
+    """
+    Create a dataset that reads rows from a compiled metadata index (see lidbox.metadata) in batches of size 'batch_size'.
+    Only the row order is kept in memory, all metadata columns are read from memory-mapped files.
+    """
+    index = lidbox.metadata.MetadataIndex(index_dir)
+    columns = index.columns
+    rows = index.row_order(
+            shuffle=kwargs.get("shuffle_files", False),
+            limit=kwargs.get("file_limit"),
+            seed=random.getrandbits(32))
+    logger.info("Reading %d rows from metadata index '%s' with columns %s", rows.size, index_dir, ', '.join(columns))
+    def get_rows(begin, end):
+        batch_rows = rows[begin:end]
+        return [index.get_bytes(key, batch_rows) for key in columns]
+    def read_batch(begin):
+        end = tf.math.minimum(begin + batch_size, rows.size)
+        values = tf.numpy_function(get_rows, [begin, end], len(columns) * [tf.string])
+        batch = {key: tf.reshape(v, [end - begin]) for key, v in zip(columns, values)}
+        batch["dataset"] = tf.fill([end - begin], dataset_key)
+        return batch
+    return (tf.data.Dataset
+              .range(0, rows.size, batch_size)
+              .map(read_batch, num_parallel_calls=TF_AUTOTUNE)
+              .unbatch())
+
+def _load_signal_bank(type2paths, max_size_bytes, dtype, name="noise"):
+    """
+    Read all signals listed in 'type2paths' into one array of dtype 'dtype' in memory, if it takes at most 'max_size_bytes' bytes.
+    Returns None if the signals do not fit, else the concatenated samples of all signals and the begin offset, length and sample rate of every signal, ordered by type, and a dict of type to the range of indexes of its signals.
+    'name' is used only for logging.
+    """
+    sample_size = np.dtype(dtype).itemsize
+    all_paths = [p for paths in type2paths.values() for p in paths]
+    total_size = sample_size * sum(int(round(info[0] * info[2])) for info in lidbox.wavfile.scan_files(all_paths) if info is not None)
+    if total_size > max_size_bytes:
+        logger.warning("All %d %s signals take %.1f MiB, which is more than the %s bank size limit %.1f MiB.", len(all_paths), name, total_size / 2**20, name, max_size_bytes / 2**20)
+        return None
+    logger.info("Reading all %d %s signals into a %s bank of %.1f MiB.", len(all_paths), name, name, total_size / 2**20)
+    signals, lengths, sample_rates = [], [], []
+    type2range = {}
+    for signal_type, paths in type2paths.items():
+        begin = len(signals)
+        for path in paths:
+            try:
+                signal, sample_rate = lidbox.wavfile.read_mono_pcm16(path)
+            except (OSError, lidbox.wavfile.WavHeaderError) as err:
+                logger.warning("Skipping %s signal '%s' that could not be read: %s", name, path, err)
+                continue
+            if signal.size == 0:
+                continue
+            if dtype == "float32":
+                # Same scaling as tf.audio.decode_wav
+                signal = signal.astype(np.float32) / 32768.0
+            signals.append(signal)
+            lengths.append(signal.size)
+            sample_rates.append(sample_rate)
+        type2range[signal_type] = (begin, len(signals))
+    lengths = np.array(lengths, np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    samples = np.concatenate(signals) if signals else np.zeros([0], dtype)
+    return samples, offsets, lengths, np.array(sample_rates, np.int32), type2range
+
+def _random_noise_crop_indexes(noise_begin, noise_length, signal_length):
+    """
+    Indexes of a random segment of length 'signal_length' from a noise signal that begins at index 'noise_begin' and has length 'noise_length'.
+    The segment wraps around to the beginning of the noise signal only if the noise signal is shorter than 'signal_length'.
+    If 'noise_begin' and 'noise_length' are vectors, returns a matrix of indexes with one segment from each noise signal on every row.
+    """
+    noise_begin = tf.expand_dims(tf.cast(noise_begin, tf.int64), -1)
+    noise_length = tf.expand_dims(tf.cast(noise_length, tf.int64), -1)
+    signal_length = tf.cast(signal_length, tf.int64)
+    max_start = tf.where(noise_length >= signal_length, noise_length - signal_length + 1, noise_length)
+    # Integer tf.random.uniform supports only scalar bounds
+    start = tf.cast(tf.random.uniform(tf.shape(max_start), 0, 1, tf.float64) * tf.cast(max_start, tf.float64), tf.int64)
+    start = tf.math.minimum(start, max_start - 1)
+    return noise_begin + (start + tf.range(signal_length)) % noise_length
+
+
+def accumulate_global_cmvn(ds, path, key="input"):
+    """
+    Accumulate the amount of frames and the per-channel sums and sums of squares of all feature matrices under 'key' while ds is iterated.
+    When the dataset is consumed, the global mean and standard deviation of each channel are written as an npz file to 'path', from where they can be applied with apply_global_cmvn.
+    """
+    num_channels = ds.element_spec[key].shape[-1]
+    if num_channels is None:
+        logger.critical("Cannot accumulate global CMVN statistics for key '%s' since the amount of channels is unknown, element spec is %s.", key, ds.element_spec[key])
+        return
+    logger.info("Accumulating global mean and variance statistics of '%s' with %d channels, to be written into '%s' when the dataset is consumed.", key, num_channels, path)
+    num_frames = tf.Variable(0, dtype=tf.int64, trainable=False)
+    sums = tf.Variable(tf.zeros([num_channels], tf.float64), trainable=False)
+    square_sums = tf.Variable(tf.zeros([num_channels], tf.float64), trainable=False)
+    def write_stats(stats_key):
+        n = int(num_frames.numpy())
+        if n == 0:
+            logger.warning("Statistics '%s': no frames were accumulated, not writing global CMVN statistics to '%s'.", stats_key, path)
+            return
+        mean = sums.numpy() / n
+        std = np.sqrt(np.maximum(0, square_sums.numpy() / n - mean**2))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, num_frames=n, mean=mean.astype(np.float32), std=std.astype(np.float32))
+        logger.info("Statistics '%s', global CMVN of '%s' over %d frames written to '%s'.", stats_key, key, n, path)
+    _register_pipeline_stats("global_cmvn", write_stats)
+    def update_stats(x):
+        X = tf.reshape(tf.cast(x[key], tf.float64), [-1, num_channels])
+        with tf.control_dependencies([
+                num_frames.assign_add(tf.shape(X, out_type=tf.int64)[0]),
+                sums.assign_add(tf.math.reduce_sum(X, axis=0)),
+                square_sums.assign_add(tf.math.reduce_sum(tf.math.square(X), axis=0))]):
+            return dict(x, **{key: tf.identity(x[key])})
+    return ds.map(update_stats, num_parallel_calls=TF_AUTOTUNE)
+
 
 def append_predictions(ds, predictions):
     """
@@ -97,6 +360,17 @@ def apply_filters(ds, config):
         fn = (lambda x, k=key, v=min_signal_length_sec:
                 k not in x or tf.size(x[k]) >= tf.cast(tf.cast(x["sample_rate"], tf.float32) * v, tf.int32))
         filters.append((fn, "min_signal_length_sec"))
+    if "duration" in config:
+        # Durations from utt2dur files, e.g. written by the 'lidbox stats' command, allow filtering before any audio is read
+        # Zero durations are always dropped, 'lidbox stats' writes them for unreadable files
+        key = "duration"
+        min_sec = tf.constant(config["duration"].get("min_sec", 0), tf.float32)
+        max_sec = tf.constant(config["duration"].get("max_sec", float("inf")), tf.float32)
+        fn = (lambda x, k=key, lo=min_sec, hi=max_sec:
+                k not in x or (0 < tf.strings.to_number(x[k], tf.float32)
+                               and lo <= tf.strings.to_number(x[k], tf.float32)
+                               and tf.strings.to_number(x[k], tf.float32) <= hi))
+        filters.append((fn, "duration"))
     if "min_shape" in config:
         key = config["min_shape"]["key"]
         min_shape = tf.constant(config["min_shape"]["shape"])
@@ -117,17 +391,56 @@ def apply_filters(ds, config):
     return ds.filter(all_ok)
 
 
+def apply_global_cmvn(ds, path, key="input", normalize_variance=True):
+    """
+    Normalize all feature matrices under 'key' with the global per-channel mean and standard deviation loaded from the npz file 'path', written by accumulate_global_cmvn.
+    """
+    if not os.path.exists(path):
+        logger.critical("Cannot apply global CMVN since the statistics file '%s' does not exist. The statistics are written by the 'accumulate_global_cmvn' step when its dataset is consumed.", path)
+        return
+    with np.load(path) as stats:
+        num_frames = int(stats["num_frames"])
+        mean = tf.constant(stats["mean"])
+        std = tf.constant(stats["std"])
+    logger.info("Applying global CMVN on '%s' with statistics of %d frames from '%s', normalize_variance is %s.", key, num_frames, path, normalize_variance)
+    def _normalize(x):
+        X = x[key] - mean
+        if normalize_variance:
+            X = tf.math.divide_no_nan(X, std)
+        return dict(x, **{key: X})
+    return ds.map(_normalize, num_parallel_calls=TF_AUTOTUNE)
+
+
 def apply_vad(ds):
     """
     Assuming each element of ds have voice activity detection decisions, use the decisions to drop non-speech frames.
     """
     logger.info("Using previously computed voice activity decisions to drop signal frames marked as non-speech.")
     drop_keys_after_done = {"vad_frame_length_ms", "vad_is_speech"}
+    # Frame statistics are updated while the signals are filtered and logged when the dataset is consumed
+    num_kept = tf.Variable(0, dtype=tf.int64, trainable=False)
+    num_dropped = tf.Variable(0, dtype=tf.int64, trainable=False)
+    frame_length_ms = tf.Variable(0, dtype=tf.int32, trainable=False)
+    def log_vad_stats(key):
+        kept, dropped = int(num_kept.numpy()), int(num_dropped.numpy())
+        if kept + dropped == 0:
+            logger.info("Statistics '%s': no VAD decisions were applied, e.g. because all elements were loaded from a cache.", key)
+            return
+        logger.info(
+                "Statistics '%s', VAD frames:\n  frame length %d ms\n  kept %d\n  dropped %d\n  total %d\n  kept ratio %.3f",
+                key, int(frame_length_ms.numpy()), kept, dropped, kept + dropped, kept / (kept + dropped))
+    _register_pipeline_stats("vad_ratio", log_vad_stats)
     def filter_signals_by_vad_decisions(x):
         vad_frame_length_sec = 1e-3 * tf.cast(x["vad_frame_length_ms"], tf.float32)
         vad_frame_length = tf.cast(tf.cast(x["sample_rate"], tf.float32) * vad_frame_length_sec, tf.int32)
         frames = tf.signal.frame(x["signal"], vad_frame_length, vad_frame_length, axis=0)
-        voiced_signal = tf.reshape(frames[x["vad_is_speech"]], [-1])
+        is_speech = tf.cast(x["vad_is_speech"], tf.int64)
+        num_speech = tf.math.reduce_sum(is_speech)
+        with tf.control_dependencies([
+                num_kept.assign_add(num_speech),
+                num_dropped.assign_add(tf.size(is_speech, out_type=tf.int64) - num_speech),
+                frame_length_ms.assign(tf.cast(x["vad_frame_length_ms"], tf.int32))]):
+            voiced_signal = tf.reshape(frames[x["vad_is_speech"]], [-1])
         return {k: v for k, v in dict(x, signal=voiced_signal).items() if k not in drop_keys_after_done}
     return ds.map(filter_signals_by_vad_decisions, num_parallel_calls=TF_AUTOTUNE)
 
@@ -142,7 +455,7 @@ def as_supervised(ds):
     return ds.map(_as_supervised, num_parallel_calls=TF_AUTOTUNE)
 
 
-def augment_by_additive_noise(ds, noise_source_dir, snr_list):
+def augment_by_additive_noise(ds, noise_source_dir, snr_list, noise_dtype="int16", max_noise_bank_mb=2048, batch_size=32):
     """
     Read all noise signals from $noise_source_dir/id2path and create new signals by mixing noise to each element of ds.
     'snr_list' defines the noise labels, which is determined by $noise_source_dir/id2label, and the SNR dB range from which the noise level in the resulting signal will be chosen randomly.
@@ -153,105 +466,381 @@ def augment_by_additive_noise(ds, noise_source_dir, snr_list):
             ("speech", 15, 20),
             ("music", 10, 20)
         ]
+    All noise signals are read once into an in-memory noise bank of dtype 'noise_dtype' (int16 or float32), if it fits into 'max_noise_bank_mb' mebibytes.
+    Otherwise, a random noise signal is read from disk for every noise type and every element.
+    The noise added to each signal is a random segment of the noise signal with the same length as the signal, noise signals shorter than the signal are repeated.
+    Signals are zero padded into batches of size 'batch_size' by sample rate and noise is mixed into all signals of a batch at once, the padding is excluded from the RMS levels used for mixing.
+    The augmented copies of each element follow each other in the output, in the order of 'snr_list'.
     """
     logger.info("Augmenting dataset with additive noise from '%s'.", noise_source_dir)
     id2type = dict(lidbox.iter_metadata_file(os.path.join(noise_source_dir, "id2label"), 2))
-    type2paths = collections.defaultdict(list)
+    noise_types = set(noise_type for noise_type, _, _ in snr_list)
+    type2paths = collections.OrderedDict((t, []) for t, _, _ in snr_list)
     for noise_id, path in lidbox.iter_metadata_file(os.path.join(noise_source_dir, "id2path"), 2):
-        type2paths[id2type[noise_id]].append(path)
+        if id2type[noise_id] in noise_types:
+            type2paths[id2type[noise_id]].append(path)
     del id2type
-    type2paths = {t: tf.constant(paths, tf.string) for t, paths in type2paths.items()}
-    def update_element_meta(new_id, mixed_signal, x):
-        return dict(x, id=new_id, signal=mixed_signal)
-    def add_random_noise_and_flatten(x):
-        # Random noise path indexes and random snr levels
-        rand_noise = [
-                (noise_type,
-                 tf.random.uniform([], 0, tf.size(type2paths[noise_type]), tf.int64),
-                 tf.random.uniform([], snr_low, snr_high, tf.float32))
-                for noise_type, snr_low, snr_high in snr_list]
-        # Load random noise signals with drawn indexes
-        rand_noise = [
-                (audio_features.read_wav(type2paths[noise_type][rand_index]), snr)
-                for noise_type, rand_index, snr in rand_noise]
-        # Assert sample rates
-        # TODO maybe add inline resampling
-        for (noise, sample_rate), snr in rand_noise:
-            tf.debugging.assert_equal(sample_rate, x["sample_rate"], message="Invalid noise signals are being used, all noise signals must have same sample rate as speech signals that are being augmented")
-        # Fix noise signal length to match x["signal"] by repeating the noise signal if it is too short
-        rand_noise = [
-                (tf.cast(tf.size(x["signal"]) / tf.size(noise), tf.int32), noise, snr)
-                for (noise, _), snr in rand_noise]
-        rand_noise = [
-                (tf.tile(noise, [1 + noise_length_ratio])[:tf.size(noise)], snr)
-                for noise_length_ratio, noise, snr in rand_noise]
-        mixed_signals = [audio_features.snr_mixer(x["signal"], noise, snr)[2] for noise, snr in rand_noise]
-        new_ids = [
-                tf.strings.join((x["id"], noise_type, tf.strings.as_string(snr, precision=2)), separator="-")
-                for noise_type, snr in rand_noise]
-        signal_ds = tf.data.Dataset.from_tensor_slices(mixed_signals)
-        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(len(mixed_signals))
-        return (tf.data.Dataset
-                  .from_tensor_slices((new_ids, mixed_signals, len(mixed_signals) * [x]))
-                  .map(update_element_meta))
-    return ds.interleave(add_random_noise_and_flatten, num_parallel_calls=TF_AUTOTUNE)
-
-
-
-def augment_by_random_resampling(ds, range):
-    pass
-
-
-def cache(ds, directory=None, batch_size=1, cache_key=None):
+    for noise_type, paths in type2paths.items():
+        if not paths:
+            logger.critical("No noise signals of type '%s' found from '%s'.", noise_type, noise_source_dir)
+            return
+    noise_bank = _load_signal_bank(type2paths, max_noise_bank_mb * 2**20, noise_dtype)
+    if noise_bank is not None:
+        samples, offsets, lengths, sample_rates, type2range = noise_bank
+        # Variables are not embedded into the graph as constants would be, which would be a problem with large noise banks
+        with tf.device("/CPU:0"):
+            noise_samples = tf.Variable(samples, trainable=False)
+        noise_offsets = tf.constant(offsets, tf.int64)
+        noise_lengths = tf.constant(lengths, tf.int64)
+        noise_sample_rates = tf.constant(sample_rates, tf.int32)
+        del samples
+        for noise_type, (begin, end) in type2range.items():
+            if begin == end:
+                logger.critical("None of the noise signals of type '%s' could be read.", noise_type)
+                return
+        def random_noise(noise_type, batch_size, signal_length):
+            begin, end = type2range[noise_type]
+            index = tf.random.uniform([batch_size], begin, end, tf.int64)
+            indexes = _random_noise_crop_indexes(tf.gather(noise_offsets, index), tf.gather(noise_lengths, index), signal_length)
+            return tf.gather(noise_samples, indexes), tf.gather(noise_sample_rates, index)
+    else:
+        logger.info("Noise signals will be read from disk for every element.")
+        type2paths = {t: tf.constant(paths, tf.string) for t, paths in type2paths.items()}
+        # The 'dtype' kwarg of tf.map_fn is deprecated since TF 2.3
+        if TF_VERSION_MAJOR == 2 and TF_VERSION_MINOR < 3:
+            map_fn_kwargs = {"dtype": (tf.float32, tf.int32)}
+        else:
+            map_fn_kwargs = {"fn_output_signature": (tf.float32, tf.int32)}
+        def random_noise(noise_type, batch_size, signal_length):
+            paths = type2paths[noise_type]
+            def read_random_noise(_):
+                noise, sample_rate = audio_features.read_wav(paths[tf.random.uniform([], 0, tf.size(paths, out_type=tf.int64), tf.int64)])
+                return tf.gather(noise, _random_noise_crop_indexes(0, tf.size(noise), signal_length)), sample_rate
+            return tf.map_fn(read_random_noise, tf.range(batch_size), **map_fn_kwargs)
+    num_noise_types = len(snr_list)
+    def add_random_noise(x):
+        # Zero padded batch of signals
+        # Noise is mixed in floating point, 16-bit PCM signals are converted back after mixing
+        signals = audio_features.signal_as_float32(x["signal"])
+        signal_lengths = x["_shape_signal"][:,0]
+        batch_size = tf.shape(signals)[0]
+        mixed_signals, new_ids = [], []
+        for noise_type, snr_low, snr_high in snr_list:
+            # Random noise segments of the same length as the padded signals and random snr levels
+            noise, sample_rates = random_noise(noise_type, batch_size, tf.shape(signals)[1])
+            # TODO maybe add inline resampling
+            tf.debugging.assert_equal(sample_rates, x["sample_rate"], message="Invalid noise signals are being used, all noise signals must have same sample rate as speech signals that are being augmented")
+            snr = tf.random.uniform([batch_size], snr_low, snr_high, tf.float32)
+            mixed_signals.append(audio_features.snr_mixer(signals, audio_features.signal_as_float32(noise), snr, lengths=signal_lengths)[2])
+            new_ids.append(tf.strings.join((x["id"], noise_type, tf.strings.as_string(snr, precision=2)), separator="-"))
+        # Interleave the augmented copies such that all copies of one element follow each other
+        mixed_signals = tf.reshape(tf.stack(mixed_signals, axis=1), [-1, tf.shape(signals)[1]])
+        if x["signal"].dtype == tf.int16:
+            mixed_signals = audio_features.float32_to_int16(mixed_signals)
+        new_ids = tf.reshape(tf.stack(new_ids, axis=1), [-1])
+        # Repeat only the metadata, the clean signals are not needed anymore
+        repeated_x = {k: tf.repeat(v, num_noise_types, axis=0) for k, v in x.items() if k not in ("id", "signal")}
+        return dict(repeated_x, id=new_ids, signal=mixed_signals)
+    def get_sample_rate(x):
+        return tf.cast(x["sample_rate"], tf.int64)
+    ds = _padded_batch_with_shapes(ds, batch_size, group_key_fn=get_sample_rate)
+    return _unbatch_and_trim(ds.map(add_random_noise, num_parallel_calls=TF_AUTOTUNE))
+
+
+def augment_by_rir(ds, rir_source_dir, rir_types=None, batch_size=1, max_rir_bank_mb=1024):
+    """
+    Reverberation by convolving signals with room impulse responses.
+    Read all room impulse responses (RIR) from $rir_source_dir/id2path into an in-memory bank and for every element of ds, create a new element with a signal that has been convolved with a random RIR, and append it after the original element.
+    If 'rir_types' is given, only RIRs that have one of the given labels in $rir_source_dir/id2label are used.
+    Every RIR is aligned to start from its highest peak, i.e. the direct path, and the reverberated signal is scaled to have the same energy as the original signal.
+    Signals are zero padded into batches of size 'batch_size' and convolved with FFTs inside the TensorFlow graph.
+    """
+    logger.info("Augmenting dataset by reverberation with room impulse responses from '%s'.", rir_source_dir)
+    type2paths = collections.OrderedDict()
+    if rir_types is None:
+        type2paths["rir"] = [path for _, path in lidbox.iter_metadata_file(os.path.join(rir_source_dir, "id2path"), 2)]
+    else:
+        id2type = dict(lidbox.iter_metadata_file(os.path.join(rir_source_dir, "id2label"), 2))
+        type2paths = collections.OrderedDict((t, []) for t in rir_types)
+        for rir_id, path in lidbox.iter_metadata_file(os.path.join(rir_source_dir, "id2path"), 2):
+            if id2type[rir_id] in type2paths:
+                type2paths[id2type[rir_id]].append(path)
+        del id2type
+    rir_bank = _load_signal_bank(type2paths, max_rir_bank_mb * 2**20, "float32", name="RIR")
+    if rir_bank is None:
+        logger.critical("Room impulse responses do not fit into memory, increase 'max_rir_bank_mb' or use less RIRs.")
+        return
+    samples, offsets, lengths, sample_rates, _ = rir_bank
+    if lengths.size == 0:
+        logger.critical("No room impulse responses found from '%s'.", rir_source_dir)
+        return
+    # Drop samples before the direct path and normalize to unit energy
+    rirs = []
+    for offset, length in zip(offsets, lengths):
+        rir = samples[offset:offset+length]
+        rir = rir[np.argmax(np.abs(rir)):]
+        rirs.append(rir / max(1e-10, np.linalg.norm(rir)))
+    lengths = np.array([rir.size for rir in rirs], np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    logger.info("Loaded %d room impulse responses, longest is %d samples.", lengths.size, lengths.max())
+    with tf.device("/CPU:0"):
+        rir_samples = tf.Variable(np.concatenate(rirs).astype(np.float32), trainable=False)
+    del samples, rirs
+    num_rirs = lengths.size
+    rir_offsets = tf.constant(offsets, tf.int64)
+    rir_lengths = tf.constant(lengths, tf.int64)
+    rir_sample_rates = tf.constant(sample_rates, tf.int32)
+    def append_reverberated_signals(x):
+        # Zero padded batch of signals
+        signals = audio_features.signal_as_float32(x["signal"])
+        signal_lengths = x["_shape_signal"][:,0]
+        index = tf.random.uniform([tf.shape(signals)[0]], 0, num_rirs, tf.int64)
+        tf.debugging.assert_equal(tf.gather(rir_sample_rates, index), x["sample_rate"], message="Invalid room impulse responses are being used, all RIRs must have same sample rate as speech signals that are being augmented")
+        # Gather a zero padded batch of RIRs
+        batch_rir_lengths = tf.gather(rir_lengths, index)
+        positions = tf.range(tf.math.reduce_max(batch_rir_lengths))
+        is_valid = tf.expand_dims(positions, 0) < tf.expand_dims(batch_rir_lengths, 1)
+        rir_indexes = tf.expand_dims(tf.gather(rir_offsets, index), 1) + tf.where(is_valid, tf.expand_dims(positions, 0), 0)
+        batch_rirs = tf.where(is_valid, tf.gather(rir_samples, rir_indexes), 0.0)
+        reverberated = audio_features.fft_convolve(signals, batch_rirs)
+        # Drop the reverberation tail that was computed into the padding and scale to the energy of the original signal
+        reverberated *= tf.sequence_mask(signal_lengths, tf.shape(signals)[1], tf.float32)
+        scale = tf.math.sqrt(tf.math.divide_no_nan(
+            tf.math.reduce_sum(tf.math.square(signals), axis=1),
+            tf.math.reduce_sum(tf.math.square(reverberated), axis=1)))
+        reverberated *= tf.expand_dims(scale, 1)
+        if x["signal"].dtype == tf.int16:
+            reverberated = audio_features.float32_to_int16(reverberated)
+        # Original signals followed by their reverberated copies
+        new_signals = tf.reshape(tf.stack((x["signal"], reverberated), axis=1), [-1, tf.shape(signals)[1]])
+        new_ids = tf.reshape(tf.stack((x["id"], tf.strings.join((x["id"], "-reverb"))), axis=1), [-1])
+        repeated_x = {k: tf.repeat(v, 2, axis=0) for k, v in x.items() if k not in ("id", "signal")}
+        return dict(repeated_x, id=new_ids, signal=new_signals)
+    ds = _padded_batch_with_shapes(ds, batch_size)
+    return _unbatch_and_trim(ds.map(append_reverberated_signals, num_parallel_calls=TF_AUTOTUNE))
+
+
+def augment_by_random_resampling(ds, range, num_ratios=5, zero_crossings=16, batch_size=32):
+    """
+    Speed perturbation by resampling.
+    For every element of ds, create a new element with a signal that has been resampled with a random ratio from 'num_ratios' evenly spaced ratios within 'range' = (low, high), and append it after the original element.
+    The sample rate does not change, i.e. a ratio of 1.1 makes the signal 1.1 times shorter and faster.
+    The polyphase interpolation filters of all ratios are precomputed and the resampling is done completely inside the TensorFlow graph.
+    Elements are grouped by their random ratio and zero padded into batches of size 'batch_size', which are resampled with one strided convolution.
+    Therefore, the output order of the elements is not the input order.
+    """
+    low, high = range
+    ratios = np.linspace(low, high, num_ratios)
+    logger.info("Augmenting dataset by speed perturbation, resampling every signal with a random ratio from:\n  %s", ', '.join("{:.3f}".format(r) for r in ratios))
+    resamplers = [audio_features.polyphase_resampling_filters(r, zero_crossings) for r in ratios]
+    for r, (filters, down, up, half_width) in zip(ratios, resamplers):
+        logger.info("Ratio %.3f approximated as %d/%d, %d filter phases of %d taps", r, down, up, filters.shape[0], filters.shape[1])
+    ratio_suffixes = tf.constant(["-speed{:.3f}".format(r) for r in ratios], tf.string)
+    downs = tf.constant([down for _, down, _, _ in resamplers], tf.int32)
+    ups = tf.constant([up for _, _, up, _ in resamplers], tf.int32)
+    def make_resampler(filters, down, up, half_width):
+        kernel = tf.constant(audio_features.polyphase_conv_filters(filters, down, up), tf.float32)
+        return lambda signals: audio_features.polyphase_resample(signals, kernel, down, up, half_width)
+    branches = [make_resampler(*resampler) for resampler in resamplers]
+    def draw_ratio(x):
+        return dict(x, _ratio_index=tf.random.uniform([], 0, len(branches), tf.int32))
+    def get_ratio_index(x):
+        return tf.cast(x["_ratio_index"], tf.int64)
+    def append_resampled_signals(x):
+        # Zero padded batch of signals, all resampled with the same ratio
+        ratio_index = x["_ratio_index"][0]
+        signals = audio_features.signal_as_float32(x["signal"])
+        resampled = tf.switch_case(ratio_index, [lambda f=f: f(signals) for f in branches])
+        if x["signal"].dtype == tf.int16:
+            resampled = audio_features.float32_to_int16(resampled)
+        signal_lengths = x["_shape_signal"][:,0]
+        resampled_lengths = signal_lengths * ups[ratio_index] // downs[ratio_index]
+        # Original signals followed by their resampled copies, padded to the same length
+        max_length = tf.math.maximum(tf.shape(signals)[1], tf.shape(resampled)[1])
+        pad = lambda s: tf.pad(s, [[0, 0], [0, max_length - tf.shape(s)[1]]])
+        new_signals = tf.reshape(tf.stack((pad(x["signal"]), pad(resampled)), axis=1), [-1, max_length])
+        new_lengths = tf.reshape(tf.stack((signal_lengths, resampled_lengths), axis=1), [-1, 1])
+        new_ids = tf.reshape(tf.stack((x["id"], tf.strings.join((x["id"], tf.fill(tf.shape(x["id"]), ratio_suffixes[ratio_index])))), axis=1), [-1])
+        repeated_x = {k: tf.repeat(v, 2, axis=0) for k, v in x.items() if k not in ("id", "signal", "_shape_signal", "_ratio_index")}
+        out = dict(repeated_x, id=new_ids, signal=new_signals, _shape_signal=new_lengths)
+        if "duration" in x:
+            durations = tf.cast(new_lengths[:,0], tf.float32) / tf.cast(out["sample_rate"], tf.float32)
+            is_resampled = tf.tile([False, True], tf.shape(signal_lengths))
+            out["duration"] = tf.where(is_resampled, tf.strings.as_string(durations), out["duration"])
+        return out
+    ds = _padded_batch_with_shapes(ds.map(draw_ratio, num_parallel_calls=TF_AUTOTUNE), batch_size, group_key_fn=get_ratio_index)
+    return _unbatch_and_trim(ds.map(append_resampled_signals, num_parallel_calls=TF_AUTOTUNE))
+
+
+def augment_by_spec_augment(ds, max_time_mask_len=0, num_time_masks=0, max_frequency_mask_len=0, num_frequency_masks=0, max_time_warp=0, batch_size=32, key="input"):
+    """
+    SpecAugment time warping and time and frequency masking of features under 'key' in every element of ds.
+    Augmentation is applied in-place, not by appending new elements, and new random augmentations are drawn every time ds is iterated.
+    This allows applying fresh augmentations after a cached features dataset, e.g. on every training epoch.
+    Features are zero padded into batches of size 'batch_size' and augmented with batched tensor operations.
+    See lidbox.features.random_time_warp and lidbox.features.random_time_frequency_masks.
+    """
+    logger.info(
+            "Augmenting '%s' by SpecAugment: time warp of at most %d frames, %d time masks of at most %d frames, %d frequency masks of at most %d channels.",
+            key, max_time_warp, num_time_masks, max_time_mask_len, num_frequency_masks, max_frequency_mask_len)
+    def augment(x):
+        X = x[key]
+        lengths = x["_shape_" + key][:,0]
+        if max_time_warp > 0:
+            X = features.random_time_warp(X, max_time_warp, lengths=lengths)
+        X = features.random_time_frequency_masks(
+                X,
+                lengths=lengths,
+                max_time_mask_len=max_time_mask_len,
+                num_time_masks=num_time_masks,
+                max_frequency_mask_len=max_frequency_mask_len,
+                num_frequency_masks=num_frequency_masks)
+        return dict(x, **{key: X})
+    ds = _padded_batch_with_shapes(ds, batch_size)
+    return _unbatch_and_trim(ds.map(augment, num_parallel_calls=TF_AUTOTUNE))
+
+
+def cache(ds, directory=None, batch_size=1, cache_key=None, storage_dtype="float32", storage_keys=("input",)):
     """
     Cache all elements of ds to disk or memory.
+    Float32 values under 'storage_keys' can be stored with a reduced precision 'storage_dtype', which is one of:
+        float32: no conversion.
+        float16: values are stored as half precision floats.
+        uint8: values of each element are quantized linearly to 256 levels between the minimum and maximum value of the element, see lidbox.dataset.tf_utils.quantize_uint8.
+    The values are converted back to float32 when elements are read from the cache.
+    If 'storage_dtype' is not float32, it is appended to 'cache_key' to prevent reading caches that were written with a different dtype.
     """
+    if storage_dtype not in ("float32", "float16", "uint8"):
+        raise ValueError("Unsupported cache storage dtype '{}'".format(storage_dtype))
+    storage_keys = [k for k in storage_keys if k in ds.element_spec and ds.element_spec[k].dtype == tf.float32]
+    if storage_dtype == "float32" or not storage_keys:
+        storage_keys = []
+    else:
+        logger.info("Storing values of keys %s in the cache as %s.", ', '.join(storage_keys), storage_dtype)
+    def encode(x):
+        x = dict(x)
+        for k in storage_keys:
+            if storage_dtype == "float16":
+                x[k] = tf.cast(x[k], tf.float16)
+            else:
+                x[k], x["_storage_scale_" + k], x["_storage_offset_" + k] = tf_utils.quantize_uint8(x[k])
+        return x
+    def decode(x):
+        x = dict(x)
+        for k in storage_keys:
+            if storage_dtype == "float16":
+                x[k] = tf.cast(x[k], tf.float32)
+            else:
+                x[k] = tf_utils.dequantize_uint8(x[k], x.pop("_storage_scale_" + k), x.pop("_storage_offset_" + k))
+        return x
     if directory is None:
         logger.warning("Caching dataset in batches of size %d into memory.", batch_size)
         cache_file = ''
     else:
         if cache_key is None:
             cache_key = str(int(time.time()))
+        if storage_dtype != "float32":
+            cache_key += "_" + storage_dtype
         os.makedirs(directory, exist_ok=True)
         cache_file = os.path.join(directory, cache_key)
         if os.path.exists(cache_file + ".index"):
             logger.info("Loading elements from existing cache in directory '%s' with key '%s'.", directory, cache_key)
         else:
             logger.info("Caching dataset in batches of size %d to directory '%s' with key '%s'.", batch_size, directory, cache_key)
-    return (ds.batch(batch_size)
-              .prefetch(TF_AUTOTUNE)
-              .cache(cache_file)
-              .prefetch(TF_AUTOTUNE)
-              .unbatch())
+    if storage_keys:
+        ds = ds.map(encode, num_parallel_calls=TF_AUTOTUNE)
+    ds = (ds.batch(batch_size)
+            .prefetch(TF_AUTOTUNE)
+            .cache(cache_file)
+            .prefetch(TF_AUTOTUNE)
+            .unbatch())
+    if storage_keys:
+        ds = ds.map(decode, num_parallel_calls=TF_AUTOTUNE)
+    return ds
 
 
-def compute_webrtc_vad(ds, aggressiveness, vad_frame_length_ms, min_non_speech_length_ms):
+def compute_energy_vad(ds, vad_frame_length_ms=10, strength=0.5, min_rms_threshold=1e-3, batch_size=64):
+    """
+    Compute voice activity detection by comparing the RMS energy of every non-overlapping frame of length 'vad_frame_length_ms' to the mean RMS energy of the signal, see lidbox.features.audio.framewise_rms_energy_vad_decisions.
+    Signals are zero padded into batches of size 'batch_size' and the padding is excluded from the mean RMS.
+    Signals are batched by sample rate.
+    The decisions can be applied with apply_vad.
+    """
+    logger.info("Computing energy based voice activity detection decisions on %d ms long windows with strength %.3f in batches of size %d.", vad_frame_length_ms, strength, batch_size)
+    def append_vad_decisions(x):
+        signals = audio_features.signal_as_float32(x["signal"])
+        lengths = x["_shape_signal"][:,0]
+        sample_rate = x["sample_rate"][0]
+        tf.debugging.assert_equal(x["sample_rate"], [sample_rate], message="Different sample rates in a single batch not supported, all signals in the same batch should have the same sample rate.")
+        vad_decisions = audio_features.framewise_rms_energy_vad_decisions(
+                signals,
+                sample_rate,
+                frame_length_ms=vad_frame_length_ms,
+                frame_step_ms=vad_frame_length_ms,
+                strength=strength,
+                min_rms_threshold=min_rms_threshold,
+                lengths=lengths)
+        vad_frame_length = audio_features.ms_to_frames(sample_rate, vad_frame_length_ms)
+        return dict(x,
+                vad_is_speech=vad_decisions,
+                _shape_vad_is_speech=tf.expand_dims(lengths // vad_frame_length, 1),
+                vad_frame_length_ms=tf.fill(tf.shape(lengths), vad_frame_length_ms))
+    def get_sample_rate(x):
+        return tf.cast(x["sample_rate"], tf.int64)
+    ds = _padded_batch_with_shapes(ds, batch_size, group_key_fn=get_sample_rate)
+    return _unbatch_and_trim(ds.map(append_vad_decisions, num_parallel_calls=TF_AUTOTUNE))
+
+
+def compute_webrtc_vad(ds, aggressiveness, vad_frame_length_ms, min_non_speech_length_ms, batch_size=64, num_workers=None, cache_directory=None):
     """
     Compute voice activity detection with WebRTC VAD.
+    Signals are processed in zero padded batches of size 'batch_size', which are divided to a pool of 'num_workers' processes, defaulting to the amount of CPUs.
+    If 'num_workers' is 0, the batches are processed in the calling thread.
+    If 'cache_directory' is given, decisions are stored by utterance id and VAD parameters into a database in that directory and decisions that have been computed in earlier runs are not computed again.
     """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    cache_path = ''
+    cache_params_key = ''
+    if cache_directory is not None:
+        cache_path = os.path.join(cache_directory, "webrtcvad.sqlite")
+        cache_params_key = lidbox.vad.DecisionCache.params_key(
+                aggressiveness=aggressiveness,
+                vad_frame_length_ms=vad_frame_length_ms,
+                min_non_speech_length_ms=min_non_speech_length_ms)
+        logger.info("Using VAD decision cache '%s' with parameter key '%s'.", cache_path, cache_params_key)
     vad_frame_length_sec = tf.constant(vad_frame_length_ms * 1e-3, tf.float32)
     min_non_speech_frames = tf.constant(min_non_speech_length_ms // vad_frame_length_ms, tf.int32)
-    logger.info("Computing voice activity detection decisions on %d ms long windows.\nMinimum length of continous non-speech segment before it is marked as non-speech is %d ms.", vad_frame_length_ms, min_non_speech_length_ms)
+    logger.info("Computing voice activity detection decisions on %d ms long windows.\nMinimum length of continous non-speech segment before it is marked as non-speech is %d ms.\nUsing batches of size %d and %d worker processes.", vad_frame_length_ms, min_non_speech_length_ms, batch_size, num_workers)
     def append_vad_decisions(x):
-        signal, sample_rate = x["signal"], x["sample_rate"]
-        vad_frame_length = tf.cast(tf.cast(sample_rate, tf.float32) * vad_frame_length_sec, tf.int32)
-        frames = tf.signal.frame(signal, vad_frame_length, vad_frame_length, axis=0)
-        _, pcm_data = audio_features.wav_to_pcm_data(signal, sample_rate)
-        args = (signal,
-                sample_rate,
-                pcm_data,
-                vad_frame_length,
+        signals, sample_rates = x["signal"], x["sample_rate"]
+        lengths = x["_shape_signal"][:,0]
+        vad_frame_lengths = tf.cast(tf.cast(sample_rates, tf.float32) * vad_frame_length_sec, tf.int32)
+        args = (signals,
+                lengths,
+                sample_rates,
+                vad_frame_lengths,
                 aggressiveness,
-                min_non_speech_frames)
-        vad_decisions = tf.numpy_function(audio_features.numpy_fn_get_webrtcvad_decisions, args, tf.bool)
-        vad_decisions = tf.reshape(vad_decisions, [tf.shape(frames)[0]])
-        return dict(x, vad_is_speech=vad_decisions, vad_frame_length_ms=vad_frame_length_ms)
-    return ds.map(append_vad_decisions, num_parallel_calls=TF_AUTOTUNE)
+                min_non_speech_frames,
+                num_workers,
+                x["id"],
+                cache_path,
+                cache_params_key)
+        vad_decisions = tf.numpy_function(lidbox.vad.numpy_fn_batch_webrtcvad_decisions, args, tf.bool)
+        num_frames = lengths // vad_frame_lengths
+        vad_decisions = tf.reshape(vad_decisions, [tf.shape(signals)[0], tf.math.reduce_max(num_frames)])
+        return dict(x,
+                vad_is_speech=vad_decisions,
+                _shape_vad_is_speech=tf.expand_dims(num_frames, 1),
+                vad_frame_length_ms=tf.fill(tf.shape(lengths), vad_frame_length_ms))
+    ds = _padded_batch_with_shapes(ds, batch_size)
+    return _unbatch_and_trim(ds.map(append_vad_decisions, num_parallel_calls=TF_AUTOTUNE))
 
 
 def consume(ds, log_interval=-1):
     """
     Iterate over ds to exhaust the iterator and fully evaluate the preceding pipeline.
+    Statistics gathered by the preceding steps during the iteration, e.g. VAD frame counts from apply_vad, are logged when done.
     """
     speed = 0
     last_update = 0
@@ -268,6 +857,7 @@ def consume(ds, log_interval=-1):
         if log_interval > -1 and i % log_interval == 0:
             counter_step(i)
     counter_step(i)
+    _log_pipeline_stats()
     return ds
 
 
@@ -296,7 +886,7 @@ def consume_to_tensorboard(ds, summary_dir, config, skip_if_exists=True):
         if "signal" in batch and tf.size(batch["signal"]) > 0:
             sample_rates = batch["sample_rate"][:max_outputs]
             tf.debugging.assert_equal(sample_rates, [sample_rates[0]], message="Unable to add audio to tensorboard summary due to signals in the batch having different sample rates")
-            signals = tf.expand_dims(batch["signal"][:max_outputs], -1)
+            signals = tf.expand_dims(audio_features.signal_as_float32(batch["signal"][:max_outputs]), -1)
             tf.summary.audio("utterances", signals, sample_rates[0], step=batch_idx, encoding="wav")
         enumerated_uttids = tf.strings.reduce_join(
                 (tf.strings.as_string(tf.range(1, max_outputs + 1)), batch["id"][:max_outputs]),
@@ -318,44 +908,33 @@ def consume_to_tensorboard(ds, summary_dir, config, skip_if_exists=True):
     return ds
 
 
-# TODO generalize and merge with create_signal_chunks
 def create_input_chunks(ds, length, step):
-    id_str_padding = 6
-    def chunks_to_elements(chunk, chunk_num, x):
-        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
-        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
-        return dict(x, id=chunk_id, input=chunk)
-    def chunk_input_and_flatten(x):
+    """
+    Divide the features under 'input' of each element of ds into chunks of 'length' frames with offset 'step' frames and create new utterances from the created chunks.
+    See create_signal_chunks for which keys are kept in the chunks.
+    """
+    logger.info("Dividing every input in the dataset into new inputs by creating chunks of length %d frames and offset %d frames.", length, step)
+    def chunk_input(x):
         chunks = tf.signal.frame(x["input"], length, step, axis=0)
-        num_chunks = tf.cast(tf.shape(chunks)[0], tf.int64)
-        chunk_ds = tf.data.Dataset.from_tensor_slices(chunks)
-        chunk_nums_ds = tf.data.Dataset.range(1, num_chunks + 1)
-        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(num_chunks)
-        return (tf.data.Dataset
-                  .zip((chunk_ds, chunk_nums_ds, repeat_x_ds))
-                  .map(chunks_to_elements))
-    return ds.interleave(chunk_input_and_flatten, num_parallel_calls=TF_AUTOTUNE)
+        return _flatten_chunks(x, "input", chunks, 6)
+    return (ds.apply(_drop_non_scalar_keys_except("input"))
+              .map(chunk_input, num_parallel_calls=TF_AUTOTUNE)
+              .unbatch())
 
 
-def create_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_output_order=True, max_num_chunks_per_signal=int(1e6), avg_num_chunks_from_signals=100):
+def create_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_output_order=True, max_num_chunks_per_signal=int(1e6)):
     """
     Divide the signals of each element of ds into fixed length chunks and create new utterances from the created chunks.
-    The metadata of each element is repeated into into each chunk, except for the utterance ids, which will be appended by the chunk number.
+    The scalar metadata of each element is repeated into into each chunk, except for the utterance ids, which will be appended by the chunk number.
+    All other non-scalar values, e.g. VAD decisions, are dropped, since they do not match the chunks.
+    All chunks of a signal are created with one batched operation and flattened into separate elements with unbatch.
     """
     logger.info("Dividing every signal in the dataset into new signals by creating signal chunks of length %d ms and offset %d ms. Maximum amount of padding allowed in the last chunk is %d ms.", length_ms, step_ms, max_pad_ms)
     chunk_length_sec = tf.constant(1e-3 * length_ms, tf.float32)
     chunk_step_sec = tf.constant(1e-3 * step_ms, tf.float32)
     max_pad_sec = tf.constant(1e-3 * max_pad_ms, tf.float32)
-    id_str_padding = tf.cast(tf.round(audio_features.log10(tf.cast(max_num_chunks_per_signal, tf.float32))), tf.int32)
-    def chunks_to_elements(chunk, chunk_num, x):
-        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
-        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
-        out = dict(x, signal=tf.reshape(chunk, [-1]), id=chunk_id)
-        if "duration" in x:
-            duration_str = tf.strings.as_string(tf.cast(tf.size(chunk) / x["sample_rate"], tf.float32))
-            out = dict(out, duration=duration_str)
-        return out
-    def chunk_signal_and_flatten(x):
+    id_str_padding = int(round(np.log10(max_num_chunks_per_signal)))
+    def chunk_signal(x):
         signal = x["signal"]
         sample_rate = tf.cast(x["sample_rate"], tf.float32)
         chunk_length = tf.cast(sample_rate * chunk_length_sec, tf.int32)
@@ -367,22 +946,20 @@ def create_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_out
         if last_chunk_length < chunk_length and chunk_length <= last_chunk_length + max_pad:
             signal = tf.pad(signal, [[0, chunk_length - last_chunk_length]])
         chunks = tf.signal.frame(signal, chunk_length, chunk_step, axis=0)
-        num_chunks = tf.cast(tf.shape(chunks)[0], tf.int64)
-        chunk_ds = tf.data.Dataset.from_tensor_slices(chunks)
-        chunk_nums_ds = tf.data.Dataset.range(1, num_chunks + 1)
-        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(num_chunks)
-        return (tf.data.Dataset
-                  .zip((chunk_ds, chunk_nums_ds, repeat_x_ds))
-                  .map(chunks_to_elements))
-    interleave_kwargs = {
-            "block_length": avg_num_chunks_from_signals,
+        out = _flatten_chunks(x, "signal", chunks, id_str_padding)
+        if "duration" in x:
+            duration = tf.cast(chunk_length, tf.float32) / sample_rate
+            out["duration"] = tf.fill([tf.shape(chunks)[0]], tf.strings.as_string(duration))
+        return out
+    map_kwargs = {
             "num_parallel_calls": TF_AUTOTUNE,
             "deterministic": deterministic_output_order}
     if TF_VERSION_MAJOR == 2 and TF_VERSION_MINOR < 2:
-        del interleave_kwargs["deterministic"]
-        logger.warning("Deleted unsupported 'deterministic' kwarg from tf.data.Dataset.interleave call, TF version >= 2.2 is required.")
-    return ds.interleave(chunk_signal_and_flatten, **interleave_kwargs)
-
+        del map_kwargs["deterministic"]
+        logger.warning("Deleted unsupported 'deterministic' kwarg from tf.data.Dataset.map call, TF version >= 2.2 is required.")
+    return (ds.apply(_drop_non_scalar_keys_except("signal"))
+              .map(chunk_signal, **map_kwargs)
+              .unbatch())
 
 def drop_empty(ds):
     """
@@ -403,6 +980,10 @@ def extract_features(ds, config):
     """
     Extract features from signals of each element in ds and add them under 'input' key to each element.
     By default, feature extraction is requested to be placed on the first visible GPU, falling back on a CPU only if GPUs are not available.
+    If 'pad_batches' is True in the config, signals of different lengths are zero padded into batches of size 'batch_size' and the features of each element are trimmed to the amount of frames computed from its actual signal.
+    Signals are always batched by sample rate.
+    If all sample rates are known in advance and given as 'sample_rates' or 'sample_rate' in the config, feature extraction constants are computed only once for every sample rate.
+    If 'backend' is 'numpy' in the config, features are computed with lidbox.numpy_features in a pool of 'num_workers' processes instead of TensorFlow.
     """
     feature_type = tf.constant(config["type"], tf.string)
     args = _feature_extraction_kwargs_to_args(config)
@@ -414,21 +995,68 @@ def extract_features(ds, config):
     else:
         tf_device = "/CPU:0"
     logger.info("Extracting '%s' features on device '%s' with arguments:\n  %s", config["type"], tf_device, "\n  ".join(repr(a) for a in args[1:]))
+    sample_rates = config.get("sample_rates", [config["sample_rate"]] if "sample_rate" in config else [])
+    if config.get("backend", "tf") == "numpy":
+        num_workers = config.get("num_workers", os.cpu_count())
+        logger.info("Using the NumPy feature extraction backend with %d worker processes instead of TensorFlow.", num_workers)
+        extractor_config = json.dumps(args)
+        num_channels = lidbox.numpy_features.num_output_channels(config["type"], args[2], args[3])
+        def extractor(signals, batch_sample_rates, signal_lengths=None):
+            if signal_lengths is None:
+                signal_lengths = tf.zeros([0], tf.int64)
+            features = tf.numpy_function(
+                    lidbox.numpy_features.numpy_fn_extract_features,
+                    [signals, signal_lengths, batch_sample_rates[0], extractor_config, num_workers],
+                    tf.float32)
+            features.set_shape([None, None, num_channels])
+            return features
+    elif sample_rates:
+        logger.info("Precomputing feature extraction constants for sample rates %s.", ', '.join(str(r) for r in sample_rates))
+        with tf.device(tf_device):
+            extractors = [tf_utils.FeatureExtractor(sample_rate, *args) for sample_rate in sample_rates]
+        sample_rates = tf.constant(sample_rates, tf.int32)
+        def extractor(signals, batch_sample_rates, signal_lengths=None):
+            rate_index = tf.where(sample_rates == batch_sample_rates[0])
+            tf.debugging.assert_equal(tf.size(rate_index), 1, message="Signals have a sample rate that is not in the 'sample_rates' of the feature extraction config.")
+            branches = [lambda e=e: e(signals, batch_sample_rates, signal_lengths) for e in extractors]
+            return tf.switch_case(tf.cast(tf.reshape(rate_index, [-1])[0], tf.int32), branches)
+    else:
+        extractor = lambda signals, sample_rates, signal_lengths=None: tf_utils.extract_features(signals, sample_rates, *args, signal_lengths=signal_lengths)
 
     def append_features(x):
         with tf.device(tf_device):
-            features = tf_utils.extract_features(x["signal"], x["sample_rate"], *args)
+            features = extractor(x["signal"], x["sample_rate"])
         feature_types = tf.repeat(feature_type, tf.shape(features)[0])
         return dict(x, input=features, feature_type=feature_types)
 
+    def get_sample_rate(x):
+        return tf.cast(x["sample_rate"], tf.int64)
+
+    def append_padded_features(x):
+        signal_lengths = x["_shape_signal"][:,0]
+        with tf.device(tf_device):
+            features = extractor(x["signal"], x["sample_rate"], signal_lengths=signal_lengths)
+        num_frames = tf_utils.num_feature_frames(signal_lengths, x["sample_rate"][0], config.get("spectrogram", {}))
+        feature_dims = tf.fill(tf.shape(num_frames), tf.shape(features)[2])
+        feature_types = tf.repeat(feature_type, tf.shape(features)[0])
+        return dict(x, input=features, _shape_input=tf.stack((num_frames, feature_dims), axis=1), feature_type=feature_types)
+
+    if config.get("pad_batches", False):
+        batch_size = config.get("batch_size", 1)
+        logger.info("Padding signals into batches of size %d, extracting features in batches and trimming padded frames.", batch_size)
+        ds = _padded_batch_with_shapes(ds, batch_size, group_key_fn=get_sample_rate)
+        return _unbatch_and_trim(ds.prefetch(TF_AUTOTUNE).map(append_padded_features, num_parallel_calls=TF_AUTOTUNE))
     if "group_by_input_length" in config:
         max_batch_size = config["group_by_input_length"]["max_batch_size"]
         logger.info("Grouping signals by length, creating batches of max size %d from each group", max_batch_size)
-        ds = group_by_axis_length(ds, "signal", max_batch_size, axis=0)
+        ds = group_by_axis_length(ds, "signal", max_batch_size, axis=0, extra_group_key="sample_rate")
     else:
         batch_size = tf.constant(config.get("batch_size", 1), tf.int64)
         logger.info("Batching signals with batch size %s, extracting features in batches.", batch_size.numpy())
-        ds = ds.batch(batch_size)
+        ds = ds.apply(tf.data.experimental.group_by_window(
+            get_sample_rate,
+            lambda key, group: group.batch(batch_size),
+            window_size=batch_size))
     return (ds.prefetch(TF_AUTOTUNE)
               .map(append_features, num_parallel_calls=TF_AUTOTUNE)
               .unbatch())
@@ -444,15 +1072,20 @@ def filter_keys_in_set(ds, keys):
     return ds.map(filter_keys, num_parallel_calls=TF_AUTOTUNE)
 
 
-def group_by_axis_length(ds, element_key, max_batch_size, min_batch_size=0, axis=0):
+def group_by_axis_length(ds, element_key, max_batch_size, min_batch_size=0, axis=0, extra_group_key=None):
     """
     Group elements such that every group is a batch where all tensors at key 'element_key' have the same length in a given dimension 'axis'.
+    If 'extra_group_key' is given, e.g. "sample_rate", the elements in every batch must also have the same non-negative integer scalar at that key.
     """
     max_batch_size = tf.constant(max_batch_size, tf.int64)
     min_batch_size = tf.constant(min_batch_size, tf.int64)
     axis = tf.constant(axis, tf.int32)
     def get_seq_len(x):
-        return tf.cast(tf.shape(x[element_key])[axis], tf.int64)
+        seq_len = tf.cast(tf.shape(x[element_key])[axis], tf.int64)
+        if extra_group_key is not None:
+            # Lengths are assumed to fit into 32 bits
+            seq_len += tf.bitwise.left_shift(tf.cast(x[extra_group_key], tf.int64), 32)
+        return seq_len
     def group_to_batch(key, group):
         return group.batch(max_batch_size)
     def has_min_batch_size(batch):
@@ -463,19 +1096,31 @@ def group_by_axis_length(ds, element_key, max_batch_size, min_batch_size=0, axis
         window_size=max_batch_size))
 
 
-def initialize(ds, labels, init_data):
+def initialize(ds, labels, init_data, file_batch_size=10000):
     """
     Initialize a tf.data.Dataset instance for the pipeline.
     This should probably always be the first step.
+    If 'init_data' is a dict of metadata lists, all metadata is converted into tensors.
+    If 'init_data' is a list of metadata file paths for each dataset, as returned by lidbox.api.get_flat_dataset_config, all metadata is streamed from the files in batches of size 'file_batch_size' and nothing is loaded into memory up front.
+    If a dataset has a compiled metadata index under key 'index', the rows are read from the index instead of the metadata files.
     """
     if ds is not None:
         logger.warning("Step 'initialize' is being applied on an already initialized dataset, all state will be lost.")
     ds = None
-    init_data_tensors = {key: tf.convert_to_tensor(list(meta)) for key, meta in init_data.items()}
-    logger.info(
-            "Initializing dataset from tensors with metadata keys:\n  %s",
-            '\n  '.join(sorted(init_data_tensors.keys())))
-    ds = tf.data.Dataset.from_tensor_slices(init_data_tensors)
+    if isinstance(init_data, dict):
+        init_data_tensors = {key: tf.convert_to_tensor(meta if isinstance(meta, list) else list(meta)) for key, meta in init_data.items()}
+        logger.info(
+                "Initializing dataset from tensors with metadata keys:\n  %s",
+                '\n  '.join(sorted(init_data_tensors.keys())))
+        ds = tf.data.Dataset.from_tensor_slices(init_data_tensors)
+    else:
+        logger.info(
+                "Initializing dataset by streaming metadata files of %d datasets in batches of size %d:\n  %s",
+                len(init_data), file_batch_size,
+                '\n  '.join(p for meta in init_data for k, p in sorted(meta.items()) if k not in ("dataset", "kwargs")))
+        for meta in init_data:
+            meta_ds = _stream_metadata_files(meta, file_batch_size)
+            ds = meta_ds if ds is None else ds.concatenate(meta_ds)
     label2int, _ = tf_utils.make_label2onehot(tf.constant(labels, tf.string))
     logger.info(
             "Generated label2target lookup table from indexes of array:\n  %s",
@@ -484,17 +1129,102 @@ def initialize(ds, labels, init_data):
     return ds.map(append_labels_as_targets, num_parallel_calls=TF_AUTOTUNE)
 
 
-def load_audio(ds):
+def load_audio(ds, dtype="float32"):
     """
     Load signal from the 'path' key as WAV file for each element of ds.
+    If the elements have a 'segment' key from an utt2seg file, only the segment between its start and end times is read from the WAV file.
+    If the segment has a channel column, only that channel is read, otherwise all channels are averaged.
+    If 'dtype' is "int16", signals are kept as 16-bit PCM samples, which halves their size in memory and in caches.
+    Such signals are converted to floats only when needed, e.g. during feature extraction.
     """
+    if dtype not in ("float32", "int16"):
+        raise ValueError("Unsupported signal dtype '{}', must be 'float32' or 'int16'".format(dtype))
+    if dtype == "int16":
+        read_wav = audio_features.read_wav_int16
+        read_wav_segment = audio_features.read_wav_segment_int16
+    else:
+        read_wav = audio_features.read_wav
+        read_wav_segment = audio_features.read_wav_segment
+    logger.info("Loaded signals will have dtype '%s'.", dtype)
+    if "segment" in ds.element_spec:
+        logger.info("Elements have segment metadata, reading only the segment of each audio file at the path of each element and appending the read signals and their sample rates to each element.")
+        def append_signals(x):
+            # file_id start end [channel], all channels are averaged if there is no channel
+            segment = tf.concat((tf.strings.split(x["segment"], sep=' '), ["-1"]), axis=0)
+            start_sec = tf.strings.to_number(segment[1], tf.float64)
+            end_sec = tf.strings.to_number(segment[2], tf.float64)
+            channel = tf.strings.to_number(segment[3], tf.int32)
+            signal, sample_rate = read_wav_segment(x["path"], start_sec, end_sec, channel)
+            return dict(x, signal=signal, sample_rate=sample_rate)
+        return ds.map(append_signals, num_parallel_calls=TF_AUTOTUNE)
     logger.info("Reading audio files from the path of each element and appending the read signals and their sample rates to each element.")
     def append_signals(x):
-        signal, sample_rate = audio_features.read_wav(x["path"])
+        signal, sample_rate = read_wav(x["path"])
         return dict(x, signal=signal, sample_rate=sample_rate)
     return ds.map(append_signals, num_parallel_calls=TF_AUTOTUNE)
 
 
+def load_audio_shards(ds, directory, shuffle_shards=False, num_parallel_reads=8, block_length=1, dtype="float32"):
+    """
+    Replace ds with all elements packed into audio shards by write_audio_shards into 'directory'.
+    Shards are read in parallel by interleaving 'num_parallel_reads' shards at a time, taking 'block_length' consecutive elements from each.
+    If 'shuffle_shards' is True, the shard order is shuffled on every iteration, which should be combined with an element level shuffle buffer of at least the shard size.
+    Signals are stored as 16-bit PCM and converted to floats unless 'dtype' is "int16".
+    """
+    if ds is not None:
+        logger.info("Step 'load_audio_shards' replaces all elements of the existing dataset with elements from the shards.")
+    with open(os.path.join(directory, AUDIO_SHARDS_MANIFEST)) as f:
+        manifest = json.load(f)
+    logger.info(
+            "Reading %d elements from %d audio shards in '%s', %d shards in parallel, shuffling shards: %s.",
+            manifest["num_elements"], len(manifest["shards"]), directory, num_parallel_reads, shuffle_shards)
+    feature_spec = {"signal": tf.io.FixedLenFeature([], tf.string)}
+    feature_spec.update({k: tf.io.FixedLenFeature([], tf.string) for k in manifest["string_keys"]})
+    feature_spec.update({k: tf.io.FixedLenFeature([], tf.int64) for k in manifest["int_keys"]})
+    int_dtypes = {k: tf.as_dtype(dtype) for k, dtype in manifest["int_keys"].items()}
+    def parse_element(serialized):
+        x = tf.io.parse_single_example(serialized, feature_spec)
+        x = dict(x, **{k: tf.cast(x[k], dtype) for k, dtype in int_dtypes.items()})
+        pcm = tf.io.decode_raw(x["signal"], tf.int16)
+        if dtype == "int16":
+            return dict(x, signal=pcm)
+        return dict(x, signal=audio_features.int16_to_float32(pcm))
+    def read_shard(path):
+        return tf.data.TFRecordDataset(path, compression_type=manifest["compression"])
+    interleave_kwargs = {
+            "cycle_length": num_parallel_reads,
+            "block_length": block_length,
+            "num_parallel_calls": TF_AUTOTUNE,
+            "deterministic": not shuffle_shards}
+    if TF_VERSION_MAJOR == 2 and TF_VERSION_MINOR < 2:
+        del interleave_kwargs["deterministic"]
+        logger.warning("Deleted unsupported 'deterministic' kwarg from tf.data.Dataset.interleave call, TF version >= 2.2 is required.")
+    if not manifest["shards"]:
+        logger.warning("Directory '%s' contains no audio shards, the dataset will be empty.", directory)
+    # Explicit dtype, an empty list would be converted to float32
+    shard_paths = tf.data.Dataset.from_tensor_slices(tf.constant([os.path.join(directory, p) for p in manifest["shards"]], tf.string))
+    if shuffle_shards:
+        shard_paths = shard_paths.shuffle(max(1, len(manifest["shards"])), reshuffle_each_iteration=True)
+    return (shard_paths
+              .interleave(read_shard, **interleave_kwargs)
+              .map(parse_element, num_parallel_calls=TF_AUTOTUNE))
+
+
+def load_kaldi_features(ds):
+    """
+    Read the Kaldi feature matrix of each element of ds from the ark file location at key 'kaldi_ark_key' and append it under key 'kaldi_ark'.
+    Vectors are read as matrices with one row.
+    Matrices are read on demand from memory-mapped ark files, in parallel for multiple elements.
+    """
+    logger.info("Reading Kaldi feature matrices from memory-mapped ark files using the 'kaldi_ark_key' of each element.")
+    def append_features(x):
+        features = tf.numpy_function(kaldi_ark.numpy_fn_read_matrix, [x["kaldi_ark_key"]], tf.float32)
+        # numpy_function outputs have unknown shape
+        features.set_shape([None, None])
+        return dict(x, kaldi_ark=features)
+    return ds.map(append_features, num_parallel_calls=TF_AUTOTUNE)
+
+
 def normalize(ds, config):
     """
     Apply normalization for all elements of ds for some key.
@@ -588,6 +1318,88 @@ def show_all_elements(ds, shapes_only=True):
     return ds
 
 
+def write_audio_shards(ds, directory, shard_size=10000, compression=None, source_hash=None, **load_kwargs):
+    """
+    Pack the signals and all scalar metadata of every element of ds into TFRecord shard files of 'shard_size' elements each, with signals stored as 16-bit PCM.
+    Lossless compression of the shards can be enabled by setting 'compression' to "GZIP" or "ZLIB".
+    'source_hash' should be a string that changes whenever the contents of ds would change, e.g. a hash of the metadata and the config used to create ds.
+    It is stored in the manifest together with the shard config and the metadata keys of ds.
+    If the directory already contains shards with a matching manifest, ds is not evaluated.
+    Otherwise, the existing shards are removed and all elements of ds are packed again.
+    Packing is eager, ds is fully iterated when this step is called, before the returned dataset is iterated.
+    Returns a dataset that reads the shards with load_audio_shards, using 'load_kwargs'.
+    """
+    string_keys = [k for k, spec in ds.element_spec.items() if spec.dtype == tf.string and spec.shape.rank == 0]
+    int_keys = {k: spec.dtype.name for k, spec in ds.element_spec.items()
+                if spec.dtype.is_integer and spec.shape.rank == 0}
+    manifest_key = hashlib.sha1(json.dumps({
+        "source_hash": source_hash,
+        "shard_size": shard_size,
+        "compression": compression or '',
+        "string_keys": string_keys,
+        "int_keys": int_keys,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    manifest_path = os.path.join(directory, AUDIO_SHARDS_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+        if old_manifest.get("manifest_key") == manifest_key:
+            logger.info("Directory '%s' already contains audio shards packed from the same source, they will be used instead of packing the dataset again.", directory)
+            return load_audio_shards(ds, directory, **load_kwargs)
+        logger.warning("Directory '%s' contains audio shards packed from a different source or with a different config, removing %d old shards and packing the dataset again.", directory, len(old_manifest["shards"]))
+        # Removed first, the old shards are invalid from now on
+        os.remove(manifest_path)
+        for shard in old_manifest["shards"]:
+            shard_path = os.path.join(directory, shard)
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+    logger.info(
+            "Packing signals and metadata keys %s of all elements into shards of size %d in directory '%s' with compression %s. "
+            "Packing is eager, all elements of the dataset are iterated now, which reads all audio files once.",
+            ', '.join(string_keys + list(int_keys)), shard_size, directory, compression)
+    os.makedirs(directory, exist_ok=True)
+    options = tf.io.TFRecordOptions(compression_type=compression or '')
+    shard_suffix = ".tfrecord" + {"GZIP": ".gz", "ZLIB": ".zz"}.get(compression, '')
+    def bytes_feature(value):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+    def int_feature(value):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+    shards = []
+    writer = None
+    i = 0
+    for i, x in enumerate(ds.as_numpy_iterator(), start=1):
+        if writer is None:
+            shards.append("shard-{:06d}{}".format(len(shards), shard_suffix))
+            writer = tf.io.TFRecordWriter(os.path.join(directory, shards[-1]), options)
+        signal = x["signal"]
+        if signal.dtype != np.int16:
+            signal = np.clip(np.round(32768.0 * signal), -32768, 32767).astype(np.int16)
+        feature = {"signal": bytes_feature(signal.astype("<i2").tobytes())}
+        feature.update({k: bytes_feature(x[k]) for k in string_keys})
+        feature.update({k: int_feature(int(x[k])) for k in int_keys})
+        writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+        if i % shard_size == 0:
+            writer.close()
+            writer = None
+            logger.info("%d elements packed into %d shards.", i, len(shards))
+    if writer is not None:
+        writer.close()
+    manifest = {
+        "manifest_key": manifest_key,
+        "source_hash": source_hash,
+        "num_elements": i,
+        "shards": shards,
+        "compression": compression or '',
+        "string_keys": string_keys,
+        "int_keys": int_keys,
+    }
+    # Written last, shards are valid only if the manifest exists
+    with open(os.path.join(directory, AUDIO_SHARDS_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info("All %d elements packed into %d shards in '%s'.", i, len(shards), directory)
+    return load_audio_shards(ds, directory, **load_kwargs)
+
+
 def write_to_kaldi_files(ds, output_dir, element_key="input"):
     from kaldiio import WriteHelper
     os.makedirs(output_dir, exist_ok=True)
@@ -601,13 +1413,18 @@ def write_to_kaldi_files(ds, output_dir, element_key="input"):
 
 
 VALID_STEP_FUNCTIONS = {
+    "accumulate_global_cmvn": accumulate_global_cmvn,
     "append_predictions": append_predictions,
     "apply_filters": apply_filters,
+    "apply_global_cmvn": apply_global_cmvn,
     "apply_vad": apply_vad,
     "as_supervised": as_supervised,
     "augment_by_additive_noise": augment_by_additive_noise,
     "augment_by_random_resampling": augment_by_random_resampling,
+    "augment_by_rir": augment_by_rir,
+    "augment_by_spec_augment": augment_by_spec_augment,
     "cache": cache,
+    "compute_energy_vad": compute_energy_vad,
     "compute_webrtc_vad": compute_webrtc_vad,
     "consume": consume,
     "consume_to_tensorboard": consume_to_tensorboard,
@@ -620,10 +1437,13 @@ VALID_STEP_FUNCTIONS = {
     "initialize": initialize,
     "lambda": lambda_fn,
     "load_audio": load_audio,
+    "load_audio_shards": load_audio_shards,
+    "load_kaldi_features": load_kaldi_features,
     "normalize": normalize,
     "reduce_stats": reduce_stats,
     "remap_keys": remap_keys,
     "show_all_elements": show_all_elements,
+    "write_audio_shards": write_audio_shards,
     "write_to_kaldi_files": write_to_kaldi_files,
 }
 
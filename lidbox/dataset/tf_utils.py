@@ -1,5 +1,6 @@
 import sys
 
+import numpy as np
 import tensorflow as tf
 
 import lidbox.features as features
@@ -118,12 +119,42 @@ def count_dim_sizes(ds, element_key=0, ndims=1):
         axis=2)
 
 
+def quantize_uint8(X):
+    """
+    Quantize all values of X linearly to 256 levels between the minimum and maximum of X.
+    Returns the quantized values as uint8 and the scale and offset that are needed for dequantize_uint8.
+    """
+    offset = tf.math.reduce_min(X)
+    scale = (tf.math.reduce_max(X) - offset) / 255.0
+    X_quantized = tf.math.round(tf.math.divide_no_nan(X - offset, scale))
+    return tf.cast(tf.clip_by_value(X_quantized, 0.0, 255.0), tf.uint8), scale, offset
+
+
+def dequantize_uint8(X_quantized, scale, offset, dtype=tf.float32):
+    return tf.cast(X_quantized, dtype) * tf.cast(scale, dtype) + tf.cast(offset, dtype)
+
+
+def num_feature_frames(signal_lengths, sample_rate, spec_kwargs):
+    """
+    Amount of spectrogram frames computed from signals of length 'signal_lengths' with the spectrogram config 'spec_kwargs'.
+    """
+    frame_length = audio_features.ms_to_frames(sample_rate, spec_kwargs.get("frame_length_ms", 25))
+    frame_step = audio_features.ms_to_frames(sample_rate, spec_kwargs.get("frame_step_ms", 10))
+    return tf.math.maximum(0, 1 + (tf.cast(signal_lengths, tf.int32) - frame_length) // frame_step)
+
+
 @tf.function
-def extract_features(signals, sample_rates, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
+def extract_features(signals, sample_rates, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs, signal_lengths=None):
     tf.debugging.assert_rank(signals, 2, message="Input signals for feature extraction must be batches of mono signals without channels, i.e. of shape [B, N] where B is batch size and N number of samples.")
+    # lidbox.dataset.steps.extract_features batches signals by sample rate
     tf.debugging.assert_equal(sample_rates, [sample_rates[0]], message="Different sample rates in a single batch not supported, all signals in the same batch should have the same sample rate.")
-    #TODO batches with different sample rates (probably not worth the effort)
     sample_rate = sample_rates[0]
+    # Signals might have been kept as 16-bit PCM until now
+    signals = audio_features.signal_as_float32(signals)
+    num_frames = None
+    if signal_lengths is not None:
+        # Signals are zero padded, use only the frames computed from the actual signals for all statistics
+        num_frames = num_feature_frames(signal_lengths, sample_rate, spec_kwargs)
     X = audio_features.spectrograms(signals, sample_rate, **spec_kwargs)
     tf.debugging.assert_all_finite(X, "spectrogram failed")
     if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
@@ -139,17 +170,93 @@ def extract_features(signals, sample_rates, feattype, spec_kwargs, melspec_kwarg
                 X = mfccs[..., coef_begin:coef_end]
                 tf.debugging.assert_all_finite(X, "mfcc failed")
     elif feattype in ("db_spectrogram",):
-        X = audio_features.power_to_db(X, **db_spec_kwargs)
+        X = audio_features.power_to_db(X, lengths=num_frames, **db_spec_kwargs)
         tf.debugging.assert_all_finite(X, "db_spectrogram failed")
     if feat_scale_kwargs:
-        X = features.feature_scaling(X, **feat_scale_kwargs)
+        X = features.feature_scaling(X, lengths=num_frames, **feat_scale_kwargs)
         tf.debugging.assert_all_finite(X, "feature scaling failed")
     if window_norm_kwargs:
-        X = features.window_normalization(X, **window_norm_kwargs)
+        X = features.window_normalization(X, lengths=num_frames, **window_norm_kwargs)
         tf.debugging.assert_all_finite(X, "window normalization failed")
     return X
 
 
+class FeatureExtractor:
+    """
+    Same as extract_features, but for signals with a fixed, known sample rate.
+    All constants, i.e. the STFT window, the frequency band of the spectrogram, the mel filterbank and the DCT matrix, are computed once when the extractor is created, instead of for every batch.
+    The outputs are equal to extract_features up to floating point rounding.
+    """
+    def __init__(self, sample_rate, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
+        self.sample_rate = sample_rate
+        self.feattype = feattype
+        self.spec_kwargs = spec_kwargs
+        self.db_spec_kwargs = db_spec_kwargs
+        self.feat_scale_kwargs = feat_scale_kwargs
+        self.window_norm_kwargs = window_norm_kwargs
+        spec_kwargs = dict(dict(frame_length_ms=25, frame_step_ms=10, power=2.0, fmin=0.0, fmax=8000.0, fft_length=512), **spec_kwargs)
+        self.frame_length = int(audio_features.ms_to_frames(sample_rate, spec_kwargs["frame_length_ms"]))
+        self.frame_step = int(audio_features.ms_to_frames(sample_rate, spec_kwargs["frame_step_ms"]))
+        self.fft_length = spec_kwargs["fft_length"]
+        self.power = spec_kwargs["power"]
+        self.window = tf.signal.hann_window(self.frame_length)
+        # The band [fmin, fmax] is a contiguous range of fft bins, which can be sliced instead of masked
+        fft_freqs = audio_features.fft_frequencies(sample_rate=sample_rate, n_fft=self.fft_length).numpy()
+        bins_in_band = np.flatnonzero((spec_kwargs["fmin"] <= fft_freqs) & (fft_freqs <= spec_kwargs["fmax"]))
+        self.band_begin = int(bins_in_band[0]) if bins_in_band.size else 0
+        self.band_end = int(bins_in_band[-1]) + 1 if bins_in_band.size else 0
+        self.mel_weights = None
+        self.dct_matrix = None
+        if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            melspec_kwargs = dict(dict(num_mel_bins=40, fmin=60.0, fmax=6000.0), **melspec_kwargs)
+            # Same as in audio_features.melspectrograms, which assumes the band limited spectrogram bins span the whole frequency range.
+            # Computed in a graph from tensors, since eager computation with Python numbers gives slightly different weights.
+            self.mel_weights = tf.function(tf.signal.linear_to_mel_weight_matrix)(
+                num_mel_bins=melspec_kwargs["num_mel_bins"],
+                num_spectrogram_bins=tf.constant(self.band_end - self.band_begin),
+                sample_rate=tf.constant(sample_rate),
+                lower_edge_hertz=melspec_kwargs["fmin"],
+                upper_edge_hertz=melspec_kwargs["fmax"])
+            if feattype == "mfcc":
+                # Same as tf.signal.mfccs_from_log_mel_spectrograms, i.e. unnormalized DCT-II scaled by 1/sqrt(2 * num_mel_bins)
+                num_mel_bins = melspec_kwargs["num_mel_bins"]
+                coef_begin = mfcc_kwargs.get("coef_begin", 1)
+                coef_end = mfcc_kwargs.get("coef_end", 13)
+                n = np.arange(num_mel_bins)[:,None]
+                k = np.arange(num_mel_bins)[None,coef_begin:coef_end]
+                dct = 2.0 * np.cos(np.pi * k * (2 * n + 1) / (2 * num_mel_bins)) / np.sqrt(2.0 * num_mel_bins)
+                self.dct_matrix = tf.constant(dct, tf.float32)
+
+    @tf.function
+    def __call__(self, signals, sample_rates, signal_lengths=None):
+        tf.debugging.assert_rank(signals, 2, message="Input signals for feature extraction must be batches of mono signals without channels, i.e. of shape [B, N] where B is batch size and N number of samples.")
+        tf.debugging.assert_equal(sample_rates, self.sample_rate, message="Feature extractor was created for a different sample rate than the signals have.")
+        signals = audio_features.signal_as_float32(signals)
+        num_frames = None
+        if signal_lengths is not None:
+            num_frames = num_feature_frames(signal_lengths, self.sample_rate, self.spec_kwargs)
+        frames = tf.signal.frame(signals, self.frame_length, self.frame_step, axis=1)
+        S = tf.signal.rfft(frames * self.window, [self.fft_length])[..., self.band_begin:self.band_end]
+        if self.power == 2.0:
+            X = tf.math.square(tf.math.abs(S))
+        else:
+            X = tf.math.pow(tf.math.abs(S), self.power)
+        if self.mel_weights is not None:
+            X = tf.matmul(X, self.mel_weights)
+            if self.feattype in ("logmelspectrogram", "mfcc"):
+                X = tf.math.log(X + 1e-6)
+                if self.dct_matrix is not None:
+                    X = tf.matmul(X, self.dct_matrix)
+        elif self.feattype == "db_spectrogram":
+            X = audio_features.power_to_db(X, lengths=num_frames, **self.db_spec_kwargs)
+        if self.feat_scale_kwargs:
+            X = features.feature_scaling(X, lengths=num_frames, **self.feat_scale_kwargs)
+        if self.window_norm_kwargs:
+            X = features.window_normalization(X, lengths=num_frames, **self.window_norm_kwargs)
+        tf.debugging.assert_all_finite(X, "feature extraction failed")
+        return X
+
+
 #TODO
 # for conf in augment_config:
 #     # prepare noise augmentation
@@ -2,20 +2,41 @@ import tensorflow as tf
 
 
 @tf.function
-def feature_scaling(X, min, max, axis=None):
-    """Apply feature scaling on X over given axis such that all values are between [min, max]"""
+def feature_scaling(X, min, max, axis=None, lengths=None):
+    """
+    Apply feature scaling on X over given axis such that all values are between [min, max]
+    If X is a zero padded batch of shape (batch_size, timedim, channels), the amount of valid frames of each features matrix can be given in 'lengths'.
+    Then the padding does not affect the scaling and each matrix is scaled separately, axis None meaning all valid frames and channels of the matrix.
+    """
+    if lengths is not None:
+        return _masked_feature_scaling(X, min, max, axis, lengths)
     X_min = tf.math.reduce_min(X, axis=axis, keepdims=True)
     X_max = tf.math.reduce_max(X, axis=axis, keepdims=True)
     return min + (max - min) * tf.math.divide_no_nan(X - X_min, X_max - X_min)
 
 
+def _masked_feature_scaling(X, min, max, axis, lengths):
+    tf.debugging.assert_rank(X, 3, message="Input to feature_scaling with lengths should be of shape (batch_size, timedim, channels)")
+    if axis is None:
+        axis = [1, 2]
+    mask = tf.expand_dims(tf.sequence_mask(lengths, tf.shape(X)[1]), 2)
+    X_min = tf.math.reduce_min(tf.where(mask, X, tf.constant(X.dtype.max, X.dtype)), axis=axis, keepdims=True)
+    X_max = tf.math.reduce_max(tf.where(mask, X, tf.constant(X.dtype.min, X.dtype)), axis=axis, keepdims=True)
+    output = min + (max - min) * tf.math.divide_no_nan(X - X_min, X_max - X_min)
+    return tf.where(mask, output, tf.zeros_like(output))
+
+
 @tf.function
-def window_normalization(X, window_len=-1, normalize_variance=True):
+def window_normalization(X, window_len=-1, normalize_variance=True, lengths=None):
     """
     Apply mean and variance normalization on batches of features matrices X with a given window length.
     By default normalize over whole tensor, i.e. wihtout a window.
+    If X is a zero padded batch, the amount of valid frames of each features matrix can be given in 'lengths'.
+    Then the padding does not affect the statistics and the valid frames are normalized as if each matrix was normalized separately.
     """
     tf.debugging.assert_rank(X, 3, message="Input to window_normalization should be of shape (batch_size, timedim, channels)")
+    if lengths is not None:
+        return _masked_window_normalization(X, window_len, normalize_variance, lengths)
     output = tf.identity(X)
     if window_len == -1 or tf.shape(X)[1] <= window_len:
         # All frames of X fit inside one window, no need for sliding window
@@ -28,14 +49,140 @@ def window_normalization(X, window_len=-1, normalize_variance=True):
         # 2, 1, 0, [ 0, 1, 2, ..., N-3, N-2, N-1 ] N-1, N-2, N-3, ...
         padding = tf.constant([[0, 0], [window_len//2, window_len//2 - 1 + (window_len&1)], [0, 0]])
         X_padded = tf.pad(X, padding, mode="REFLECT")
-        windows = tf.signal.frame(X_padded, window_len, 1, axis=1)
-        tf.debugging.assert_equal(tf.shape(windows)[1], tf.shape(X)[1], message="Mismatching amount of output windows and time steps in the input")
-        output = X - tf.math.reduce_mean(windows, axis=2)
+        mean, std = sliding_window_mean_std(X_padded, window_len)
+        tf.debugging.assert_equal(tf.shape(mean)[1], tf.shape(X)[1], message="Mismatching amount of output windows and time steps in the input")
+        output = X - mean
         if normalize_variance:
-            output = tf.math.divide_no_nan(output, tf.math.reduce_std(windows, axis=2))
+            output = tf.math.divide_no_nan(output, std)
     return output
 
 
+@tf.function
+def sliding_window_mean_std(X, window_len):
+    """
+    Mean and standard deviation over all windows of length 'window_len' with step 1 along the time axis of X of shape (batch_size, timedim, channels), without materializing the windows.
+    Computed from cumulative sums in float64, which takes O(timedim * channels) time and memory regardless of 'window_len'.
+    Returns two tensors of shape (batch_size, timedim - window_len + 1, channels).
+    """
+    X64 = tf.cast(X, tf.float64)
+    zeros = tf.zeros_like(X64[:,:1])
+    sums = tf.concat((zeros, tf.math.cumsum(X64, axis=1)), axis=1)
+    square_sums = tf.concat((zeros, tf.math.cumsum(tf.math.square(X64), axis=1)), axis=1)
+    n = tf.cast(window_len, tf.float64)
+    mean = (sums[:,window_len:] - sums[:,:-window_len]) / n
+    variance = tf.math.maximum(tf.constant(0.0, tf.float64), (square_sums[:,window_len:] - square_sums[:,:-window_len]) / n - tf.math.square(mean))
+    return tf.cast(mean, X.dtype), tf.cast(tf.math.sqrt(variance), X.dtype)
+
+
+def _masked_window_normalization(X, window_len, normalize_variance, lengths):
+    lengths = tf.cast(lengths, tf.int32)
+    num_frames = tf.shape(X)[1]
+    mask = tf.expand_dims(tf.sequence_mask(lengths, num_frames, X.dtype), 2)
+    # Normalization over all valid frames
+    num_valid = tf.math.maximum(1.0, tf.cast(tf.reshape(lengths, [-1, 1, 1]), X.dtype))
+    mean = tf.math.reduce_sum(mask * X, axis=1, keepdims=True) / num_valid
+    output = X - mean
+    if normalize_variance:
+        std = tf.math.sqrt(tf.math.reduce_sum(mask * tf.math.square(output), axis=1, keepdims=True) / num_valid)
+        output = tf.math.divide_no_nan(output, std)
+    if window_len != -1 and num_frames > window_len:
+        # Same reflect padding as in window_normalization, but from the last valid frame of each matrix
+        left = window_len // 2
+        right = window_len // 2 - 1 + (window_len & 1)
+        indexes = tf.expand_dims(tf.range(-left, num_frames + right), 0)
+        last = tf.expand_dims(lengths - 1, 1)
+        indexes = tf.math.abs(indexes)
+        indexes = tf.where(indexes > last, 2 * last - indexes, indexes)
+        # Matrices shorter than the window are normalized over all frames, their indexes are never used
+        indexes = tf.clip_by_value(indexes, 0, tf.math.maximum(0, last))
+        X_padded = tf.gather(X, indexes, axis=1, batch_dims=1)
+        window_mean, window_std = sliding_window_mean_std(X_padded, window_len)
+        windowed_output = X - window_mean
+        if normalize_variance:
+            windowed_output = tf.math.divide_no_nan(windowed_output, window_std)
+        use_window = tf.reshape(lengths > window_len, [-1, 1, 1])
+        output = tf.where(use_window, windowed_output, output)
+    return mask * output
+
+
+def _random_intervals_mask(max_width, num_intervals, lengths, maxlen):
+    # Boolean mask of shape (batch_size, maxlen) that is True inside 'num_intervals' random intervals of width [0, max_width] that are within 'lengths'
+    batch_size = tf.size(lengths)
+    widths = tf.random.uniform([batch_size, num_intervals], 0, max_width + 1, tf.int32)
+    widths = tf.math.minimum(widths, tf.expand_dims(lengths, 1))
+    max_begin = tf.cast(tf.expand_dims(lengths, 1) - widths + 1, tf.float32)
+    begins = tf.cast(tf.random.uniform([batch_size, num_intervals]) * max_begin, tf.int32)
+    positions = tf.reshape(tf.range(maxlen), [1, 1, -1])
+    in_interval = tf.math.logical_and(
+            positions >= tf.expand_dims(begins, 2),
+            positions < tf.expand_dims(begins + widths, 2))
+    return tf.math.reduce_any(in_interval, axis=1)
+
+
+@tf.function
+def random_time_frequency_masks(X, lengths=None, max_time_mask_len=0, num_time_masks=0, max_frequency_mask_len=0, num_frequency_masks=0):
+    """
+    SpecAugment time and frequency masking on a batch of features matrices X of shape (batch_size, timedim, channels).
+    Every matrix gets 'num_time_masks' random blocks of at most 'max_time_mask_len' consecutive frames and 'num_frequency_masks' random blocks of at most 'max_frequency_mask_len' consecutive channels set to zero, i.e. to the mean of mean normalized features.
+    If X is a zero padded batch, the amount of valid frames of each matrix can be given in 'lengths' and time masks are drawn only from the valid frames.
+    """
+    tf.debugging.assert_rank(X, 3, message="Input to random_time_frequency_masks should be of shape (batch_size, timedim, channels)")
+    batch_size, num_frames, num_channels = tf.shape(X)[0], tf.shape(X)[1], tf.shape(X)[2]
+    if lengths is None:
+        lengths = tf.fill([batch_size], num_frames)
+    lengths = tf.cast(lengths, tf.int32)
+    keep = tf.ones_like(X, dtype=tf.bool)
+    if num_time_masks > 0 and max_time_mask_len > 0:
+        time_mask = _random_intervals_mask(max_time_mask_len, num_time_masks, lengths, num_frames)
+        keep = tf.math.logical_and(keep, tf.expand_dims(tf.math.logical_not(time_mask), 2))
+    if num_frequency_masks > 0 and max_frequency_mask_len > 0:
+        frequency_mask = _random_intervals_mask(max_frequency_mask_len, num_frequency_masks, tf.fill([batch_size], num_channels), num_channels)
+        keep = tf.math.logical_and(keep, tf.expand_dims(tf.math.logical_not(frequency_mask), 1))
+    return tf.where(keep, X, tf.zeros_like(X))
+
+
+@tf.function
+def random_time_warp(X, max_warp, lengths=None):
+    """
+    SpecAugment time warping on a batch of features matrices X of shape (batch_size, timedim, channels).
+    For every matrix, a random frame from the interval [max_warp, length - max_warp) is moved by a random amount of at most 'max_warp' frames to the left or right and the frames on both sides are linearly interpolated to fill the gaps, without changing the length of the matrix.
+    Matrices with at most 2 * 'max_warp' valid frames are not modified.
+    If X is a zero padded batch, the amount of valid frames of each matrix can be given in 'lengths', then only the valid frames are warped.
+    """
+    tf.debugging.assert_rank(X, 3, message="Input to random_time_warp should be of shape (batch_size, timedim, channels)")
+    batch_size, num_frames = tf.shape(X)[0], tf.shape(X)[1]
+    if lengths is None:
+        lengths = tf.fill([batch_size], num_frames)
+    lengths = tf.cast(lengths, tf.int32)
+    can_warp = lengths > 2 * max_warp
+    # Warp center and its new position, drawn in float to allow different lengths in the batch
+    center = max_warp + tf.cast(tf.random.uniform([batch_size]) * tf.cast(tf.math.maximum(1, lengths - 2 * max_warp), tf.float32), tf.int32)
+    warped_center = center + tf.random.uniform([batch_size], -max_warp, max_warp + 1, tf.int32)
+    center = tf.where(can_warp, center, 0)
+    warped_center = tf.where(can_warp, warped_center, 0)
+    # Source position of every output frame, the left side of the warped center is scaled by c/w and the right side by (N-c)/(N-w)
+    c = tf.expand_dims(tf.cast(center, tf.float32), 1)
+    w = tf.expand_dims(tf.cast(warped_center, tf.float32), 1)
+    n = tf.expand_dims(tf.cast(lengths, tf.float32), 1)
+    t = tf.expand_dims(tf.cast(tf.range(num_frames), tf.float32), 0)
+    source = tf.where(
+            t < w,
+            t * tf.math.divide_no_nan(c, w),
+            c + (t - w) * tf.math.divide_no_nan(n - c, n - w))
+    source = tf.clip_by_value(source, 0.0, tf.math.maximum(0.0, n - 1))
+    left = tf.math.floor(source)
+    right_weight = tf.expand_dims(tf.cast(source - left, X.dtype), 2)
+    left = tf.cast(left, tf.int32)
+    right = tf.math.minimum(left + 1, tf.math.maximum(0, tf.expand_dims(lengths, 1) - 1))
+    warped = ((1 - right_weight) * tf.gather(X, left, axis=1, batch_dims=1)
+              + right_weight * tf.gather(X, right, axis=1, batch_dims=1))
+    # Keep padding and matrices that were too short as they were
+    is_valid = tf.math.logical_and(
+            tf.reshape(can_warp, [-1, 1, 1]),
+            tf.expand_dims(tf.sequence_mask(lengths, num_frames), 2))
+    return tf.where(is_valid, warped, X)
+
+
 # Window normalization without padding
 # NOTE tensorflow 2.1 does not support non-zero axes in tf.gather when indices are ragged so this was left out
 # @tf.function
@@ -4,7 +4,9 @@ Some functions are simply one-to-one TensorFlow math conversions from https://gi
 """
 import numpy as np
 import tensorflow as tf
-import webrtcvad
+
+import lidbox.vad
+import lidbox.wavfile as wavfile
 
 
 @tf.function
@@ -20,9 +22,19 @@ def log10(x):
     return tf.math.log(x) / tf.math.log(10.0)
 
 @tf.function
-def power_to_db(S, ref=tf.math.reduce_max, amin=1e-10, top_db=80.0):
-    db_spectrogram = 20.0 * (log10(tf.math.maximum(amin, S)) - log10(tf.math.maximum(amin, ref(S))))
-    return tf.math.maximum(db_spectrogram, tf.math.reduce_max(db_spectrogram) - top_db)
+def power_to_db(S, ref=tf.math.reduce_max, amin=1e-10, top_db=80.0, lengths=None):
+    """
+    Convert power spectrograms 'S' to decibels relative to 'ref(S)', clipped to at most 'top_db' below the maximum.
+    If 'lengths' is given, 'S' is a batch of zero padded spectrograms of shape (batch_size, num_frames, num_bins) and the reference and the maximum are taken separately for each spectrogram over its first 'lengths' frames, instead of using 'ref'.
+    """
+    if lengths is None:
+        db_spectrogram = 20.0 * (log10(tf.math.maximum(amin, S)) - log10(tf.math.maximum(amin, ref(S))))
+        return tf.math.maximum(db_spectrogram, tf.math.reduce_max(db_spectrogram) - top_db)
+    is_valid = tf.expand_dims(tf.sequence_mask(lengths, tf.shape(S)[1]), 2)
+    S_max = tf.math.reduce_max(tf.where(is_valid, S, 0.0), axis=[1, 2], keepdims=True)
+    db_spectrogram = 20.0 * (log10(tf.math.maximum(amin, S)) - log10(tf.math.maximum(amin, S_max)))
+    db_max = tf.math.reduce_max(tf.where(is_valid, db_spectrogram, 20.0 * log10(amin)), axis=[1, 2], keepdims=True)
+    return tf.math.maximum(db_spectrogram, db_max - top_db)
 
 @tf.function
 def ms_to_frames(sample_rate, ms):
@@ -60,19 +72,28 @@ def root_mean_square(x, axis=-1):
                 axis=axis))
 
 @tf.function
-def framewise_rms_energy_vad_decisions(signals, sample_rate, frame_length_ms=25, frame_step_ms=10, strength=0.5, min_rms_threshold=1e-3):
+def framewise_rms_energy_vad_decisions(signals, sample_rate, frame_length_ms=25, frame_step_ms=10, strength=0.5, min_rms_threshold=1e-3, lengths=None):
     """
     For a batch of 1D-signals, compute energy based frame-wise VAD decisions by comparing the RMS value of each frame to the mean RMS of the whole signal (separately for each signal), such that True means the frame is voiced and False unvoiced.
     VAD threshold is 'strength' multiplied by mean RMS, i.e. larger 'strength' values increase VAD aggressiveness.
+    If the signals have been zero padded, their original 'lengths' can be given to exclude the padding from the mean RMS, frames that contain only padding are marked unvoiced.
     """
     tf.debugging.assert_rank(signals, 2, message="energy_vad_decisions expects batches of single channel signals")
     frame_length = ms_to_frames(sample_rate, frame_length_ms)
     frame_step = ms_to_frames(sample_rate, frame_step_ms)
     frames = tf.signal.frame(signals, frame_length, frame_step, axis=1)
     rms = root_mean_square(frames, axis=2)
-    mean_rms = tf.math.reduce_mean(rms, axis=1, keepdims=True)
+    if lengths is None:
+        mean_rms = tf.math.reduce_mean(rms, axis=1, keepdims=True)
+        is_valid = tf.ones_like(rms, tf.bool)
+    else:
+        num_frames = tf.math.maximum(0, 1 + (tf.cast(lengths, tf.int32) - frame_length) // frame_step)
+        is_valid = tf.sequence_mask(num_frames, tf.shape(rms)[1])
+        valid_rms = tf.where(is_valid, rms, tf.zeros_like(rms))
+        mean_rms = (tf.math.reduce_sum(valid_rms, axis=1, keepdims=True)
+                    / tf.cast(tf.math.maximum(1, tf.expand_dims(num_frames, 1)), rms.dtype))
     threshold = strength * tf.math.maximum(min_rms_threshold, mean_rms)
-    return rms > threshold
+    return tf.math.logical_and(is_valid, rms > threshold)
 
 # # similar to kaldi mfcc vad but without a context window (for now):
 # # https://github.com/kaldi-asr/kaldi/blob/8ce3a95761e0eb97d95d3db2fcb6b2bfb7ffec5b/src/ivector/voice-activity-detection.cc
@@ -105,6 +126,97 @@ def read_wav(path):
         sample_rate = wav.sample_rate
     return signal, sample_rate
 
+@tf.function
+def read_wav_int16(path):
+    """
+    Same as read_wav, but returns the signal as 16-bit PCM samples without converting them to floats.
+    Only the RIFF chunks needed for finding the sample data are parsed.
+    Fails if the samples are not 16-bit PCM, like tf.audio.decode_wav.
+    """
+    file_contents = tf.io.read_file(path)
+    file_size = tf.strings.length(file_contents)
+    num_channels = tf.constant(1, tf.int32)
+    sample_rate = tf.constant(0, tf.int32)
+    audio_format = tf.constant(1, tf.int32)
+    bits_per_sample = tf.constant(16, tf.int32)
+    data_begin = tf.constant(-1, tf.int32)
+    data_size = tf.constant(0, tf.int32)
+    # Iterate over all chunks after the 12 byte RIFF header until the data chunk is found
+    pos = tf.constant(12, tf.int32)
+    while pos + 8 <= file_size and data_begin < 0:
+        chunk_id = tf.strings.substr(file_contents, pos, 4)
+        chunk_size = tf.io.decode_raw(tf.strings.substr(file_contents, pos + 4, 4), tf.int32)[0]
+        if chunk_size < 0:
+            # Streamed WAV files might have a placeholder size 0xFFFFFFFF
+            chunk_size = file_size - pos - 8
+        if chunk_id == "fmt ":
+            num_channels = tf.cast(tf.io.decode_raw(tf.strings.substr(file_contents, pos + 10, 2), tf.uint16)[0], tf.int32)
+            sample_rate = tf.io.decode_raw(tf.strings.substr(file_contents, pos + 12, 4), tf.int32)[0]
+            audio_format = tf.cast(tf.io.decode_raw(tf.strings.substr(file_contents, pos + 8, 2), tf.uint16)[0], tf.int32)
+            bits_per_sample = tf.cast(tf.io.decode_raw(tf.strings.substr(file_contents, pos + 22, 2), tf.uint16)[0], tf.int32)
+            if audio_format == 0xFFFE and chunk_size >= 40:
+                # WAVE_FORMAT_EXTENSIBLE, the format code is in the first 2 bytes of the sub format GUID
+                audio_format = tf.cast(tf.io.decode_raw(tf.strings.substr(file_contents, pos + 32, 2), tf.uint16)[0], tf.int32)
+        elif chunk_id == "data":
+            data_begin = pos + 8
+            data_size = tf.math.minimum(chunk_size, file_size - data_begin)
+        pos += 8 + chunk_size + chunk_size % 2
+    if data_begin < 0 or sample_rate == 0:
+        # No PCM data, this cannot be a wav file
+        signal = tf.zeros([0], tf.int16)
+        sample_rate = 0
+    else:
+        tf.debugging.assert_equal(audio_format, 1, message="Unsupported WAV audio format, only PCM is supported")
+        tf.debugging.assert_equal(bits_per_sample, 16, message="Unsupported WAV sample size, only 16-bit PCM is supported")
+        frame_size = 2 * num_channels
+        pcm_data = tf.strings.substr(file_contents, data_begin, data_size - data_size % frame_size)
+        frames = tf.reshape(tf.io.decode_raw(pcm_data, tf.int16), [-1, num_channels])
+        if num_channels == 1:
+            signal = frames[:,0]
+        else:
+            # Merge channels by averaging
+            signal = tf.cast(tf.math.round(tf.math.reduce_mean(tf.cast(frames, tf.float32), axis=1)), tf.int16)
+    return signal, sample_rate
+
+@tf.function
+def int16_to_float32(signal):
+    """Scale 16-bit PCM samples between [-1, 1) like tf.audio.decode_wav."""
+    return tf.cast(signal, tf.float32) / 32768.0
+
+@tf.function
+def float32_to_int16(signal):
+    """Inverse of int16_to_float32, samples outside [-1, 1) are clipped."""
+    return tf.cast(tf.clip_by_value(tf.math.round(32768.0 * signal), -32768.0, 32767.0), tf.int16)
+
+def signal_as_float32(signal):
+    """Convert 'signal' to float32 if it contains 16-bit PCM samples, else return it unchanged."""
+    if signal.dtype == tf.int16:
+        return int16_to_float32(signal)
+    return signal
+
+@tf.function
+def read_wav_segment(path, start_sec, end_sec, channel=-1):
+    """
+    Read only the samples between 'start_sec' and 'end_sec' from a 16-bit PCM WAV file, a negative 'end_sec' reads until the end of the file.
+    Only channel 'channel' is read, or if it is negative, channels are merged by averaging like in read_wav.
+    """
+    signal, sample_rate = tf.numpy_function(
+            wavfile.numpy_fn_read_wav_segment,
+            [path, start_sec, end_sec, channel],
+            (tf.float32, tf.int32))
+    return tf.reshape(signal, [-1]), tf.reshape(sample_rate, [])
+
+@tf.function
+def read_wav_segment_int16(path, start_sec, end_sec, channel=-1):
+    """
+    Same as read_wav_segment, but returns the signal as 16-bit PCM samples.
+    """
+    signal, sample_rate = tf.numpy_function(
+            wavfile.numpy_fn_read_wav_segment_int16,
+            [path, start_sec, end_sec, channel],
+            (tf.int16, tf.int32))
+    return tf.reshape(signal, [-1]), tf.reshape(sample_rate, [])
+
 @tf.function
 def write_mono_wav(path, signal, sample_rate):
     tf.debugging.assert_rank(signal, 1, "write_wav expects 1-dim mono signals without channel dims.")
@@ -126,22 +238,12 @@ def wav_to_pcm_data(signal, sample_rate):
 
 # Cannot be a tf.function due to external Python object webrtcvad.Vad
 def numpy_fn_get_webrtcvad_decisions(signal, sample_rate, pcm_data, vad_step, aggressiveness, min_non_speech_frames):
+    if signal.dtype == np.int16:
+        # Signal is already 16-bit PCM, no need for encoding
+        pcm_data = signal.astype("<i2").tobytes()
     assert 2 * signal.size == len(pcm_data), "signal length was {}, but pcm_data length was {}, when {} was expected (sample width 2)".format(signal.size, len(pcm_data), 2 * signal.size)
-    vad_decisions = np.ones(signal.size // vad_step, dtype=np.bool)
-    vad_step_bytes = 2 * vad_step
-    vad = webrtcvad.Vad(aggressiveness)
-    non_speech_begin = -1
-    for f, i in enumerate(range(0, len(pcm_data) - len(pcm_data) % vad_step_bytes, vad_step_bytes)):
-        if not vad.is_speech(pcm_data[i:i+vad_step_bytes], sample_rate):
-            vad_decisions[f] = False
-            if non_speech_begin < 0:
-                non_speech_begin = f
-        else:
-            if non_speech_begin >= 0 and f - non_speech_begin < min_non_speech_frames:
-                # too short non-speech segment, revert all non-speech decisions up to f
-                vad_decisions[np.arange(non_speech_begin, f)] = True
-            non_speech_begin = -1
-    return vad_decisions
+    pcm = np.frombuffer(pcm_data, dtype="<i2")
+    return lidbox.vad.webrtcvad_decisions(pcm, sample_rate, vad_step, aggressiveness, min_non_speech_frames)
 
 def numpy_snr_mixer(clean, noise, snr):
     """
@@ -165,21 +267,101 @@ def numpy_snr_mixer(clean, noise, snr):
     return clean, noisenewlevel, noisyspeech
 
 @tf.function
-def snr_mixer(clean, noise, snr):
+def snr_mixer(clean, noise, snr, lengths=None):
     """
     TensorFlow version of numpy_snr_mixer.
+    Also mixes batches of signals 'clean' and 'noise' of shape (batch_size, num_samples) with SNRs 'snr' of shape (batch_size,).
+    If 'lengths' of shape (batch_size,) is given, the signals are assumed to be zero padded after 'lengths' samples, the padding is excluded from the RMS levels and the noise is zeroed in the padding.
     """
-    tf.debugging.assert_equal(tf.size(clean), tf.size(noise), message="mismatching length for signals clean and noise given to snr mixer")
+    tf.debugging.assert_equal(tf.shape(clean), tf.shape(noise), message="mismatching length for signals clean and noise given to snr mixer")
+    if lengths is None:
+        rms = root_mean_square
+    else:
+        mask = tf.sequence_mask(lengths, tf.shape(clean)[-1], clean.dtype)
+        noise *= mask
+        num_valid = tf.math.maximum(1.0, tf.cast(lengths, clean.dtype))
+        def rms(x):
+            return tf.math.sqrt(tf.math.reduce_sum(tf.math.square(x), axis=-1) / num_valid)
     # Normalizing to -25 dB FS
-    scalarclean = tf.math.pow(10.0, -25.0/20.0) / root_mean_square(clean)
+    scalarclean = tf.math.pow(10.0, -25.0/20.0) / tf.expand_dims(rms(clean), -1)
     clean_norm = scalarclean * clean
-    rmsclean = root_mean_square(clean_norm)
-    scalarnoise = tf.math.pow(10.0, -25.0/20.0) / root_mean_square(noise)
+    rmsclean = tf.expand_dims(rms(clean_norm), -1)
+    scalarnoise = tf.math.pow(10.0, -25.0/20.0) / tf.expand_dims(rms(noise), -1)
     noise_norm = scalarnoise * noise
-    rmsnoise = root_mean_square(noise_norm)
+    rmsnoise = tf.expand_dims(rms(noise_norm), -1)
     # Set the noise level for a given SNR
-    level = tf.math.pow(10.0, snr / 20.0)
+    level = tf.math.pow(10.0, tf.expand_dims(snr, -1) / 20.0)
     noisescalar = tf.math.sqrt(rmsclean / level / rmsnoise)
     noisenewlevel = noisescalar * noise_norm
     noisyspeech = clean_norm + noisenewlevel
     return clean_norm, noisenewlevel, noisyspeech
+
+def polyphase_resampling_filters(ratio, zero_crossings=16, kaiser_beta=8.0, max_denominator=100):
+    """
+    Precompute a bank of Kaiser windowed sinc interpolation filters for resampling signals such that the length of the result is the length of the input divided by 'ratio'.
+    E.g. if ratio is 1.1, the resulting signal will be played 1.1 times faster with the same sample rate.
+    The ratio is approximated as a fraction down/up, with up <= 'max_denominator'.
+    Returns the filters in an array of shape (up, 2 * half_width), one filter for every phase of the output samples, and integers down, up, half_width.
+    """
+    from fractions import Fraction
+    fraction = Fraction(ratio).limit_denominator(max_denominator)
+    down, up = fraction.numerator, fraction.denominator
+    # Lowpass below the output Nyquist frequency when the signal is being decimated
+    cutoff = min(1.0, up / down)
+    half_width = int(np.ceil(zero_crossings / cutoff))
+    # Distance from each output sample to the input samples it depends on, for all phases
+    taps = np.arange(-half_width + 1, half_width + 1)
+    phases = np.arange(up) / up
+    t = taps[None,:] - phases[:,None]
+    window = np.kaiser(2 * half_width + 1, kaiser_beta)
+    window = np.interp(t, np.arange(-half_width, half_width + 1), window)
+    filters = cutoff * np.sinc(cutoff * t) * window
+    return filters.astype(np.float32), down, up, half_width
+
+def polyphase_conv_filters(filters, down, up):
+    """
+    Rearrange the filters from polyphase_resampling_filters into a conv1d kernel of shape (down - 1 + 2 * half_width + 1, 1, up).
+    Output sample n = k * up + j depends on the input samples starting from k * down, with the filter of phase (j * down) % up shifted by (j * down) // up samples.
+    Therefore all output samples can be computed with one conv1d with stride 'down' and 'up' output channels, which are then interleaved.
+    """
+    num_phases, num_taps = filters.shape
+    j = np.arange(up)
+    phases = (j * down) % up
+    shifts = (j * down) // up
+    kernel = np.zeros((shifts.max() + num_taps + 1, up), np.float32)
+    for out_channel, (phase, shift) in enumerate(zip(phases, shifts)):
+        kernel[shift+1:shift+1+num_taps, out_channel] = filters[phase]
+    return np.expand_dims(kernel, 1)
+
+@tf.function
+def polyphase_resample(signals, kernel, down, up, half_width):
+    """
+    Resample a batch of signals of shape [..., N] with a conv1d kernel from polyphase_conv_filters.
+    Returns signals of shape [..., N * up // down].
+    Computed as one strided convolution, which takes O(N * up / down) memory instead of materializing the filter inputs of every output sample.
+    """
+    signals_shape = tf.shape(signals)
+    num_samples = signals_shape[-1]
+    num_outputs = num_samples * up // down
+    # Amount of conv1d steps, each producing 'up' output samples
+    num_steps = (num_outputs + up - 1) // up
+    kernel_length = tf.shape(kernel)[0]
+    signals = tf.reshape(signals, [-1, num_samples])
+    right_pad = tf.math.maximum(half_width, (num_steps - 1) * down + kernel_length - num_samples - half_width)
+    padded = tf.pad(signals, [[0, 0], [half_width, right_pad]])
+    outputs = tf.nn.conv1d(tf.expand_dims(padded, 2), kernel, down, "VALID")[:,:num_steps]
+    outputs = tf.reshape(outputs, [tf.shape(signals)[0], -1])[:,:num_outputs]
+    return tf.reshape(outputs, tf.concat((signals_shape[:-1], [num_outputs]), axis=0))
+
+@tf.function
+def fft_convolve(signals, filters):
+    """
+    Convolve every signal in a batch of shape (batch_size, N) with the filter on the same row of 'filters' of shape (batch_size, L) by multiplying their spectra.
+    Returns the first N samples of every convolution, i.e. the outputs have the same shape as 'signals'.
+    """
+    signal_length = tf.shape(signals)[1]
+    full_length = signal_length + tf.shape(filters)[1] - 1
+    # Smallest power of two that holds the full convolution without circular wrap-around
+    fft_length = tf.bitwise.left_shift(1, tf.cast(tf.math.ceil(tf.math.log(tf.cast(full_length, tf.float64)) / np.log(2.0)), tf.int32))
+    spectra = tf.signal.rfft(signals, [fft_length]) * tf.signal.rfft(filters, [fft_length])
+    return tf.signal.irfft(spectra, [fft_length])[:,:signal_length]
@@ -0,0 +1,75 @@
+"""
+On demand reading of Kaldi matrices from memory-mapped ark files.
+Uncompressed binary float and double matrices are parsed directly from the memory-mapped ark file, all other formats (e.g. compressed matrices or scp entries with slices) are read with kaldiio.
+"""
+import re
+import threading
+
+import numpy as np
+
+
+# E.g. /path/to/feats.ark:1234
+ARK_KEY_PATTERN = re.compile(r"^(?P<path>.+):(?P<offset>\d+)$")
+MATRIX_DTYPES = {b"FM ": np.float32, b"DM ": np.float64}
+VECTOR_DTYPES = {b"FV ": np.float32, b"DV ": np.float64}
+
+
+class ArkReader:
+    """
+    Reads matrices from ark files at given byte offsets.
+    Every ark file is memory-mapped once and kept open, which makes this safe to be called from multiple threads, e.g. inside a parallel tf.data map.
+    """
+    def __init__(self):
+        self._arks = {}
+        self._lock = threading.Lock()
+
+    def _get_ark(self, path):
+        ark = self._arks.get(path)
+        if ark is None:
+            with self._lock:
+                if path not in self._arks:
+                    self._arks[path] = np.memmap(path, dtype=np.uint8, mode="r")
+                ark = self._arks[path]
+        return ark
+
+    def _read_int32(self, ark, pos):
+        assert ark[pos] == 4, "expected int32 size marker 4 in Kaldi binary header but got {}".format(ark[pos])
+        return int(np.frombuffer(ark, dtype="<i4", count=1, offset=pos+1)[0]), pos + 5
+
+    def read(self, ark_key):
+        """
+        Read the matrix or vector at 'ark_key' of the form path:offset, as written into Kaldi scp files.
+        """
+        match = ARK_KEY_PATTERN.match(ark_key)
+        if match is None:
+            return self._read_with_kaldiio(ark_key)
+        ark = self._get_ark(match.group("path"))
+        pos = int(match.group("offset"))
+        if ark[pos:pos+2].tobytes() != b"\0B":
+            return self._read_with_kaldiio(ark_key)
+        token = ark[pos+2:pos+5].tobytes()
+        pos += 5
+        if token in MATRIX_DTYPES:
+            dtype = np.dtype(MATRIX_DTYPES[token]).newbyteorder('<')
+            num_rows, pos = self._read_int32(ark, pos)
+            num_cols, pos = self._read_int32(ark, pos)
+            data = np.frombuffer(ark, dtype=dtype, count=num_rows*num_cols, offset=pos)
+            return data.reshape((num_rows, num_cols)).astype(np.float32)
+        if token in VECTOR_DTYPES:
+            dtype = np.dtype(VECTOR_DTYPES[token]).newbyteorder('<')
+            size, pos = self._read_int32(ark, pos)
+            return np.frombuffer(ark, dtype=dtype, count=size, offset=pos).astype(np.float32)
+        return self._read_with_kaldiio(ark_key)
+
+    def _read_with_kaldiio(self, ark_key):
+        from kaldiio import load_mat
+        return np.asarray(load_mat(ark_key), dtype=np.float32)
+
+
+_default_reader = ArkReader()
+
+# Usage:
+# features = tf.numpy_function(kaldi_ark.numpy_fn_read_matrix, [x["kaldi_ark_key"]], tf.float32)
+def numpy_fn_read_matrix(ark_key):
+    # Vectors are returned as matrices with one row, to always have rank 2 outputs
+    return np.atleast_2d(_default_reader.read(ark_key.decode("utf-8")))
@@ -0,0 +1,244 @@
+"""
+Compiled, memory-mappable metadata indexes of the utt2* metadata files of one dataset split.
+
+An index is a directory containing the utterance ids in sorted order and one column for every metadata file.
+Each column is stored as two numpy arrays: all values as UTF-8 bytes concatenated into one uint8 array and an int64 array of offsets into it, such that the value of row i is data[offsets[i]:offsets[i+1]].
+The index is rebuilt only if the size or modification time of some source file changes.
+"""
+import collections
+import json
+import logging
+import os
+import random
+
+import numpy as np
+
+import lidbox
+
+logger = logging.getLogger("metadata")
+
+INDEX_VERSION = 1
+MANIFEST_FILE = "index.json"
+# Relative to the split directory containing the utt2* files, used only if there is no index_directory or cache config
+DEFAULT_INDEX_DIRECTORY = ".lidbox-index"
+# Metadata with more than one value column, e.g. utt2seg lines are of the form 'utt_id file_id start end [channel]'
+NUM_COLUMNS = {"segment": 5}
+# Metadata key of a Kaldi wav.scp file, which maps file ids, not utterance ids, to paths
+FILE_PATH_KEY = "file_path"
+
+
+def iter_metadata_values(path, key):
+    """
+    Yield (utterance id, value) pairs from metadata file 'path' containing metadata 'key'.
+    Metadata with multiple value columns have all values joined by a space into one string.
+    """
+    for utt, *values in lidbox.iter_metadata_file(path, num_columns=NUM_COLUMNS.get(key, 2)):
+        yield utt, ' '.join(values)
+
+
+def iter_segment_paths(segment_path, file_path):
+    """
+    Yield (utterance id, path) pairs for every segment in the utt2seg file 'segment_path', with the path of the file id of the segment from the Kaldi wav.scp file 'file_path'.
+    Only wav.scp lines of the form 'file_id path' are supported, not commands.
+    """
+    file2path = dict(lidbox.iter_metadata_file(file_path, 2))
+    for utt, segment in iter_metadata_values(segment_path, "segment"):
+        file_id = segment.split(' ', 1)[0]
+        if file_id not in file2path:
+            raise ValueError("File id '{}' of segment '{}' in '{}' not found from '{}'".format(file_id, utt, segment_path, file_path))
+        yield utt, file2path[file_id]
+
+
+def load_metadata_files(meta_paths):
+    """
+    Read all metadata files in 'meta_paths', a dict of metadata key to file path, into ordered dicts of utterance id to value.
+    If there is a wav.scp file instead of utt2path, the path of every utterance is resolved from the file id of its utt2seg segment.
+    """
+    meta_paths = dict(meta_paths)
+    file_path = meta_paths.pop(FILE_PATH_KEY, None)
+    meta = {key: collections.OrderedDict(iter_metadata_values(path, key)) for key, path in meta_paths.items()}
+    if file_path is not None:
+        meta["path"] = collections.OrderedDict(iter_segment_paths(meta_paths["segment"], file_path))
+    return meta
+
+
+def _column_paths(directory, key):
+    return (os.path.join(directory, key + ".data.npy"),
+            os.path.join(directory, key + ".offsets.npy"))
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _write_column(directory, key, values):
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    data_path, offsets_path = _column_paths(directory, key)
+    np.save(data_path, data)
+    np.save(offsets_path, offsets)
+
+
+def is_up_to_date(directory, meta_paths):
+    """
+    Check that the index in 'directory' exists and was built from the files in 'meta_paths' in their current state.
+    """
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != INDEX_VERSION or set(manifest["sources"]) != set(meta_paths):
+        return False
+    return all(manifest["sources"][key] == _file_signature(path) for key, path in meta_paths.items())
+
+
+def build_index(directory, meta_paths):
+    """
+    Parse all metadata files in 'meta_paths', a dict of metadata key to file path, and write the index into 'directory'.
+    Utterance ids are defined by the 'path' key (utt2path) and every other file must contain exactly the same utterance ids.
+    If there is a wav.scp instead of utt2path, the paths are resolved from the utt2seg segments, see load_metadata_files.
+    """
+    if "path" not in meta_paths and not (FILE_PATH_KEY in meta_paths and "segment" in meta_paths):
+        raise ValueError("Cannot build a metadata index without an utt2path file or utt2seg and wav.scp files, got metadata keys: {}".format(', '.join(meta_paths)))
+    logger.info("Building metadata index into '%s' from %d files", directory, len(meta_paths))
+    meta = load_metadata_files(meta_paths)
+    utt_ids = sorted(meta["path"])
+    for key, utt2meta in meta.items():
+        if len(utt2meta) != len(utt_ids) or any(utt not in utt2meta for utt in utt_ids):
+            raise ValueError("Metadata file '{}' does not contain exactly the same utterance ids as utt2path '{}'".format(meta_paths.get(key), meta_paths.get("path", meta_paths.get("segment"))))
+    os.makedirs(directory, exist_ok=True)
+    # Remove the manifest first so that an interrupted build is never mistaken for a valid index
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    _write_column(directory, "id", utt_ids)
+    for key, utt2meta in meta.items():
+        _write_column(directory, key, [utt2meta[utt] for utt in utt_ids])
+    manifest = {
+        "version": INDEX_VERSION,
+        "num_utterances": len(utt_ids),
+        "columns": ["id"] + sorted(meta),
+        "sources": {key: _file_signature(path) for key, path in meta_paths.items()},
+    }
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    logger.info("Metadata index with %d utterances and columns %s written to '%s'", len(utt_ids), ', '.join(manifest["columns"]), directory)
+
+
+def update_index(directory, meta_paths):
+    """
+    Rebuild the index in 'directory' if it does not exist or if some of the source files have changed since it was built.
+    """
+    if is_up_to_date(directory, meta_paths):
+        logger.info("Metadata index in '%s' is up to date", directory)
+    else:
+        build_index(directory, meta_paths)
+    return directory
+
+
+class MetadataIndex:
+    """
+    Read-only view to a metadata index, all columns are memory-mapped and read only when accessed.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.directory = directory
+        self.num_utterances = manifest["num_utterances"]
+        self.columns = manifest["columns"]
+        self._arrays = {}
+
+    def __len__(self):
+        return self.num_utterances
+
+    def _column_arrays(self, key):
+        if key not in self._arrays:
+            if key not in self.columns:
+                raise KeyError("Metadata index '{}' has no column '{}'".format(self.directory, key))
+            data_path, offsets_path = _column_paths(self.directory, key)
+            self._arrays[key] = (np.load(data_path, mmap_mode="r"), np.load(offsets_path, mmap_mode="r"))
+        return self._arrays[key]
+
+    def get_bytes(self, key, rows):
+        """
+        Values of column 'key' at the given row indexes as an object array of bytes, e.g. for tf.numpy_function.
+        """
+        data, offsets = self._column_arrays(key)
+        begin = offsets[rows]
+        end = offsets[np.asarray(rows) + 1]
+        return np.array([data[b:e].tobytes() for b, e in zip(begin, end)], dtype=object)
+
+    def column(self, key):
+        """
+        All values of column 'key' as a list of strings.
+        """
+        data, offsets = self._column_arrays(key)
+        data = data.tobytes()
+        return [data[b:e].decode("utf-8") for b, e in zip(offsets[:-1], offsets[1:])]
+
+    def row_order(self, shuffle=False, limit=None, seed=None):
+        """
+        Row indexes in sorted utterance id order, or in a random order if 'shuffle' is True, truncated to 'limit' rows.
+        """
+        if shuffle:
+            rows = np.random.RandomState(seed).permutation(self.num_utterances)
+        else:
+            rows = np.arange(self.num_utterances)
+        return rows[:limit]
+
+
+def load_dataset_metadata(split, meta):
+    """
+    Load and validate all metadata of one dataset split and return it as a dict of lists, all in the same utterance order.
+    Without an index, the utterances are in the order of utt2path.
+    With an index, the utterances are in sorted utterance id order, since the index columns are stored in that order.
+    Returns None if the metadata is invalid.
+    This is a module level function so that it can be called in worker processes.
+    """
+    meta = dict(meta)
+    dataset = meta.pop("dataset")
+    kwargs = meta.pop("kwargs")
+    index_dir = meta.pop("index", None)
+    if index_dir is not None:
+        logger.info("Loading all metadata columns for dataset '%s' split '%s' from index '%s'", dataset, split, index_dir)
+        index = MetadataIndex(index_dir)
+        # All columns are in the same row order, no need for matching the utterance ids
+        utt_ids = index.column("id")
+        meta = {key: index.column(key) for key in index.columns if key != "id"}
+    else:
+        logger.info("Loading all metadata file contents for dataset '%s' split '%s'", dataset, split)
+        # Read all meta files
+        meta = load_metadata_files(meta)
+        # 'utt2path' is always present or resolved from segments, use it to select final utterance ids
+        utt_ids = list(meta["path"].keys())
+    logger.info("Amount of contents per file:\n  %s", '\n  '.join("{}: {}".format(key, len(val)) for key, val in meta.items()))
+    first_meta_length = len(list(meta.values())[0])
+    if not all(len(meta_list) == first_meta_length for meta_list in meta.values()):
+        logger.error("All metadata files must contain exactly the same amount of unique utterance ids")
+        return
+    rows = list(range(len(utt_ids)))
+    if kwargs.get("shuffle_files", False):
+        logger.info("'shuffle_files' given for dataset '%s' split '%s', shuffling all its utterance ids", dataset, split)
+        # Seed from the dataset and split keys so that the order does not depend on which process loads which dataset
+        random.Random("{}-{}-{}".format(lidbox.RANDOM_SEED, dataset, split)).shuffle(rows)
+    file_limit = kwargs.get("file_limit")
+    rows = rows[:file_limit]
+    logger.info("After applying file_limit %s, amount of final utterance ids that will be used is %d", file_limit, len(rows))
+    utt_ids = [utt_ids[i] for i in rows]
+    if index_dir is not None:
+        # Index columns are already lists in the row order, select rows only if the order changed
+        if rows != list(range(first_meta_length)):
+            meta = {key: [values[i] for i in rows] for key, values in meta.items()}
+    else:
+        # Filter all metadata with selected utterance ids to ensure correct order of metadata
+        # This step is very important in order to not have samples with wrong metadata
+        meta = {key: [utt2meta[utt] for utt in utt_ids] for key, utt2meta in meta.items()}
+    meta["id"] = utt_ids
+    meta["dataset"] = len(utt_ids) * [dataset]
+    if "kaldi_ark_key" in meta:
+        logger.info("Metadata contains 'kaldi_ark_key', Kaldi feature matrices can be read on demand with step 'load_kaldi_features'.")
+    logger.info("Dataset '%s' split '%s' done, all its elements will have keys:\n  %s", dataset, split, '\n  '.join(meta.keys()))
+    return meta
@@ -0,0 +1,239 @@
+"""
+Feature extraction with NumPy, computing the same features as lidbox.dataset.tf_utils.FeatureExtractor.
+Does not depend on TensorFlow, which makes it cheap to import in worker processes.
+Batches are processed in a pool of worker processes, which can be faster than the TensorFlow STFT on machines without GPUs.
+"""
+import json
+import threading
+
+import numpy as np
+
+import lidbox.system
+
+
+# Feature extractors of the current process by sample rate and config
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def ms_to_frames(sample_rate, ms):
+    # Same float32 arithmetic as lidbox.features.audio.ms_to_frames
+    return int(np.float32(sample_rate) * np.float32(1e-3) * np.float32(ms))
+
+
+def num_output_channels(feattype, melspec_kwargs, mfcc_kwargs):
+    """
+    Amount of feature dimensions of 'feattype' features or None if it depends on the sample rate.
+    """
+    if feattype == "mfcc":
+        return mfcc_kwargs.get("coef_end", 13) - mfcc_kwargs.get("coef_begin", 1)
+    if feattype in ("melspectrogram", "logmelspectrogram"):
+        return melspec_kwargs.get("num_mel_bins", 40)
+    return None
+
+
+def hann_window(frame_length):
+    # Same as tf.signal.hann_window with periodic=True
+    if frame_length == 1:
+        return np.ones(1, np.float32)
+    n = np.arange(frame_length, dtype=np.float32)
+    return np.float32(0.5) - np.float32(0.5) * np.cos(np.float32(2 * np.pi) * n / np.float32(frame_length))
+
+
+def hertz_to_mel(frequencies_hz):
+    return np.float32(1127.0) * np.log1p(frequencies_hz / np.float32(700.0))
+
+
+def linear_to_mel_weight_matrix(num_mel_bins, num_spectrogram_bins, sample_rate, lower_edge_hertz, upper_edge_hertz):
+    # Same as tf.signal.linear_to_mel_weight_matrix, computed in float32
+    nyquist_hertz = np.float32(sample_rate) / np.float32(2.0)
+    linear_frequencies = np.linspace(0, nyquist_hertz, num_spectrogram_bins, dtype=np.float32)[1:]
+    spectrogram_bins_mel = hertz_to_mel(linear_frequencies)[:,None]
+    band_edges_mel = np.linspace(
+            hertz_to_mel(np.float32(lower_edge_hertz)),
+            hertz_to_mel(np.float32(upper_edge_hertz)),
+            num_mel_bins + 2,
+            dtype=np.float32)
+    lower_edge_mel = band_edges_mel[None,:-2]
+    center_mel = band_edges_mel[None,1:-1]
+    upper_edge_mel = band_edges_mel[None,2:]
+    lower_slopes = (spectrogram_bins_mel - lower_edge_mel) / (center_mel - lower_edge_mel)
+    upper_slopes = (upper_edge_mel - spectrogram_bins_mel) / (upper_edge_mel - center_mel)
+    mel_weights = np.maximum(np.float32(0), np.minimum(lower_slopes, upper_slopes))
+    return np.pad(mel_weights, [[1, 0], [0, 0]])
+
+
+def frame(signals, frame_length, frame_step):
+    """
+    View to all frames of length 'frame_length' with step 'frame_step' of a batch of signals, like tf.signal.frame without padding.
+    """
+    num_frames = max(0, 1 + (signals.shape[1] - frame_length) // frame_step)
+    if num_frames == 0:
+        return np.zeros((signals.shape[0], 0, frame_length), signals.dtype)
+    # as_strided instead of sliding_window_view, which requires numpy 1.20
+    batch_stride, sample_stride = signals.strides
+    return np.lib.stride_tricks.as_strided(
+            signals,
+            shape=(signals.shape[0], num_frames, frame_length),
+            strides=(batch_stride, frame_step * sample_stride, sample_stride),
+            writeable=False)
+
+
+def power_to_db(S, amin=1e-10, top_db=80.0, lengths=None):
+    # Same as lidbox.features.audio.power_to_db with the default ref
+    amin = np.float32(amin)
+    if lengths is None:
+        db_spectrogram = np.float32(20.0) * (np.log10(np.maximum(amin, S)) - np.log10(np.maximum(amin, S.max(initial=amin))))
+        return np.maximum(db_spectrogram, db_spectrogram.max(initial=-np.inf) - np.float32(top_db))
+    is_valid = (np.arange(S.shape[1])[None,:] < np.asarray(lengths)[:,None])[:,:,None]
+    S_max = np.where(is_valid, S, np.float32(0)).max(axis=(1, 2), keepdims=True, initial=0)
+    db_spectrogram = np.float32(20.0) * (np.log10(np.maximum(amin, S)) - np.log10(np.maximum(amin, S_max)))
+    db_max = np.where(is_valid, db_spectrogram, np.float32(20.0) * np.log10(amin)).max(axis=(1, 2), keepdims=True, initial=-np.inf)
+    return np.maximum(db_spectrogram, db_max - np.float32(top_db))
+
+
+def feature_scaling(X, min, max, axis=None, lengths=None):
+    # Same as lidbox.features.feature_scaling
+    if lengths is not None:
+        if axis is None:
+            axis = (1, 2)
+        mask = (np.arange(X.shape[1])[None,:] < np.asarray(lengths)[:,None])[:,:,None]
+        X_min = np.where(mask, X, np.finfo(X.dtype).max).min(axis=axis, keepdims=True)
+        X_max = np.where(mask, X, np.finfo(X.dtype).min).max(axis=axis, keepdims=True)
+        return np.where(mask, min + (max - min) * _divide_no_nan(X - X_min, X_max - X_min), 0).astype(X.dtype)
+    X_min = X.min(axis=axis, keepdims=True)
+    X_max = X.max(axis=axis, keepdims=True)
+    return min + (max - min) * _divide_no_nan(X - X_min, X_max - X_min)
+
+
+def _divide_no_nan(x, y):
+    return np.divide(x, y, out=np.zeros(np.broadcast(x, y).shape, np.result_type(x, y)), where=(y != 0))
+
+
+def _normalize(X, window_len, normalize_variance):
+    # Mean and variance normalization of a single features matrix X, like lidbox.features.window_normalization
+    if window_len == -1 or X.shape[0] <= window_len:
+        mean = X.mean(axis=0, keepdims=True)
+        std = X.std(axis=0, keepdims=True)
+    else:
+        # Same reflect padding and cumulative sum statistics as lidbox.features.sliding_window_mean_std
+        X_padded = np.pad(X, [[window_len//2, window_len//2 - 1 + (window_len&1)], [0, 0]], mode="reflect").astype(np.float64)
+        sums = np.concatenate((np.zeros((1, X.shape[1])), np.cumsum(X_padded, axis=0)))
+        square_sums = np.concatenate((np.zeros((1, X.shape[1])), np.cumsum(np.square(X_padded), axis=0)))
+        mean = (sums[window_len:] - sums[:-window_len]) / window_len
+        std = np.sqrt(np.maximum(0, (square_sums[window_len:] - square_sums[:-window_len]) / window_len - np.square(mean)))
+        mean, std = mean.astype(X.dtype), std.astype(X.dtype)
+    output = X - mean
+    if normalize_variance:
+        output = _divide_no_nan(output, std)
+    return output
+
+
+def window_normalization(X, window_len=-1, normalize_variance=True, lengths=None):
+    """
+    Mean and variance normalization of a batch of features matrices, see lidbox.features.window_normalization.
+    """
+    if lengths is None:
+        lengths = np.full(X.shape[0], X.shape[1])
+    output = np.zeros_like(X)
+    for i, length in enumerate(lengths):
+        if length > 0:
+            output[i,:length] = _normalize(X[i,:length], window_len, normalize_variance)
+    return output
+
+
+class FeatureExtractor:
+    """
+    NumPy implementation of lidbox.dataset.tf_utils.FeatureExtractor, with the same arguments.
+    The outputs are equal to the TensorFlow implementation up to floating point rounding.
+    """
+    def __init__(self, sample_rate, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
+        self.sample_rate = sample_rate
+        self.feattype = feattype
+        self.db_spec_kwargs = db_spec_kwargs
+        self.feat_scale_kwargs = feat_scale_kwargs
+        self.window_norm_kwargs = window_norm_kwargs
+        spec_kwargs = dict(dict(frame_length_ms=25, frame_step_ms=10, power=2.0, fmin=0.0, fmax=8000.0, fft_length=512), **spec_kwargs)
+        self.frame_length = ms_to_frames(sample_rate, spec_kwargs["frame_length_ms"])
+        self.frame_step = ms_to_frames(sample_rate, spec_kwargs["frame_step_ms"])
+        self.fft_length = spec_kwargs["fft_length"]
+        self.power = spec_kwargs["power"]
+        self.window = hann_window(self.frame_length)
+        fft_freqs = np.linspace(0.0, np.float32(sample_rate // 2), 1 + self.fft_length // 2, dtype=np.float32)
+        bins_in_band = np.flatnonzero((spec_kwargs["fmin"] <= fft_freqs) & (fft_freqs <= spec_kwargs["fmax"]))
+        self.band_begin = int(bins_in_band[0]) if bins_in_band.size else 0
+        self.band_end = int(bins_in_band[-1]) + 1 if bins_in_band.size else 0
+        self.mel_weights = None
+        self.dct_matrix = None
+        if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            melspec_kwargs = dict(dict(num_mel_bins=40, fmin=60.0, fmax=6000.0), **melspec_kwargs)
+            self.mel_weights = linear_to_mel_weight_matrix(
+                    melspec_kwargs["num_mel_bins"],
+                    self.band_end - self.band_begin,
+                    sample_rate,
+                    melspec_kwargs["fmin"],
+                    melspec_kwargs["fmax"])
+            if feattype == "mfcc":
+                num_mel_bins = melspec_kwargs["num_mel_bins"]
+                n = np.arange(num_mel_bins)[:,None]
+                k = np.arange(num_mel_bins)[None,mfcc_kwargs.get("coef_begin", 1):mfcc_kwargs.get("coef_end", 13)]
+                self.dct_matrix = (2.0 * np.cos(np.pi * k * (2 * n + 1) / (2 * num_mel_bins)) / np.sqrt(2.0 * num_mel_bins)).astype(np.float32)
+
+    def num_frames(self, signal_lengths):
+        return np.maximum(0, 1 + (np.asarray(signal_lengths, np.int64) - self.frame_length) // self.frame_step)
+
+    def __call__(self, signals, signal_lengths=None):
+        if signals.dtype == np.int16:
+            signals = signals.astype(np.float32) / np.float32(32768.0)
+        frames = frame(signals.astype(np.float32, copy=False), self.frame_length, self.frame_step)
+        S = np.fft.rfft(frames * self.window, n=self.fft_length)[..., self.band_begin:self.band_end]
+        if self.power == 2.0:
+            X = np.square(np.abs(S))
+        else:
+            X = np.power(np.abs(S), np.float32(self.power))
+        X = X.astype(np.float32, copy=False)
+        lengths = None if signal_lengths is None else self.num_frames(signal_lengths)
+        if self.mel_weights is not None:
+            X = np.matmul(X, self.mel_weights)
+            if self.feattype in ("logmelspectrogram", "mfcc"):
+                X = np.log(X + np.float32(1e-6))
+                if self.dct_matrix is not None:
+                    X = np.matmul(X, self.dct_matrix)
+        elif self.feattype == "db_spectrogram":
+            X = power_to_db(X, lengths=lengths, **self.db_spec_kwargs)
+        if self.feat_scale_kwargs:
+            X = feature_scaling(X, lengths=lengths, **self.feat_scale_kwargs)
+        if self.window_norm_kwargs:
+            X = window_normalization(X, lengths=lengths, **self.window_norm_kwargs)
+        if not np.all(np.isfinite(X)):
+            raise ValueError("feature extraction failed, features contain non-finite values")
+        return X.astype(np.float32, copy=False)
+
+
+def get_extractor(sample_rate, config_json):
+    """
+    FeatureExtractor of the current process for 'sample_rate' and the JSON encoded list of FeatureExtractor arguments 'config_json'.
+    The extractor constants are computed only once in every process.
+    """
+    key = (sample_rate, config_json)
+    with _extractors_lock:
+        if key not in _extractors:
+            _extractors[key] = FeatureExtractor(sample_rate, *json.loads(config_json))
+        return _extractors[key]
+
+
+def extract_features(signals, signal_lengths, sample_rate, config_json):
+    return get_extractor(int(sample_rate), config_json)(signals, signal_lengths)
+
+
+# Usage:
+# features = tf.numpy_function(numpy_features.numpy_fn_extract_features, [signals, signal_lengths, sample_rate, config_json, num_workers], tf.float32)
+def numpy_fn_extract_features(signals, signal_lengths, sample_rate, config_json, num_workers):
+    """
+    Extract features from a batch of signals with the same sample rate in a worker process from a pool of 'num_workers' processes, or in the calling thread if 'num_workers' is 0.
+    If 'signal_lengths' is empty, all signals are assumed to have the length of the batch.
+    """
+    args = (signals, signal_lengths if signal_lengths.size else None, int(sample_rate), config_json.decode("utf-8"))
+    if num_workers > 0:
+        return lidbox.system.get_pool(int(num_workers)).apply(extract_features, args)
+    return extract_features(*args)
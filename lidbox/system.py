@@ -1,12 +1,38 @@
 """
 Misc. IO stuff.
 """
+import atexit
 import hashlib
+import multiprocessing
+import struct
 import subprocess
+import threading
+
+import lidbox.wavfile as wavfile
 
 
 SUBPROCESS_BATCH_SIZE = 5000
 
+# Shared worker process pools by amount of workers
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(num_workers):
+    """
+    Process pool with 'num_workers' processes, shared by all callers in the current process and kept open until exit.
+    The processes are spawned, not forked, since forking a process running TensorFlow is not safe.
+    Functions executed in the pool should be defined in modules that do not import TensorFlow, to keep the worker startup cheap.
+    """
+    with _pools_lock:
+        if num_workers not in _pools:
+            _pools[num_workers] = multiprocessing.get_context("spawn").Pool(num_workers)
+        return _pools[num_workers]
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.values():
+        pool.terminate()
+
 def run_command(cmd):
     process = subprocess.run(
         cmd.split(" "),
@@ -39,8 +65,9 @@ def read_arff_features(path, include_keys=None, exclude_keys=None, types=None):
 
 def get_audio_type(path):
     try:
-        return sox.file_info.file_type(path)
-    except sox.core.SoxiError:
+        wavfile.read_info(path)
+        return "wav"
+    except (OSError, wavfile.WavHeaderError, struct.error):
         return None
 
 def md5sum(path):
@@ -62,10 +89,9 @@ def iter_log_events(tf_event_file):
             value = event.summary.value[0]
             yield value.tag, value.simple_value
 
-def get_total_duration_sec(paths):
-    # Run SoXi for all files
-    soxi_cmd = "soxi -D -T"
-    seconds = sum(float(output) for output in run_for_files(soxi_cmd, paths))
+def get_total_duration_sec(paths, num_workers=None):
+    # Parse the duration from the WAV headers of all files, unreadable files have no duration
+    seconds = sum(info[2] for info in wavfile.scan_files(paths, num_workers) if info is not None)
     return round(seconds)
 
 def get_total_duration(paths):
@@ -0,0 +1,161 @@
+"""
+Batched voice activity detection with WebRTC VAD in worker processes.
+Does not depend on TensorFlow, which makes it cheap to import in the worker processes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import webrtcvad
+
+import lidbox.system
+
+
+# Open decision caches by path
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def float_to_pcm16(signal):
+    return np.clip(np.round(32768.0 * signal), -32768, 32767).astype(np.int16)
+
+
+def fill_short_non_speech(is_speech, min_non_speech_frames):
+    """
+    Mark as speech every run of non-speech frames shorter than 'min_non_speech_frames' that is followed by a speech frame.
+    Non-speech at the end of the signal is never filled.
+
+    >>> fill_short_non_speech(np.array([1, 0, 0, 1, 0, 0, 0, 1, 0], bool), 3).astype(int)
+    array([1, 1, 1, 1, 0, 0, 0, 1, 0])
+    """
+    is_speech = np.asarray(is_speech, dtype=bool)
+    if min_non_speech_frames <= 1 or is_speech.size == 0:
+        return is_speech
+    # Boundaries of all runs of equal decisions
+    change = np.flatnonzero(is_speech[1:] != is_speech[:-1]) + 1
+    run_begin = np.concatenate(([0], change))
+    run_end = np.concatenate((change, [is_speech.size]))
+    fill = (~is_speech[run_begin]
+            & (run_end - run_begin < min_non_speech_frames)
+            & (run_end < is_speech.size))
+    # Cumulative sum trick to mark all frames within the selected runs
+    marks = np.zeros(is_speech.size + 1, dtype=np.int32)
+    np.add.at(marks, run_begin[fill], 1)
+    np.add.at(marks, run_end[fill], -1)
+    return is_speech | (np.cumsum(marks[:-1]) > 0)
+
+
+def webrtcvad_decisions(pcm, sample_rate, frame_length, aggressiveness, min_non_speech_frames):
+    """
+    WebRTC VAD decisions for every non-overlapping frame of length 'frame_length' of the int16 signal 'pcm'.
+    Trailing samples that do not fill a whole frame are ignored.
+    """
+    # The VAD adapts to the signal it processes, a new VAD with initial state is needed for every utterance
+    vad = webrtcvad.Vad(int(aggressiveness))
+    frame_length = int(frame_length)
+    num_frames = pcm.size // frame_length
+    data = np.ascontiguousarray(pcm[:num_frames*frame_length], dtype="<i2").tobytes()
+    frame_bytes = 2 * frame_length
+    sample_rate = int(sample_rate)
+    is_speech = np.fromiter(
+            (vad.is_speech(data[i*frame_bytes:(i+1)*frame_bytes], sample_rate, frame_length) for i in range(num_frames)),
+            dtype=bool,
+            count=num_frames)
+    return fill_short_non_speech(is_speech, min_non_speech_frames)
+
+
+class DecisionCache:
+    """
+    Persistent store of VAD decisions in an SQLite database, indexed by a hash of the VAD parameters and the utterance id.
+    Decisions are stored bit-packed, i.e. 8 frames per byte.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS decisions ("
+                    "params TEXT NOT NULL, utt TEXT NOT NULL, num_frames INTEGER NOT NULL, bits BLOB NOT NULL, "
+                    "PRIMARY KEY (params, utt))")
+
+    @staticmethod
+    def params_key(**params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def get_many(self, params_key, utt_ids):
+        """
+        Return a dict of utterance id to decisions for all utterances in 'utt_ids' found from the cache.
+        """
+        found = {}
+        with self._lock:
+            # SQLite has a limit for the amount of bound parameters
+            for begin in range(0, len(utt_ids), 500):
+                batch = utt_ids[begin:begin+500]
+                rows = self._db.execute(
+                        "SELECT utt, num_frames, bits FROM decisions WHERE params = ? AND utt IN ({})".format(','.join('?' * len(batch))),
+                        [params_key] + batch)
+                for utt, num_frames, bits in rows:
+                    found[utt] = np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=num_frames).astype(bool)
+        return found
+
+    def put_many(self, params_key, utt2decisions):
+        with self._lock, self._db:
+            self._db.executemany(
+                    "INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?)",
+                    [(params_key, utt, d.size, np.packbits(d).tobytes()) for utt, d in utt2decisions.items()])
+
+
+def get_cache(path):
+    """
+    DecisionCache at 'path', shared by all callers in the current process.
+    """
+    with _caches_lock:
+        if path not in _caches:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            _caches[path] = DecisionCache(path)
+        return _caches[path]
+
+
+def batch_webrtcvad_decisions(signals, lengths, sample_rates, frame_lengths, aggressiveness, min_non_speech_frames, num_workers=0, utt_ids=None, cache_path=None, cache_params_key=None):
+    """
+    WebRTC VAD decisions for a zero padded batch of signals with given lengths, sample rates and VAD frame lengths.
+    If 'num_workers' is greater than 0, the utterances are processed in parallel in a shared pool of worker processes.
+    If 'cache_path' is given, decisions of the utterances 'utt_ids' are first looked up from a DecisionCache with 'cache_params_key' and only the missing decisions are computed and then added to the cache.
+    Returns a zero padded boolean array of shape (batch_size, max_num_frames).
+    """
+    if signals.dtype != np.int16:
+        signals = float_to_pcm16(signals)
+    cached = {}
+    if cache_path:
+        cache = get_cache(cache_path)
+        cached = cache.get_many(cache_params_key, utt_ids)
+    missing = [i for i in range(len(signals)) if not cache_path or utt_ids[i] not in cached]
+    tasks = [(signals[i,:lengths[i]], sample_rates[i], frame_lengths[i], aggressiveness, min_non_speech_frames) for i in missing]
+    if num_workers > 0 and len(tasks) > 1:
+        computed = lidbox.system.get_pool(num_workers).starmap(webrtcvad_decisions, tasks, chunksize=max(1, len(tasks) // (4 * num_workers)))
+    else:
+        computed = [webrtcvad_decisions(*task) for task in tasks]
+    if cache_path and computed:
+        cache.put_many(cache_params_key, {utt_ids[i]: d for i, d in zip(missing, computed)})
+    decisions = [cached[utt_ids[i]] if cache_path and utt_ids[i] in cached else None for i in range(len(signals))]
+    for i, d in zip(missing, computed):
+        decisions[i] = d
+    out = np.zeros((len(decisions), max((d.size for d in decisions), default=0)), dtype=bool)
+    for i, d in enumerate(decisions):
+        out[i,:d.size] = d
+    return out
+
+
+# Usage:
+# vad_decisions = tf.numpy_function(vad.numpy_fn_batch_webrtcvad_decisions, [signals, lengths, sample_rates, frame_lengths, aggressiveness, min_non_speech_frames, num_workers, utt_ids, cache_path, cache_params_key], tf.bool)
+def numpy_fn_batch_webrtcvad_decisions(signals, lengths, sample_rates, frame_lengths, aggressiveness, min_non_speech_frames, num_workers, utt_ids, cache_path, cache_params_key):
+    return batch_webrtcvad_decisions(
+            signals, lengths, sample_rates, frame_lengths,
+            int(aggressiveness), int(min_non_speech_frames), int(num_workers),
+            [utt.decode("utf-8") for utt in utt_ids],
+            cache_path.decode("utf-8"),
+            cache_params_key.decode("utf-8"))
@@ -0,0 +1,168 @@
+"""
+Reading WAV files by parsing only the RIFF headers, without decoding whole files.
+Does not depend on TensorFlow, which makes it cheap to use in worker processes.
+"""
+import collections
+import os
+import struct
+
+import numpy as np
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavInfo = collections.namedtuple("WavInfo", (
+    "sample_rate",
+    "num_channels",
+    "bits_per_sample",
+    "audio_format",
+    "data_offset",
+    "data_size",
+))
+
+
+class WavHeaderError(ValueError):
+    pass
+
+
+def read_header(f):
+    """
+    Parse the RIFF header of an opened binary WAV file 'f' and return a WavInfo.
+    The file position is left at an unspecified position.
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        raise WavHeaderError("not a RIFF WAVE file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"fmt ":
+            if chunk_size < 16:
+                raise WavHeaderError("too short fmt chunk of size {}".format(chunk_size))
+            audio_format, num_channels, sample_rate, _, _, bits_per_sample = struct.unpack("<HHIIHH", f.read(16))
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # First two bytes of the sub format GUID is the actual format code
+                f.seek(pos + 8 + 24)
+                audio_format = struct.unpack("<H", f.read(2))[0]
+            fmt = (sample_rate, num_channels, bits_per_sample, audio_format)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise WavHeaderError("data chunk before fmt chunk")
+            data_offset = pos + 8
+            # Streamed WAV files might have a placeholder or too large data chunk size
+            data_size = min(chunk_size, file_size - data_offset)
+            return WavInfo(*fmt, data_offset, data_size)
+        # Chunks are padded to even sizes
+        pos += 8 + chunk_size + (chunk_size & 1)
+    raise WavHeaderError("no data chunk")
+
+
+def read_info(path):
+    with open(path, "rb") as f:
+        return read_header(f)
+
+
+def num_frames(info):
+    return info.data_size // max(1, info.num_channels * info.bits_per_sample // 8)
+
+
+def duration_sec(info):
+    return num_frames(info) / info.sample_rate if info.sample_rate else 0.0
+
+
+def scan_file(path):
+    """
+    Return (sample_rate, num_channels, duration_sec) from the header of the WAV file at 'path' or None if the file cannot be read.
+    """
+    try:
+        info = read_info(path)
+    except (OSError, WavHeaderError, struct.error):
+        return None
+    return info.sample_rate, info.num_channels, duration_sec(info)
+
+
+def scan_files(paths, num_workers=None, chunksize=1000):
+    """
+    Yield scan_file(path) for every path in 'paths', in the same order, reading the headers in parallel with 'num_workers' processes.
+    The processes are taken from the shared spawned process pool lidbox.system.get_pool, since this can be called from a process running TensorFlow.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if num_workers < 2:
+        yield from map(scan_file, paths)
+        return
+    # lidbox.system imports this module
+    import lidbox.system
+    yield from lidbox.system.get_pool(num_workers).imap(scan_file, paths, chunksize=chunksize)
+
+
+def read_pcm16_segment(path, start_sec=0.0, end_sec=-1.0):
+    """
+    Read samples between 'start_sec' and 'end_sec' from a 16-bit PCM WAV file by seeking directly to the byte range, without reading the rest of the file.
+    A negative 'end_sec' means the end of the file.
+    Returns the int16 samples in an array of shape (frames, channels) and the sample rate.
+    """
+    with open(path, "rb") as f:
+        info = read_header(f)
+        if info.audio_format != WAVE_FORMAT_PCM or info.bits_per_sample != 16:
+            raise WavHeaderError("only 16-bit PCM is supported, but '{}' has format {} with {} bits per sample".format(path, info.audio_format, info.bits_per_sample))
+        frame_size = 2 * info.num_channels
+        total_frames = info.data_size // frame_size
+        begin = min(total_frames, max(0, int(round(start_sec * info.sample_rate))))
+        end = total_frames if end_sec < 0 else min(total_frames, max(begin, int(round(end_sec * info.sample_rate))))
+        f.seek(info.data_offset + begin * frame_size)
+        data = f.read((end - begin) * frame_size)
+    pcm = np.frombuffer(data, dtype="<i2")
+    return pcm.reshape((-1, info.num_channels)), info.sample_rate
+
+
+def select_channel(pcm, channel, path=''):
+    """
+    Keep only channel 'channel' of the samples 'pcm' of shape (frames, channels), or all channels if 'channel' is negative.
+    """
+    if channel < 0:
+        return pcm
+    if channel >= pcm.shape[1]:
+        raise ValueError("cannot select channel {} from '{}', which has {} channels".format(channel, path, pcm.shape[1]))
+    return pcm[:,channel:channel+1]
+
+
+# Usage:
+# signal, sample_rate = tf.numpy_function(wavfile.numpy_fn_read_wav_segment, [path, start_sec, end_sec, channel], (tf.float32, tf.int32))
+def numpy_fn_read_wav_segment(path, start_sec, end_sec, channel=-1):
+    """
+    Same as read_pcm16_segment but decodes the samples like tf.audio.decode_wav.
+    Only channel 'channel' is kept, or if it is negative, all channels are merged by averaging like in lidbox.features.audio.read_wav.
+    """
+    path = path.decode("utf-8")
+    pcm, sample_rate = read_pcm16_segment(path, float(start_sec), float(end_sec))
+    pcm = select_channel(pcm, int(channel), path)
+    signal = np.mean(pcm.astype(np.float32) / 32768.0, axis=1, dtype=np.float32)
+    return signal, np.int32(sample_rate)
+
+# Usage:
+# signal, sample_rate = tf.numpy_function(wavfile.numpy_fn_read_wav_segment_int16, [path, start_sec, end_sec, channel], (tf.int16, tf.int32))
+def numpy_fn_read_wav_segment_int16(path, start_sec, end_sec, channel=-1):
+    """
+    Same as numpy_fn_read_wav_segment but returns the 16-bit PCM samples without converting them to floats.
+    """
+    signal, sample_rate = read_mono_pcm16(path.decode("utf-8"), float(start_sec), float(end_sec), int(channel))
+    return signal, np.int32(sample_rate)
+
+
+def read_mono_pcm16(path, start_sec=0.0, end_sec=-1.0, channel=-1):
+    """
+    Same as read_pcm16_segment but returns int16 samples of shape (frames,).
+    Only channel 'channel' is kept, or if it is negative, all channels are merged by averaging.
+    """
+    pcm, sample_rate = read_pcm16_segment(path, start_sec, end_sec)
+    pcm = select_channel(pcm, channel, path)
+    if pcm.shape[1] == 1:
+        signal = pcm[:,0].astype(np.int16)
+    else:
+        signal = np.round(np.mean(pcm, axis=1)).astype(np.int16)
+    return signal, sample_rate
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+from lidbox.features import kaldi_ark
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+# Contents of tests/data/feats.ark
+EXPECTED = {
+    "float_matrix": np.arange(6, dtype=np.float32).reshape((3, 2)),
+    "double_matrix": 0.5 * np.arange(6, dtype=np.float32).reshape((2, 3)),
+    "float_vector": np.array([1, -2, 3, -4], np.float32),
+    "double_vector": np.array([0.25, 1e10], np.float32),
+}
+
+
+def iter_ark_keys():
+    with open(os.path.join(DATA_DIR, "feats.scp")) as f:
+        for line in f:
+            utt, ark_key = line.split()
+            yield utt, os.path.join(DATA_DIR, ark_key)
+
+
+@pytest.mark.parametrize("utt, ark_key", list(iter_ark_keys()))
+def test_ark_reader(utt, ark_key):
+    data = kaldi_ark.ArkReader().read(ark_key)
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(data, EXPECTED[utt])
+
+
+@pytest.mark.parametrize("utt, ark_key", list(iter_ark_keys()))
+def test_numpy_fn_read_matrix_returns_rank_2(utt, ark_key):
+    data = kaldi_ark.numpy_fn_read_matrix(ark_key.encode("utf-8"))
+    assert data.ndim == 2
+    np.testing.assert_array_equal(data, np.atleast_2d(EXPECTED[utt]))
+
+
+def test_load_kaldi_features_static_shape():
+    tf = pytest.importorskip("tensorflow")
+    from lidbox.dataset.steps import load_kaldi_features
+    utts, ark_keys = zip(*iter_ark_keys())
+    ds = load_kaldi_features(tf.data.Dataset.from_tensor_slices({"id": list(utts), "kaldi_ark_key": list(ark_keys)}))
+    assert ds.element_spec["kaldi_ark"].shape.as_list() == [None, None]
+    for x in ds.as_numpy_iterator():
+        np.testing.assert_array_equal(x["kaldi_ark"], np.atleast_2d(EXPECTED[x["id"].decode("utf-8")]))
@@ -0,0 +1,136 @@
+import os
+
+import pytest
+
+import lidbox.metadata as metadata
+
+
+# Utterance ids in the same, unsorted order in all files
+UTT2PATH = {"utt3": "/data/c.wav", "utt1": "/data/a.wav", "utt2": "/data/b.wav"}
+UTT2LABEL = {"utt3": "fin", "utt1": "eng", "utt2": "swe"}
+UTT2SEG = {"utt3": "c 2.00 3.50 0", "utt1": "a 0.00 1.00 0", "utt2": "b 1.00 -1 1"}
+
+
+def write_metadata_file(path, utt2value):
+    with open(path, "w") as f:
+        for utt, value in utt2value.items():
+            print(utt, value, file=f)
+    return path
+
+
+@pytest.fixture
+def meta_paths(tmp_path):
+    return {
+        "path": write_metadata_file(str(tmp_path / "utt2path"), UTT2PATH),
+        "label": write_metadata_file(str(tmp_path / "utt2label"), UTT2LABEL),
+        "segment": write_metadata_file(str(tmp_path / "utt2seg"), UTT2SEG),
+    }
+
+
+def test_build_index_columns_in_sorted_order(tmp_path, meta_paths):
+    index_dir = str(tmp_path / "index")
+    metadata.build_index(index_dir, meta_paths)
+    index = metadata.MetadataIndex(index_dir)
+    utt_ids = sorted(UTT2PATH)
+    assert len(index) == len(utt_ids)
+    assert index.columns == ["id", "label", "path", "segment"]
+    assert index.column("id") == utt_ids
+    assert index.column("path") == [UTT2PATH[u] for u in utt_ids]
+    assert index.column("label") == [UTT2LABEL[u] for u in utt_ids]
+    # All value columns of multi-column metadata are kept
+    assert index.column("segment") == [UTT2SEG[u] for u in utt_ids]
+    assert list(index.get_bytes("path", [2, 0])) == [UTT2PATH[utt_ids[2]].encode("utf-8"), UTT2PATH[utt_ids[0]].encode("utf-8")]
+    with pytest.raises(KeyError):
+        index.column("speaker")
+
+
+def test_build_index_requires_same_utterance_ids(tmp_path, meta_paths):
+    write_metadata_file(meta_paths["label"], {"utt1": "eng", "utt2": "swe", "utt4": "fin"})
+    with pytest.raises(ValueError):
+        metadata.build_index(str(tmp_path / "index"), meta_paths)
+
+
+def test_build_index_requires_utt2path(tmp_path, meta_paths):
+    del meta_paths["path"]
+    with pytest.raises(ValueError):
+        metadata.build_index(str(tmp_path / "index"), meta_paths)
+
+
+def test_is_up_to_date(tmp_path, meta_paths):
+    index_dir = str(tmp_path / "index")
+    assert not metadata.is_up_to_date(index_dir, meta_paths)
+    metadata.build_index(index_dir, meta_paths)
+    assert metadata.is_up_to_date(index_dir, meta_paths)
+    # Different set of source files
+    assert not metadata.is_up_to_date(index_dir, {k: p for k, p in meta_paths.items() if k != "segment"})
+    # Modified source file
+    write_metadata_file(meta_paths["label"], dict(UTT2LABEL, utt1="english"))
+    assert not metadata.is_up_to_date(index_dir, meta_paths)
+
+
+def test_update_index_rebuilds_only_when_sources_change(tmp_path, meta_paths):
+    index_dir = str(tmp_path / "index")
+    metadata.update_index(index_dir, meta_paths)
+    manifest_path = os.path.join(index_dir, metadata.MANIFEST_FILE)
+    built_at = os.stat(manifest_path).st_mtime_ns
+    metadata.update_index(index_dir, meta_paths)
+    assert os.stat(manifest_path).st_mtime_ns == built_at
+    write_metadata_file(meta_paths["label"], dict(UTT2LABEL, utt1="english"))
+    metadata.update_index(index_dir, meta_paths)
+    assert metadata.MetadataIndex(index_dir).column("label")[0] == "english"
+
+
+def test_load_dataset_metadata_from_index_and_files(tmp_path, meta_paths):
+    kwargs = {"file_limit": 2}
+    from_files = metadata.load_dataset_metadata("train", dict(meta_paths, dataset="ds", kwargs=kwargs))
+    index_dir = metadata.update_index(str(tmp_path / "index"), meta_paths)
+    from_index = metadata.load_dataset_metadata("train", dict(meta_paths, index=index_dir, dataset="ds", kwargs=kwargs))
+    # Files are read in utt2path order, the index in sorted utterance id order
+    assert from_files["id"] == ["utt3", "utt1"]
+    assert from_index["id"] == ["utt1", "utt2"]
+    for meta in (from_files, from_index):
+        assert set(meta) == {"id", "dataset", "path", "label", "segment"}
+        assert meta["dataset"] == ["ds", "ds"]
+        assert meta["path"] == [UTT2PATH[u] for u in meta["id"]]
+        assert meta["label"] == [UTT2LABEL[u] for u in meta["id"]]
+        assert meta["segment"] == [UTT2SEG[u] for u in meta["id"]]
+
+
+@pytest.mark.parametrize("use_index", [False, True])
+def test_stream_metadata(tmp_path, meta_paths, use_index):
+    pytest.importorskip("tensorflow")
+    from lidbox.dataset.steps import _stream_metadata_files
+    meta = dict(meta_paths, dataset="ds", kwargs={})
+    if use_index:
+        meta["index"] = metadata.update_index(str(tmp_path / "index"), meta_paths)
+        utt_ids = sorted(UTT2PATH)
+    else:
+        utt_ids = list(UTT2PATH)
+    # Batch size smaller than the amount of utterances to stream in more than one batch
+    elements = list(_stream_metadata_files(meta, batch_size=2).as_numpy_iterator())
+    assert [x["id"].decode("utf-8") for x in elements] == utt_ids
+    for x in elements:
+        utt = x["id"].decode("utf-8")
+        assert x["dataset"] == b"ds"
+        assert x["path"].decode("utf-8") == UTT2PATH[utt]
+        assert x["label"].decode("utf-8") == UTT2LABEL[utt]
+        assert x["segment"].decode("utf-8") == UTT2SEG[utt]
+
+
+def test_default_index_directory_is_in_cache(tmp_path, meta_paths):
+    pytest.importorskip("tensorflow")
+    import lidbox.api
+    split_dir = os.path.dirname(meta_paths["path"])
+    config = {
+        "datasets": [{"key": "ds", "labels": ["eng", "fin", "swe"], "splits": [{"key": "train", "path": split_dir}]}],
+        "metadata": {"index": True},
+        "cache": {"directory": str(tmp_path / "cache"), "batch_size": 1},
+    }
+    split2datasets, labels = lidbox.api.get_flat_dataset_config(config)
+    index_dir = split2datasets["train"][0]["index"]
+    assert index_dir == os.path.join(config["cache"]["directory"], "metadata_index", "ds", "train")
+    assert metadata.is_up_to_date(index_dir, meta_paths)
+    assert not os.path.exists(os.path.join(split_dir, metadata.DEFAULT_INDEX_DIRECTORY))
+    config["metadata"]["index_directory"] = str(tmp_path / "indexes")
+    split2datasets, _ = lidbox.api.get_flat_dataset_config(config)
+    assert split2datasets["train"][0]["index"] == os.path.join(config["metadata"]["index_directory"], "ds", "train")
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("webrtcvad")
+from lidbox import vad
+
+
+def test_fill_short_non_speech():
+    is_speech = np.array([0, 0, 1, 0, 1, 0, 0, 0, 1, 1, 0], bool)
+    # Leading and inner runs shorter than 3 frames are filled, trailing non-speech is never filled
+    np.testing.assert_array_equal(
+            vad.fill_short_non_speech(is_speech, 3),
+            np.array([1, 1, 1, 1, 1, 0, 0, 0, 1, 1, 0], bool))
+    np.testing.assert_array_equal(vad.fill_short_non_speech(is_speech, 1), is_speech)
+
+
+def test_decision_cache_round_trip(tmp_path):
+    path = str(tmp_path / "vad.sqlite")
+    cache = vad.DecisionCache(path)
+    params_key = vad.DecisionCache.params_key(aggressiveness=2, frame_length_ms=10)
+    assert params_key != vad.DecisionCache.params_key(aggressiveness=3, frame_length_ms=10)
+    utt2decisions = {
+        "utt1": np.array([1, 0, 1, 1, 0, 0, 1, 0, 1, 1, 1], bool),
+        "utt2": np.zeros(8, bool),
+        "utt3": np.zeros(0, bool),
+    }
+    cache.put_many(params_key, utt2decisions)
+    # Decisions are stored persistently, read them with a new connection
+    found = vad.DecisionCache(path).get_many(params_key, ["utt1", "utt2", "utt3", "utt4"])
+    assert set(found) == set(utt2decisions)
+    for utt, decisions in utt2decisions.items():
+        assert found[utt].dtype == bool
+        np.testing.assert_array_equal(found[utt], decisions)
+    assert cache.get_many(vad.DecisionCache.params_key(aggressiveness=3, frame_length_ms=10), ["utt1"]) == {}
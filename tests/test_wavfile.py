@@ -0,0 +1,111 @@
+import struct
+
+import numpy as np
+import pytest
+
+from lidbox import wavfile
+
+
+def chunk(chunk_id, data):
+    # Chunks of odd size are followed by one padding byte
+    return struct.pack("<4sI", chunk_id, len(data)) + data + b"\x00" * (len(data) & 1)
+
+
+def fmt_chunk(sample_rate, num_channels, audio_format=wavfile.WAVE_FORMAT_PCM, bits_per_sample=16):
+    block_align = num_channels * bits_per_sample // 8
+    fmt = struct.pack("<HHIIHH", audio_format, num_channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample)
+    if audio_format == wavfile.WAVE_FORMAT_EXTENSIBLE:
+        # cbSize, valid bits, channel mask and the sub format GUID, which begins with the actual format code
+        fmt += struct.pack("<HHIH14s", 22, bits_per_sample, 0, wavfile.WAVE_FORMAT_PCM, b"\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71")
+    return chunk(b"fmt ", fmt)
+
+
+def write_wav(path, chunks):
+    body = b"WAVE" + b"".join(chunks)
+    with open(path, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", len(body)) + body)
+    return str(path)
+
+
+def pcm_bytes(pcm):
+    return np.asarray(pcm, dtype="<i2").tobytes()
+
+
+def test_read_header_skips_odd_size_chunks(tmp_path):
+    pcm = np.arange(100, dtype=np.int16)
+    path = write_wav(tmp_path / "a.wav", [
+        chunk(b"LIST", b"odd"),
+        fmt_chunk(8000, 1),
+        chunk(b"junk", b"12345"),
+        chunk(b"data", pcm_bytes(pcm)),
+    ])
+    info = wavfile.read_info(path)
+    assert (info.sample_rate, info.num_channels, info.bits_per_sample, info.audio_format) == (8000, 1, 16, wavfile.WAVE_FORMAT_PCM)
+    assert info.data_size == pcm.size * 2
+    signal, sample_rate = wavfile.read_mono_pcm16(path)
+    np.testing.assert_array_equal(signal, pcm)
+
+
+def test_read_header_extensible_format(tmp_path):
+    pcm = np.arange(-50, 50, dtype=np.int16).reshape((50, 2))
+    path = write_wav(tmp_path / "a.wav", [
+        fmt_chunk(16000, 2, audio_format=wavfile.WAVE_FORMAT_EXTENSIBLE),
+        chunk(b"data", pcm_bytes(pcm)),
+    ])
+    info = wavfile.read_info(path)
+    assert info.audio_format == wavfile.WAVE_FORMAT_PCM
+    assert (info.sample_rate, info.num_channels) == (16000, 2)
+    segment, _ = wavfile.read_pcm16_segment(path)
+    np.testing.assert_array_equal(segment, pcm)
+
+
+def test_read_header_truncated_data_chunk(tmp_path):
+    pcm = np.arange(100, dtype=np.int16)
+    path = write_wav(tmp_path / "a.wav", [
+        fmt_chunk(8000, 1),
+        chunk(b"data", pcm_bytes(pcm)),
+    ])
+    # Drop the last 20 samples without updating the sizes in the header, like an interrupted recording
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 40)
+    info = wavfile.read_info(path)
+    assert info.data_size == 80 * 2
+    assert wavfile.scan_file(path) == (8000, 1, 80 / 8000)
+    signal, _ = wavfile.read_mono_pcm16(path)
+    np.testing.assert_array_equal(signal, pcm[:80])
+
+
+def test_read_header_invalid_files(tmp_path):
+    not_wav = tmp_path / "a.wav"
+    not_wav.write_bytes(b"not a wav file")
+    no_data = write_wav(tmp_path / "b.wav", [fmt_chunk(8000, 1)])
+    for path in (str(not_wav), no_data):
+        with pytest.raises(wavfile.WavHeaderError):
+            wavfile.read_info(path)
+        assert wavfile.scan_file(path) is None
+
+
+@pytest.mark.parametrize("start_sec, end_sec, begin, end", [
+    (0.0, -1.0, 0, 100),
+    (0.25, 0.5, 25, 50),
+    # Negative start is clamped to the beginning
+    (-1.0, 0.1, 0, 10),
+    # End past the end of the file is clamped to the end
+    (0.9, 2.0, 90, 100),
+    # Start past the end of the file gives an empty segment
+    (1.5, 2.0, 100, 100),
+    # End before start gives an empty segment
+    (0.5, 0.25, 50, 50),
+])
+def test_read_pcm16_segment_clamps_to_file(tmp_path, start_sec, end_sec, begin, end):
+    pcm = np.arange(200, dtype=np.int16).reshape((100, 2))
+    path = write_wav(tmp_path / "a.wav", [
+        fmt_chunk(100, 2),
+        chunk(b"data", pcm_bytes(pcm)),
+    ])
+    segment, sample_rate = wavfile.read_pcm16_segment(path, start_sec, end_sec)
+    assert sample_rate == 100
+    assert segment.shape == (end - begin, 2)
+    np.testing.assert_array_equal(segment, pcm[begin:end])
+    signal, _ = wavfile.read_mono_pcm16(path, start_sec, end_sec, channel=1)
+    np.testing.assert_array_equal(signal, pcm[begin:end,1])